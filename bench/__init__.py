@@ -0,0 +1,11 @@
+'''
+    benchmark harness for the command engine
+
+    python -m bench [--mode inproc|socket|both] [--rows N] [--ops N] [--clients N] ..
+
+    Loads a synthetic schema using every column role and runs workloads
+    against it, either through Server.run_command in this process or over
+    sockets against a server in a child process. Latencies and throughput
+    are printed as JSON, to be compared across commits. Databases use the
+    embedded local engine unless told otherwise, so no MongoDB is needed.
+'''
@@ -0,0 +1,205 @@
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from bench import schema
+from bench.clients import ROOT, LocalClient, SocketClient, start_server
+from bench.workloads import LIMITED, WORKLOADS, Dataset
+from server import Server
+
+DATABASE = 'bench'
+
+
+def percentile(latencies, p) -> float:
+    '''
+        nearest rank percentile of sorted latencies, in milliseconds
+    '''
+    if len(latencies) == 0:
+        return None
+    rank = max(0, math.ceil(p / 100 * len(latencies)) - 1)
+    return round(latencies[rank] * 1000, 3)
+
+
+def report(name, mode, clients, latencies, elapsed, errors, **extra) -> dict:
+    latencies = sorted(latencies)
+    return {
+        'workload': name,
+        'mode': mode,
+        'clients': clients,
+        'ops': len(latencies),
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'ops_per_second': round(len(latencies) / elapsed, 1) if elapsed > 0 else None,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        **extra,
+    }
+
+
+def connect(make_client):
+    client = make_client()
+    if not client.execute(f'use_database {DATABASE}'):
+        raise RuntimeError(f'use_database {DATABASE} failed')
+    return client
+
+
+def load(client, engine, customers, batch) -> (list, float, int):
+    '''
+        creates the schema and bulk loads it, one timed operation per batch
+    '''
+    for command in [f'create_database {DATABASE} {engine}', f'use_database {DATABASE}', *schema.create_commands()]:
+        if not client.execute(command):
+            raise RuntimeError(f'{command} failed')
+
+    rows = [('customer', schema.customer(i)) for i in range(customers)]
+    rows += [('orders', schema.order(n, customers)) for n in range(schema.orders(customers))]
+    latencies = []
+    errors = 0
+    start = time.perf_counter()
+    for i in range(0, len(rows), batch):
+        chunk = rows[i:i + batch]
+        # a batch does not span tables, so parents are loaded before children
+        for table in dict.fromkeys(table for table, _ in chunk):
+            values = ';'.join(row for t, row in chunk if t == table)
+            t0 = time.perf_counter()
+            errors += not client.execute(f'bulk_insert into {table} values {values}')
+            latencies.append(time.perf_counter() - t0)
+    return latencies, time.perf_counter() - start, errors
+
+
+def run(make_client, workload, data, clients, ops, seed) -> (list, float, int):
+    '''
+        runs ops operations of a workload split among concurrent clients,
+        returns (latencies, elapsed, errors)
+    '''
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    conns = [connect(make_client) for _ in range(clients)]
+    barrier = threading.Barrier(clients + 1)
+
+    def worker(n, client):
+        nonlocal errors
+        rng = random.Random(seed * 1000 + n)
+        mine = []
+        failed = 0
+        barrier.wait()
+        for _ in range(ops // clients + (n < ops % clients)):
+            commands = workload(data, rng)
+            t0 = time.perf_counter()
+            for command in commands:
+                failed += not client.execute(command)
+            mine.append(time.perf_counter() - t0)
+        with lock:
+            latencies.extend(mine)
+            errors += failed
+
+    threads = [threading.Thread(target=worker, args=(n, conn)) for n, conn in enumerate(conns)]
+    for thread in threads:
+        thread.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    for conn in conns:
+        conn.close()
+    return latencies, elapsed, errors
+
+
+def bench(mode, args) -> list:
+    server_dir = tempfile.mkdtemp(prefix='pythondb-bench-')
+    env = dict(os.environ, PYTHONDB_WAL='on' if args.wal else 'off', PYTHONDB_CACHE_MB=str(args.cache_mb))
+    proc = None
+    try:
+        if mode == 'socket':
+            proc, address = start_server(server_dir, env)
+            make_client = lambda: SocketClient(address)
+        else:
+            server = Server(server_dir, wal=args.wal, cache_bytes=args.cache_mb * 2 ** 20)
+            make_client = lambda: LocalClient(server)
+
+        results = []
+        client = make_client()
+        latencies, elapsed, errors = load(client, args.engine, args.rows, args.batch)
+        rows = args.rows + schema.orders(args.rows)
+        results.append(report('bulk_load', mode, 1, latencies, elapsed, errors,
+                              rows=rows, rows_per_second=round(rows / elapsed, 1)))
+
+        data = Dataset(args.rows, args.seed)
+        for name in args.workloads:
+            ops = min(args.ops, args.rows) if name in LIMITED else args.ops
+            latencies, elapsed, errors = run(make_client, WORKLOADS[name], data, args.clients, ops, args.seed)
+            results.append(report(name, mode, args.clients, latencies, elapsed, errors))
+            print(f'{mode} {name}: {len(latencies) / elapsed:.0f} ops/s', file=sys.stderr)
+
+        client.execute(f'drop_database {DATABASE}')
+        client.close()
+        return results
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait()
+        shutil.rmtree(server_dir, ignore_errors=True)
+
+
+def commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    args = argparse.ArgumentParser(prog='python -m bench', description='pythondb benchmarks')
+    args.add_argument('--mode', choices=['inproc', 'socket', 'both'], default='inproc')
+    args.add_argument('--engine', choices=['local', 'mongo'], default='local')
+    args.add_argument('--rows', type=int, default=2000, help='customers loaded, orders get 8 rows each')
+    args.add_argument('--ops', type=int, default=1000, help='operations per workload')
+    args.add_argument('--clients', type=int, default=1, help='concurrent clients per workload')
+    args.add_argument('--batch', type=int, default=1000, help='rows per bulk_insert while loading')
+    args.add_argument('--workloads', default=','.join(WORKLOADS), help='comma separated, from: ' + ', '.join(WORKLOADS))
+    args.add_argument('--seed', type=int, default=0)
+    args.add_argument('--cache-mb', type=int, default=64, help='row cache per database, 0 disables it')
+    args.add_argument('--no-wal', dest='wal', action='store_false', help='disable the write-ahead log')
+    args.add_argument('--out', help='write the JSON report here instead of stdout')
+    args = args.parse_args()
+
+    args.workloads = [name for name in args.workloads.split(',') if len(name) != 0]
+    for name in args.workloads:
+        if name not in WORKLOADS:
+            sys.exit(f'unknown workload: {name}')
+    # the data changing workloads run last whatever the order given
+    args.workloads.sort(key=lambda name: name in ('mixed', *LIMITED))
+
+    modes = ['inproc', 'socket'] if args.mode == 'both' else [args.mode]
+    results = []
+    for mode in modes:
+        results += bench(mode, args)
+
+    out = {
+        'commit': commit(),
+        'python': platform.python_version(),
+        'config': {key: value for key, value in vars(args).items() if key not in ('out', 'mode')},
+        'results': results,
+    }
+    text = json.dumps(out, indent=2)
+    if args.out is None:
+        print(text)
+    else:
+        with open(args.out, 'w') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+'''
+    ways of sending commands to a server, one client per benchmark thread
+'''
+import os
+import socket
+import subprocess
+import sys
+import time
+from client import Connection
+from error import Error
+from session import Session, current_session
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class LocalClient:
+    '''
+        runs commands through Server.run_command, in a session of its own
+    '''
+
+    def __init__(self, server):
+        self.server = server
+        self.session = Session()
+
+    def execute(self, command) -> bool:
+        token = current_session.set(self.session)
+        try:
+            code, _ = self.server.run_command(command, lambda row: None)
+        finally:
+            current_session.reset(token)
+        return code == Error.SUCCESS
+
+    def close(self):
+        self.session.close()
+
+
+class SocketClient:
+    '''
+        runs commands over a connection, waiting for each response
+    '''
+
+    def __init__(self, address):
+        self.conn = Connection(address)
+
+    def execute(self, command) -> bool:
+        self.conn.send(command)
+        _, status, _, _ = self.conn.receive()
+        return status == Error.SUCCESS.name
+
+    def close(self):
+        self.conn.close()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def start_server(server_dir, env=None, timeout=10) -> (subprocess.Popen, tuple):
+    '''
+        starts a server in a child process, returns it and its address
+        once it accepts connections
+    '''
+    address = ('localhost', free_port())
+    code = 'import sys, server; server.Server(sys.argv[1]).listen((sys.argv[2], int(sys.argv[3])))'
+    proc = subprocess.Popen([sys.executable, '-c', code, server_dir, *map(str, address)],
+                            cwd=ROOT, env=env, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(address).close()
+            return proc, address
+        except ConnectionError:
+            if proc.poll() is not None or time.monotonic() > deadline:
+                proc.kill()
+                raise
+            time.sleep(0.05)
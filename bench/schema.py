@@ -0,0 +1,63 @@
+'''
+    synthetic schema and rows for the benchmarks
+
+    customer has one column of every role but foreign-key, orders has a
+    composite primary key and references customer.
+'''
+import datetime
+
+REGIONS = 100  # distinct values of the non unique index
+ORDERS_PER_CUSTOMER = 4
+LINES_PER_ORDER = 2  # rows sharing the first part of the orders key
+FIRST_DAY = datetime.date(2020, 1, 1)
+DAYS = 1500  # distinct values of the date index
+
+TABLES = {
+    'customer': [
+        ('id', 'int', 'primary-key-unique'),
+        ('email', 'string', 'unique'),
+        ('region', 'int', 'index'),
+        ('joined', 'date', 'index'),
+        ('name', 'string', 'none'),
+    ],
+    'orders': [
+        ('id', 'int', 'primary-key-not-unique'),
+        ('line', 'int', 'primary-key-not-unique'),
+        ('customer', 'int', 'foreign-key=customer.id'),
+        ('total', 'float', 'index'),
+        ('note', 'string', 'none'),
+    ],
+}
+
+
+def create_commands() -> list:
+    commands = []
+    for table, columns in TABLES.items():
+        commands.append(f'create_table {table}')
+        for name, col_type, role in columns:
+            commands.append(f'create_column {table} {name} {col_type} {role}')
+    return commands
+
+
+def day(n) -> str:
+    return (FIRST_DAY + datetime.timedelta(days=n % DAYS)).isoformat()
+
+
+def customer(i) -> str:
+    return f'{i}#user{i}@example.com#{i % REGIONS}#{day(i * 7)}#name{i}'
+
+
+def order(n, customers) -> str:
+    '''
+        row n of orders, the rows of an order belong to the same customer
+    '''
+    oid = n // LINES_PER_ORDER
+    return f'{oid}#{n % LINES_PER_ORDER}#{oid % customers}#{total(n)}#note{n}'
+
+
+def total(n) -> str:
+    return f'{n * 7919 % 100000 / 100:.2f}'
+
+
+def orders(customers) -> int:
+    return customers * ORDERS_PER_CUSTOMER * LINES_PER_ORDER
@@ -0,0 +1,101 @@
+'''
+    workloads, each a function returning the commands of one operation
+
+    An operation is timed as a whole, a cascading delete for example is
+    two commands. Workloads that change data come last, so the others see
+    the rows as loaded.
+'''
+import itertools
+import random
+from bench import schema
+
+
+class Dataset:
+    '''
+        what the workloads need to know about the loaded rows,
+        shared by the clients of a run
+    '''
+
+    def __init__(self, customers, seed=0):
+        self.customers = customers
+        self.orders = schema.orders(customers)
+        self.new_rows = itertools.count(self.orders)  # rows of orders inserted by mixed
+        victims = list(range(customers))
+        random.Random(seed).shuffle(victims)
+        self.victims = iter(victims)  # customers deleted by cascade_delete
+
+
+def point(data, rng):
+    k = rng.randrange(data.customers)
+    return [f'select * from customer where id={k}']
+
+
+def composite_key(data, rng):
+    n = rng.randrange(data.orders)
+    oid, line = divmod(n, schema.LINES_PER_ORDER)
+    return [f'select * from orders where id={oid} line={line}']
+
+
+def unique(data, rng):
+    k = rng.randrange(data.customers)
+    return [f'select id,name from customer where email=user{k}@example.com']
+
+
+def index(data, rng):
+    return [f'select id from customer where region={rng.randrange(schema.REGIONS)}']
+
+
+def foreign_key(data, rng):
+    k = rng.randrange(data.customers)
+    return [f'select * from orders where customer={k}']
+
+
+def range_scan(data, rng):
+    if rng.random() < 0.5:
+        n = rng.randrange(schema.DAYS)
+        return [f'select id from customer where joined between {schema.day(n)} and {schema.day(n + 7)}']
+    lo = rng.randrange(100000 - 500) / 100
+    return [f'select id,line from orders where total>={lo:.2f} total<{lo + 5:.2f}']
+
+
+def join(data, rng):
+    k = rng.randrange(data.customers)
+    return [f'select customer.name,orders.total from customer,orders '
+            f'where customer.id=orders.customer orders.customer={k}']
+
+
+def aggregate(data, rng):
+    if rng.random() < 0.5:
+        return [f'select count(*) from orders where customer={rng.randrange(data.customers)}']
+    return [f'select region,count(*),avg(total) from customer,orders '
+            f'where customer.id=orders.customer customer.region={rng.randrange(schema.REGIONS)} group by region']
+
+
+def mixed(data, rng):
+    r = rng.random()
+    if r < 0.7:
+        return point(data, rng)
+    if r < 0.8:
+        return foreign_key(data, rng)
+    return [f'insert into orders values {schema.order(next(data.new_rows), data.customers)}']
+
+
+def cascade_delete(data, rng):
+    # children first, a referenced customer cannot be deleted
+    k = next(data.victims)
+    return [f'delete orders where customer={k}', f'delete customer where id={k}']
+
+
+WORKLOADS = {
+    'point': point,
+    'composite_key': composite_key,
+    'unique': unique,
+    'index': index,
+    'foreign_key': foreign_key,
+    'range': range_scan,
+    'join': join,
+    'aggregate': aggregate,
+    'mixed': mixed,
+    'cascade_delete': cascade_delete,
+}
+LIMITED = {'cascade_delete'}  # at most one operation per customer
@@ -0,0 +1,188 @@
+'''
+    counting Bloom filters over the values of unique columns
+
+    A filter answers whether a value may be stored in a unique or single
+    primary key column: no means the value is absent and the index need not
+    be asked, yes means it has to be. Counters instead of bits let deleted
+    values be removed.
+
+    Filters are built from the indexes when the database is opened, or read
+    from TABLE.COL.bloom next to the table definition when that was saved
+    since the last value was added; adding a value deletes the saved file,
+    since it no longer holds everything. A filter holding more values than
+    it was sized for lets more through until it is rebuilt larger.
+
+    Values are added before the index entries are written and removed only
+    once they are deleted. Counts left over by failed writes or replays
+    only cost false positives; a missing count would wrongly skip a check.
+'''
+import hashlib
+import math
+import os
+import pickle
+import struct
+import threading
+
+FALSE_POSITIVES = 0.01  # share of absent values a filter lets through at capacity
+MIN_CAPACITY = 1024  # values a new filter is sized for, at least
+HEADER = struct.Struct('>QQI')  # capacity, values, hashes
+
+
+class CountingBloom:
+
+    def __init__(self, capacity, hashes=None, counts=None, size=0):
+        self.capacity = max(capacity, MIN_CAPACITY)
+        slots = math.ceil(-self.capacity * math.log(FALSE_POSITIVES) / math.log(2) ** 2)
+        self.hashes = hashes or max(1, round(slots / self.capacity * math.log(2)))
+        self.counts = bytearray(slots) if counts is None else counts
+        self.size = size  # values added and not removed
+
+    def positions(self, value):
+        digest = hashlib.blake2b(pickle.dumps(value, 4), digest_size=16).digest()
+        h1, h2 = struct.unpack('>QQ', digest)
+        slots = len(self.counts)
+        return [(h1 + i * h2) % slots for i in range(self.hashes)]
+
+    def add(self, value):
+        for i in self.positions(value):
+            # a full counter stays full, it can no longer be counted down
+            if self.counts[i] != 255:
+                self.counts[i] += 1
+        self.size += 1
+
+    def remove(self, value):
+        positions = self.positions(value)
+        if any(self.counts[i] == 0 for i in positions):
+            # never added, counting down would hide other values
+            return
+        for i in positions:
+            if self.counts[i] != 255:
+                self.counts[i] -= 1
+        self.size -= 1
+
+    def __contains__(self, value):
+        return all(self.counts[i] != 0 for i in self.positions(value))
+
+    def full(self):
+        return self.size > self.capacity
+
+    def dumps(self) -> bytes:
+        return HEADER.pack(self.capacity, self.size, self.hashes) + bytes(self.counts)
+
+    @staticmethod
+    def loads(data):
+        capacity, size, hashes = HEADER.unpack_from(data)
+        return CountingBloom(capacity, hashes, bytearray(data[HEADER.size:]), size)
+
+
+class Filter:
+    '''
+        filter of one column, with the file it is saved to and source, a
+        function returning every value stored in the column
+    '''
+
+    def __init__(self, path, bloom, saved, source):
+        self.path = path
+        self.bloom = bloom
+        self.saved = saved  # the file holds every value added so far
+        self.source = source
+        self.lock = threading.Lock()
+
+    def add(self, values):
+        with self.lock:
+            if self.saved:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                self.saved = False
+            for val in values:
+                self.bloom.add(val)
+
+    def remove(self, values):
+        with self.lock:
+            for val in values:
+                self.bloom.remove(val)
+
+    def __contains__(self, value):
+        return value in self.bloom
+
+    def rebuild(self):
+        stored = list(self.source())
+        bloom = CountingBloom(2 * len(stored))
+        for val in stored:
+            bloom.add(val)
+        with self.lock:
+            self.bloom = bloom
+            self.saved = False
+
+    def save(self):
+        with self.lock:
+            if self.saved:
+                return
+            tmp = f'{self.path}.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(self.bloom.dumps())
+            os.replace(tmp, self.path)
+            self.saved = True
+
+
+class Filters:
+    '''
+        filters of the unique columns of one database, by (table, column)
+
+        Filters are rebuilt only while no value can be on its way between
+        being added and being written: when the database is opened, and
+        by grow at a checkpoint of the write-ahead log.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.filters = {}
+
+    def file(self, table, col):
+        return os.path.join(self.path, f'{table}.{col}.bloom')
+
+    def open(self, table, col, source):
+        '''
+            makes the filter of a column, read from its file or built from source
+        '''
+        path = self.file(table, col)
+        filt = None
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                filt = Filter(path, CountingBloom.loads(f.read()), True, source)
+        if filt is None or filt.bloom.full():
+            filt = Filter(path, None, False, source)
+            filt.rebuild()
+            filt.save()
+        with self.lock:
+            self.filters[(table, col)] = filt
+
+    def get(self, table, col) -> Filter | None:
+        return self.filters.get((table, col))
+
+    def columns(self, table) -> list:
+        return [col for name, col in self.filters if name == table]
+
+    def drop(self, table, col=None):
+        with self.lock:
+            for key in [key for key in self.filters if key[0] == table and col in (None, key[1])]:
+                filt = self.filters.pop(key)
+                if os.path.exists(filt.path):
+                    os.remove(filt.path)
+
+    def full(self) -> bool:
+        return any(filt.bloom.full() for filt in list(self.filters.values()))
+
+    def grow(self):
+        '''
+            rebuilds the filters holding more values than they were
+            sized for; nothing may be written meanwhile
+        '''
+        for filt in list(self.filters.values()):
+            if filt.bloom.full():
+                filt.rebuild()
+
+    def save(self):
+        for filt in list(self.filters.values()):
+            filt.save()
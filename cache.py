@@ -0,0 +1,277 @@
+'''
+    in-process cache of rows and index entries
+
+    CachedEngine wraps the engine of a database and remembers the answers
+    of get, multi_get and index_get, including the keys and values found
+    missing, in an LRUCache bounded by an estimate of their size in memory.
+    Every write goes through the wrapper and drops the entries it touches,
+    so the cache holds only what the engine would return. Databases are
+    assumed to be written by this server alone.
+'''
+import os
+import threading
+from collections import OrderedDict
+from storage import hashable
+
+CACHE_BYTES = int(os.getenv('PYTHONDB_CACHE_MB', '64')) * 2 ** 20  # per database, 0 disables the cache
+
+MISSING = object()
+
+
+def size_of(value) -> int:
+    '''
+        rough size of a document in memory, in bytes
+    '''
+    if isinstance(value, dict):
+        return 64 + sum(size_of(k) + size_of(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return 56 + sum(8 + size_of(v) for v in value)
+    if isinstance(value, (str, bytes)):
+        return 49 + len(value)
+    return 32
+
+
+class LRUCache:
+
+    def __init__(self, budget):
+        self.budget = budget  # bytes
+        self.entries = OrderedDict()  # key -> (value, size), least recently used first
+        self.size = 0
+        self.lock = threading.Lock()
+        self.generation = 0  # bumped by every invalidation
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        '''
+            returns the cached value or MISSING
+        '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return MISSING
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, generation):
+        '''
+            caches a value read while the cache was at generation,
+            unless something was invalidated since
+        '''
+        size = size_of(key) + size_of(value)
+        with self.lock:
+            if generation != self.generation or size > self.budget:
+                return
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self.entries[key] = (value, size)
+            self.size += size
+            while self.size > self.budget:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+                self.evictions += 1
+
+    def invalidate(self, keys):
+        with self.lock:
+            self.generation += 1
+            for key in keys:
+                entry = self.entries.pop(key, None)
+                if entry is not None:
+                    self.size -= entry[1]
+
+    def invalidate_where(self, match):
+        '''
+            drops every entry whose key satisfies match
+        '''
+        with self.lock:
+            self.generation += 1
+            for key in [key for key in self.entries if match(key)]:
+                self.size -= self.entries.pop(key)[1]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'budget': self.budget,
+            }
+
+
+class CachedEngine:
+    '''
+        engine whose point reads are served from a cache,
+        everything else is passed to the wrapped engine
+    '''
+
+    def __init__(self, engine, cache):
+        self.engine = engine
+        self.cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self.engine, name)
+
+    #
+    # ROWS
+    #
+
+    def get(self, table, key):
+        return next(iter(self.multi_get(table, [key])), None)
+
+    def multi_get(self, table, keys):
+        keys = {hashable(key): key for key in keys}
+        found = {}
+        missed = []
+        for key in keys:
+            doc = self.cache.get(('row', table, key))
+            if doc is MISSING:
+                missed.append(key)
+            else:
+                found[key] = doc
+        if len(missed) != 0:
+            generation = self.cache.generation
+            docs = {hashable(doc['_id']): doc for doc in self.engine.multi_get(table, [keys[key] for key in missed])}
+            for key in missed:
+                found[key] = docs.get(key)
+                self.cache.put(('row', table, key), found[key], generation)
+        # in the order of the keys
+        return [found[key] for key in keys if found[key] is not None]
+
+    # the cache is invalidated after each write, so that no read
+    # that started before the write can cache what it replaced
+
+    def put(self, table, doc):
+        try:
+            self.engine.put(table, doc)
+        finally:
+            self.cache.invalidate([('row', table, hashable(doc['_id']))])
+
+    def put_many(self, table, docs):
+        try:
+            self.engine.put_many(table, docs)
+        finally:
+            self.cache.invalidate([('row', table, hashable(doc['_id'])) for doc in docs])
+
+    def replace_many(self, table, docs):
+        try:
+            self.engine.replace_many(table, docs)
+        finally:
+            self.cache.invalidate([('row', table, hashable(doc['_id'])) for doc in docs])
+
+    def delete(self, table, keys):
+        keys = list(keys)
+        try:
+            self.engine.delete(table, keys)
+        finally:
+            self.cache.invalidate([('row', table, hashable(key)) for key in keys])
+
+    def drop(self, table):
+        try:
+            self.engine.drop(table)
+        finally:
+            self.cache.invalidate_where(lambda key: key[:2] == ('row', table))
+
+    #
+    # INDEXES
+    #
+
+    def index_get(self, index, col, values):
+        found = {}
+        missed = []
+        for val in values:
+            doc = self.cache.get(('index', index, col, hashable(val)))
+            if doc is MISSING:
+                missed.append(val)
+            elif doc is not None:
+                found[hashable(val)] = doc
+        if len(missed) != 0:
+            generation = self.cache.generation
+            docs = self.engine.index_get(index, col, missed)
+            for val in missed:
+                doc = docs.get(hashable(val))
+                self.cache.put(('index', index, col, hashable(val)), doc, generation)
+                if doc is not None:
+                    found[hashable(val)] = doc
+        return found
+
+    def __invalidate(self, index, entries):
+        self.cache.invalidate([('index', index, col, hashable(val)) for col, val in entries])
+
+    def index_insert(self, index, col, entries):
+        try:
+            self.engine.index_insert(index, col, entries)
+        finally:
+            self.__invalidate(index, [(col, val) for val in entries])
+
+    def index_delete(self, index, col, values):
+        values = list(values)
+        try:
+            self.engine.index_delete(index, col, values)
+        finally:
+            self.__invalidate(index, [(col, val) for val in values])
+
+    def index_push(self, index, field, items):
+        try:
+            self.engine.index_push(index, field, items)
+        finally:
+            self.__invalidate(index, items)
+
+    def index_add(self, index, field, items):
+        try:
+            self.engine.index_add(index, field, items)
+        finally:
+            self.__invalidate(index, items)
+
+    def index_pull(self, index, field, items):
+        try:
+            self.engine.index_pull(index, field, items)
+        finally:
+            self.__invalidate(index, items)
+
+    def refs_add(self, index, table, refs):
+        try:
+            self.engine.refs_add(index, table, refs)
+        finally:
+            self.__invalidate(index, refs)
+
+    def refs_remove(self, index, table, refs):
+        try:
+            self.engine.refs_remove(index, table, refs)
+        finally:
+            self.__invalidate(index, refs)
+
+    def refs_purge(self, index, table):
+        try:
+            self.engine.refs_purge(index, table)
+        finally:
+            self.cache.invalidate_where(lambda key: key[:2] == ('index', index))
+
+    def refs_convert(self, index):
+        try:
+            self.engine.refs_convert(index)
+        finally:
+            self.cache.invalidate_where(lambda key: key[:2] == ('index', index))
+
+    def index_purge(self, index, col, field, item):
+        try:
+            self.engine.index_purge(index, col, field, item)
+        finally:
+            self.cache.invalidate_where(lambda key: key[:3] == ('index', index, col))
+
+    def drop_index(self, index):
+        try:
+            self.engine.drop_index(index)
+        finally:
+            self.cache.invalidate_where(lambda key: key[:2] == ('index', index))
+
+    def drop_database(self):
+        try:
+            self.engine.drop_database()
+        finally:
+            self.cache.invalidate_where(lambda key: True)
@@ -0,0 +1,319 @@
+import json
+import os
+import threading
+import parser
+from error import Error, ServerError
+from storage import hashable
+from functools import reduce
+
+
+class Index:
+    '''
+        compound index over columns of a table, declared with create_index
+
+        Entries are keyed by the values of every indexed column and list the
+        rows holding them, each with the values of the included columns:
+
+            TABLE_cx_NAME  (NAME, {col: val, ..}) -> {'rows': [{'key': row key, 'inc': [val, ..]}, ..]}
+
+        An index answers equality on all of its columns in one probe. The
+        columns it covers, the indexed, included and primary key ones, can
+        be read from its entries without fetching the rows.
+
+        An index is building from when it is declared until every stored
+        row has its entry; writes keep it up to date meanwhile, but only
+        ready indexes are read.
+    '''
+
+    def __init__(self, table, definition):
+        self.table = table
+        self.name = definition['name']
+        self.columns = definition['columns']
+        self.include = definition.get('include', [])
+        self.collection = f'{table.name}_cx_{self.name}'
+        self.covered = {*self.columns, *self.include, *(col['name'] for col in table.keys)}
+        self.ready = definition.get('state', 'ready') == 'ready'
+        self.definition = definition
+
+    def value(self, row):
+        return Compound((name, row[name]) for name in self.columns)
+
+    def item(self, row) -> dict:
+        return {'key': row['_id'], 'inc': [row[name] for name in self.include]}
+
+    def entries(self, rows) -> dict:
+        '''
+            {(NAME, value): [item, ..]} of reconstructed rows, for index_push and index_pull
+        '''
+        entries = {}
+        for row in rows:
+            entries.setdefault((self.name, self.value(row)), []).append(self.item(row))
+        return entries
+
+    def rows(self, doc):
+        '''
+            yields the rows of an entry, holding only the covered columns
+        '''
+        value = doc['_id'][self.name]
+        keys = self.table.keys
+        for item in doc['rows']:
+            key = item['key']
+            row = {'_id': key}
+            if len(keys) == 1:
+                row[keys[0]['name']] = key
+            else:
+                row.update(key)
+            row.update(value)
+            row.update(zip(self.include, item['inc']))
+            yield row
+
+
+class IndexBuild:
+    '''
+        compound index being built from the stored rows
+
+        Writes capture the entries they add to or remove from the index
+        before they do, the last change of each entry is applied again once
+        the rows are read: the build may have read a row before it went, or
+        after it came and got its entry.
+    '''
+
+    def __init__(self, index, rows):
+        self.index = index
+        self.rows = rows  # stored when the build started
+        self.done = 0  # rows read so far
+        self.changes = {}  # (value, item) -> (value, item, added)
+        self.cancelled = False
+        self.lock = threading.Lock()
+
+    def capture(self, entries, added):
+        with self.lock:
+            for value, items in entries.items():
+                for item in items:
+                    self.changes[(value, hashable(item))] = (value, item, added)
+
+    def take(self) -> (dict, dict):
+        '''
+            (added, removed) entries captured since the last take
+        '''
+        with self.lock:
+            changes, self.changes = self.changes, {}
+        added, removed = {}, {}
+        for value, item, add in changes.values():
+            (added if add else removed).setdefault(value, []).append(item)
+        return added, removed
+
+
+class Compound(dict):
+    '''
+        value of a compound index, stored as a document of its columns in
+        index order; hashable so that it can key index_push and index_get
+    '''
+
+    def __hash__(self):
+        return hash(tuple(self.items()))
+
+
+class Table:
+    '''
+        cached definition of a single table
+
+        columns: column definitions in declaration order, as stored on disk
+        cols:    column definitions indexed by name
+        keys:    primary key columns, in the order they make up the row key
+        values:  every other column, in the order they are stored in a row
+        key_idx, value_idx: positions of keys and values in an inserted row
+        roles:   column definitions grouped by role
+        indexes: compound indexes by name, written by every change
+        ready:   compound indexes by name that are built, read by select
+
+        Rows are stored as {'_id': key, 'v': [value, ..]} holding comparable
+        values: the key is the value of a single primary key column, or a
+        dict of every primary key column. reconstruct is compiled from the
+        column order; rows written as '#'-joined strings are still read.
+    '''
+
+    def __init__(self, name, columns, indexes=()):
+        self.name = name
+        self.columns = columns
+        self.cols = {col['name']: col for col in columns}
+        self.keys = [col for col in columns if col['role'].startswith('primary-key')]
+        self.values = [col for col in columns if not col['role'].startswith('primary-key')]
+        self.key_idx = [i for i, col in enumerate(columns) if col['role'].startswith('primary-key')]
+        self.value_idx = [i for i, col in enumerate(columns) if not col['role'].startswith('primary-key')]
+        self.roles = {}
+        for col in columns:
+            self.roles.setdefault(col['role'], []).append(col)
+        self.indexes = {definition['name']: Index(self, definition) for definition in indexes}
+        self.ready = {name: index for name, index in self.indexes.items() if index.ready}
+
+        # (name, is key) for every column; drives legacy row reconstruction
+        self.order = [(col['name'], col['role'].startswith('primary-key')) for col in columns]
+        self.reconstruct = self.__decoder()
+
+    def __decoder(self):
+        fields = []
+        for col in self.columns:
+            if col in self.values:
+                fields.append(f"{col['name']!r}: v[{self.values.index(col)}]")
+            elif len(self.keys) == 1:
+                fields.append(f"{col['name']!r}: k")
+            else:
+                fields.append(f"{col['name']!r}: k[{col['name']!r}]")
+        source = (
+            'def reconstruct(row):\n'
+            '    v = row.get("v")\n'
+            '    if v is None:\n'
+            '        return legacy(row)\n'
+            '    k = row["_id"]\n'
+            f'    return {{"_id": k, {", ".join(fields)}}}\n')
+        scope = {'legacy': self.__legacy}
+        exec(compile(source, f'<table {self.name}>', 'exec'), scope)
+        return scope['reconstruct']
+
+    def __legacy(self, row):
+        # rows stored as strings, found only until the database is upgraded when opened
+        keys = iter(row['_id'].split('#'))
+        vals = iter(row['values'].split('#'))
+
+        doc = {'_id': row['_id']}
+        for (name, is_key), col in zip(self.order, self.columns):
+            doc[name] = parser.parse_value(next(keys) if is_key else next(vals), col['type'])
+        return doc
+
+    def role(self, role):
+        return self.roles.get(role, [])
+
+    def parse(self, name, text):
+        '''
+            comparable value of text in a column, raises INVALID_TYPE
+        '''
+        col_type = self.cols[name]['type']
+        if not parser.parser_input(text, col_type):
+            raise ServerError(Error.INVALID_TYPE, f'{self.name}.{name}: {text}')
+        return parser.parse_value(text, col_type)
+
+    def condition(self, name, cond):
+        '''
+            types a where condition on a column: a value, a range or
+            a list of both, which is folded into one condition
+        '''
+        if isinstance(cond, list):
+            return reduce(parser.intersect, (self.condition(name, c) for c in cond))
+        if isinstance(cond, parser.Range):
+            return cond.map(lambda text: self.parse(name, text))
+        return self.parse(name, cond)
+
+    def typed(self, values) -> list:
+        '''
+            comparable values of a validated row, in declaration order
+        '''
+        return [parser.parse_value(val, col['type']) for col, val in zip(self.columns, values)]
+
+    def make_key(self, values):
+        '''
+            row key of the comparable values of the primary key columns
+        '''
+        if len(self.keys) == 1:
+            return values[0]
+        return {col['name']: val for col, val in zip(self.keys, values)}
+
+    def field(self, name) -> str:
+        '''
+            dotted path of a column in the row documents
+        '''
+        col = self.cols[name]
+        if col in self.values:
+            return f'v.{self.values.index(col)}'
+        if len(self.keys) == 1:
+            return '_id'
+        return f'_id.{name}'
+
+    def encode(self, values) -> dict:
+        '''
+            row document of the comparable values of a row, in declaration order
+        '''
+        return {
+            '_id': self.make_key([values[i] for i in self.key_idx]),
+            'v': [values[i] for i in self.value_idx],
+        }
+
+
+class Catalog:
+    '''
+        in-memory cache of every table definition in a database directory
+
+        Definitions are read once when the database is opened and refreshed
+        only by the methods that write them. Sessions using the same database
+        share its catalog; schema changes hold lock while they read and write.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.tables = {}
+        self.broken = set()  # tables whose definition is not valid json
+        self.version = 0  # bumped by every change of a definition
+        self.dropped = False  # set once the database is dropped
+        self.load()
+
+    def tab_path(self, table):
+        return os.path.join(self.path, f'{table}.json')
+
+    @staticmethod
+    def decode(data) -> (list, list):
+        '''
+            (columns, indexes) of a table file; files holding only
+            the list of columns predate compound indexes
+        '''
+        if isinstance(data, list):
+            return data, []
+        return data['columns'], data.get('indexes', [])
+
+    def load(self):
+        self.version += 1
+        self.tables = {}
+        self.broken = set()
+        for file in os.listdir(self.path):
+            table, ext = os.path.splitext(file)
+            if ext != '.json':
+                continue
+            with open(self.tab_path(table), 'r') as f:
+                table_def = f.read()
+            try:
+                self.tables[table] = Table(table, *self.decode(json.loads(table_def)))
+            except json.decoder.JSONDecodeError:
+                self.broken.add(table)
+
+    def __contains__(self, table):
+        return table in self.tables or table in self.broken
+
+    def get(self, table) -> Table:
+        tab = self.tables.get(table)
+        if tab is not None:
+            return tab
+        if table in self.broken:
+            raise ServerError(Error.INVALID_JSON, f"path: {self.tab_path(table)}")
+        raise ServerError(Error.DOES_NOT_EXIST, f"table: {table}")
+
+    def write(self, table, table_def, indexes=None) -> str:
+        '''
+            writes the columns of a table, and its compound index
+            definitions; indexes of None keeps the current ones
+        '''
+        if indexes is None:
+            tab = self.tables.get(table)
+            indexes = [] if tab is None else [index.definition for index in tab.indexes.values()]
+        data = json.dumps({'columns': table_def, 'indexes': indexes})
+        with open(self.tab_path(table), 'w') as f:
+            f.write(data)
+        self.tables[table] = Table(table, table_def, indexes)
+        self.broken.discard(table)
+        self.version += 1
+        return data
+
+    def drop(self, table):
+        os.remove(self.tab_path(table))
+        self.tables.pop(table, None)
+        self.broken.discard(table)
+        self.version += 1
@@ -1,21 +1,148 @@
+import argparse
 import socket
+import sys
+import threading
+import time
+from protocol import decode_batch, encode_request, decode_response
+
+
+class Connection:
+    '''
+        framed connection to a server, requests may be pipelined
+    '''
+
+    def __init__(self, address):
+        self.sock = socket.create_connection(address)
+        self.reader = self.sock.makefile('rb')
+        self.writer = self.sock.makefile('w')
+        self.next_id = 0
+
+    def send(self, command, flush=True) -> int:
+        rid = self.next_id
+        self.next_id += 1
+        self.writer.write(encode_request(rid, command))
+        if flush:
+            self.writer.flush()
+        return rid
+
+    def format(self, format, compression=None) -> str:
+        '''
+            asks for results as text or in binary batches, returns the
+            encoding of the batches
+        '''
+        command = f'format {format}' if compression is None else f'format {format} {compression}'
+        self.send(command)
+        _, status, _, message = self.receive()
+        if status != 'SUCCESS':
+            raise ValueError(f'{command}: [{status}] {message}')
+        return message
+
+    def flush(self):
+        self.writer.flush()
+
+    def receive(self, on_row=None) -> (int, str, int, str):
+        '''
+            reads one response, returns (id, status, rows, message)
+        '''
+        columns = None
+        while len(line := self.reader.readline()) > 0:
+            rid, kind, payload = decode_response(line.decode())
+            if kind == '=':
+                if on_row is not None:
+                    on_row(payload)
+                continue
+            if kind == '#':
+                columns = payload
+                continue
+            if kind == '*':
+                encoding, compression, size = payload
+                data = self.reader.read(size)
+                if on_row is not None:
+                    for values in decode_batch(encoding, compression, data):
+                        on_row(dict(zip(columns, values)))
+                continue
+            rows, message = payload
+            return rid, kind, rows, message
+        raise ConnectionError('server closed the connection')
+
+    def close(self):
+        self.sock.close()
+
+
+def interactive(conn):
+    while True:
+        snd = input('> ')
+        if snd == 'exit':
+            break
+        if len(snd.strip()) == 0:
+            continue
+
+        conn.send(snd)
+        _, status, rows, message = conn.receive(print)
+        print(f'[{status}] {message}')
+
+
+def batch(conn, paths, window):
+    '''
+        replays command files, keeping up to window requests in flight
+    '''
+    commands = []
+    for path in paths:
+        with open(path) as f:
+            commands.extend(line.strip() for line in f if len(line.strip()) != 0)
+
+    slots = threading.Semaphore(window)
+    first = conn.next_id
+
+    def sender():
+        for command in commands:
+            # flush once the window is full or everything is written
+            if not slots.acquire(blocking=False):
+                conn.flush()
+                slots.acquire()
+            conn.send(command, flush=False)
+        conn.flush()
+
+    start = time.perf_counter()
+    thread = threading.Thread(target=sender, daemon=True)
+    thread.start()
+
+    failed = 0
+    total_rows = 0
+    for _ in commands:
+        rid, status, rows, message = conn.receive()
+        slots.release()
+        total_rows += rows
+        if status != 'SUCCESS':
+            failed += 1
+            print(f'{commands[rid - first]}: [{status}] {message}', file=sys.stderr)
+    elapsed = time.perf_counter() - start
+    thread.join()
+
+    print(f'{len(commands)} commands, {failed} failed, {total_rows} rows in {elapsed:.3f}s '
+          f'({len(commands) / elapsed:.0f} commands/s)')
 
 
 def main():
-    address = ("localhost", 25565)
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        s.connect(address)
-        reader = s.makefile('r')
-        while True:
-            snd = input('> ')
-            if snd == 'exit':
-                break
-
-            s.sendall((snd + "\n").encode())
-
-            buf = reader.readline()
-            if len(buf) > 0:
-                print(buf, end='')
+    args = argparse.ArgumentParser(description='pythondb client')
+    args.add_argument('files', nargs='*', help='command files to replay instead of reading commands interactively')
+    args.add_argument('--host', default='localhost')
+    args.add_argument('--port', type=int, default=25565)
+    args.add_argument('--window', type=int, default=256, help='requests in flight in batch mode')
+    args.add_argument('--format', choices=['text', 'binary'], default='text', help='how results are sent')
+    args.add_argument('--compress', choices=['zlib', 'lz4'], help='compression of binary results')
+    args = args.parse_args()
+
+    conn = Connection((args.host, args.port))
+    try:
+        if args.format != 'text' or args.compress is not None:
+            conn.format('binary', args.compress)
+        if len(args.files) != 0:
+            batch(conn, args.files, args.window)
+        else:
+            interactive(conn)
+    finally:
+        conn.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,96 @@
+'''
+    columnar evaluation of where over scanned rows
+
+    With columnar on, the full scans of a session decode the row documents
+    in batches into one NumPy array per filtered column, typed from the
+    schema, and check the conditions as vectorized masks; only the rows
+    passing all of them are reconstructed. Rows come out batch by batch.
+
+    Engines return rows as documents, so every value still passes through
+    Python once to reach an array; that decoding, and the scan itself,
+    bound what the masks can save.
+
+    NumPy is optional, without it scans filter row by row.
+'''
+from itertools import islice
+from operator import itemgetter
+from parser import Range
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+BATCH = 4096  # rows decoded into arrays at once
+
+# array types by column type, other columns are arrays of objects; dates
+# are compared as objects, converting them costs more than it saves
+DTYPES = {'int': 'int64', 'bit': 'int64', 'float': 'float64'}
+
+
+def available() -> bool:
+    return numpy is not None
+
+
+def values(tab, name, docs, rows):
+    '''
+        iterates the values of a column in row documents, rows being the
+        value lists of docs
+    '''
+    col = tab.cols[name]
+    if col in tab.values:
+        return map(itemgetter(tab.values.index(col)), rows)
+    if len(tab.keys) == 1:
+        return map(itemgetter('_id'), docs)
+    return (doc['_id'][name] for doc in docs)
+
+
+def array(tab, name, docs, rows):
+    '''
+        the values of a column decoded straight into an array of the
+        length of the batch, with no list in between
+    '''
+    dtype = DTYPES.get(tab.cols[name]['type'])
+    if dtype is not None:
+        try:
+            return numpy.fromiter(values(tab, name, docs, rows), dtype, count=len(docs))
+        except (OverflowError, ValueError):
+            # ints too large for int64
+            pass
+    return numpy.fromiter(values(tab, name, docs, rows), object, count=len(docs))
+
+
+def mask(arr, cond):
+    '''
+        which values of an array satisfy a typed condition
+    '''
+    if not isinstance(cond, Range):
+        return arr == cond
+    res = numpy.ones(len(arr), dtype=bool)
+    if cond.lo is not None:
+        res &= arr >= cond.lo if cond.lo_incl else arr > cond.lo
+    if cond.hi is not None:
+        res &= arr <= cond.hi if cond.hi_incl else arr < cond.hi
+    return res
+
+
+def scan(tab, docs, where, check):
+    '''
+        yields the reconstructed rows of row documents matching the typed
+        conditions of where; check is the row filter of where, for rows
+        stored as '#'-joined strings
+    '''
+    docs = iter(docs)
+    while batch := list(islice(docs, BATCH)):
+        if any('v' not in doc for doc in batch):
+            yield from filter(check, map(tab.reconstruct, batch))
+            continue
+
+        rows = [doc['v'] for doc in batch]
+        selected = numpy.ones(len(batch), dtype=bool)
+        for name, cond in where.items():
+            selected &= mask(array(tab, name, batch, rows), cond)
+            if not selected.any():
+                break
+        for i in numpy.flatnonzero(selected).tolist():
+            yield tab.reconstruct(batch[i])
@@ -15,6 +15,8 @@ class Error(IntEnum):
     DUPLICATE_UNIQUE = auto()
     FOREIGN_KEY_CONSTRAINT = auto()
     AMBIGUOUS_REFERENCE = auto()
+    TOO_MANY_CONNECTIONS = auto()
+    DATABASE_IN_USE = auto()
 
 
 class ServerError(Exception):
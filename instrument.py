@@ -0,0 +1,244 @@
+'''
+    where the time of a command goes
+
+    Every command gets a Profile, found through current_profile while it
+    runs. InstrumentedEngine counts the round trips made to the engine and
+    times them by phase: query (rows), index and write. The server times
+    catalog lookups and planning the same way. With profile on, a session
+    also has the rows of its commands timed as they are reconstructed,
+    filtered and sent, which costs a little per row.
+
+    Metrics keeps the latencies of the latest commands of each type for
+    the stats command. Commands slower than a threshold are written to a
+    slow log, and a sample of commands can be run under cProfile, their
+    profile saved when they turn out slow.
+'''
+import contextvars
+import cProfile
+import datetime
+import json
+import os
+import threading
+from collections import deque
+from time import perf_counter
+
+SLOW_MS = float(os.getenv('PYTHONDB_SLOW_MS', '250'))  # commands logged as slow, 0 disables the log
+PROFILE_SAMPLE = float(os.getenv('PYTHONDB_PROFILE_SAMPLE', '0'))  # share of commands run under cProfile
+SLOW_LOG = 'slow.log'  # in the server directory
+PROFILE_DIR = 'profiles'  # in the server directory, cProfile dumps of slow commands
+HISTORY = 1000  # latest commands of each type kept for stats
+BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+# engine methods by phase, each call is one round trip
+PHASES = {
+    'get': 'query', 'multi_get': 'query', 'scan': 'query', 'match_keys': 'query', 'count': 'query',
+    'aggregate': 'query',
+    'index_get': 'index', 'index_range': 'index', 'index_bounds': 'index', 'index_count': 'index',
+    'refs_keys': 'index', 'refs_count': 'index',
+    'put': 'write', 'put_many': 'write', 'replace_many': 'write', 'delete': 'write', 'drop': 'write',
+    'index_insert': 'write', 'index_delete': 'write', 'index_push': 'write', 'index_add': 'write',
+    'index_pull': 'write', 'index_purge': 'write', 'drop_index': 'write', 'drop_database': 'write', 'sync': 'write',
+    'refs_add': 'write', 'refs_remove': 'write', 'refs_purge': 'write', 'refs_convert': 'write',
+}
+LAZY = {'multi_get', 'scan', 'index_range', 'refs_keys'}  # return rows as they are read
+
+# profile of the command being run
+current_profile = contextvars.ContextVar('profile', default=None)
+
+
+class Profile:
+
+    def __init__(self, detailed=False):
+        self.detailed = detailed  # time every row, not only every round trip
+        self.phases = {}  # phase -> seconds
+        self.round_trips = 0
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0) + seconds
+
+    def breakdown(self) -> dict:
+        return {phase: round(seconds * 1000, 3) for phase, seconds in self.phases.items()}
+
+    def describe(self, elapsed) -> str:
+        phases = ' '.join(f'{phase}={ms}ms' for phase, ms in self.breakdown().items())
+        return f'total={elapsed * 1000:.3f}ms round_trips={self.round_trips} {phases}'.rstrip()
+
+
+class phase:
+    '''
+        times a block into the profile of the command
+    '''
+    __slots__ = ('name', 'profile', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.profile = current_profile.get()
+        self.start = perf_counter()
+
+    def __exit__(self, *exc):
+        if self.profile is not None:
+            self.profile.add(self.name, perf_counter() - self.start)
+
+
+def timed(name, func):
+    '''
+        func timed into the profile of the command, if that is detailed
+    '''
+    profile = current_profile.get()
+    if profile is None or not profile.detailed:
+        return func
+
+    def call(*args):
+        start = perf_counter()
+        try:
+            return func(*args)
+        finally:
+            profile.add(name, perf_counter() - start)
+    return call
+
+
+def timed_iter(name, iterable, profile):
+    it = iter(iterable)
+    while True:
+        start = perf_counter()
+        try:
+            item = next(it)
+        except StopIteration:
+            return
+        finally:
+            profile.add(name, perf_counter() - start)
+        yield item
+
+
+class InstrumentedEngine:
+    '''
+        engine counting and timing the calls made to it
+    '''
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def __getattr__(self, name):
+        attr = getattr(self.engine, name)
+        phase = PHASES.get(name)
+        if phase is None:
+            return attr
+
+        def call(*args, **kwargs):
+            profile = current_profile.get()
+            if profile is None:
+                return attr(*args, **kwargs)
+            profile.round_trips += 1
+            start = perf_counter()
+            try:
+                res = attr(*args, **kwargs)
+            finally:
+                profile.add(phase, perf_counter() - start)
+            # rows may be fetched only as they are read
+            if name in LAZY and profile.detailed:
+                res = timed_iter(phase, res, profile)
+            return res
+        return call
+
+
+def percentile(latencies, p):
+    return latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))]
+
+
+class Metrics:
+    '''
+        latencies of the latest commands of each type
+    '''
+
+    def __init__(self, history=HISTORY):
+        self.history = history
+        self.lock = threading.Lock()
+        self.latest = {}  # command type -> deque of (ms, round trips)
+        self.counts = {}  # command type -> commands run
+
+    def record(self, kind, ms, round_trips):
+        with self.lock:
+            if kind not in self.latest:
+                self.latest[kind] = deque(maxlen=self.history)
+                self.counts[kind] = 0
+            self.latest[kind].append((ms, round_trips))
+            self.counts[kind] += 1
+
+    def rows(self) -> list:
+        with self.lock:
+            latest = {kind: list(samples) for kind, samples in self.latest.items()}
+            counts = dict(self.counts)
+
+        rows = []
+        for kind in sorted(latest):
+            ms = sorted(sample[0] for sample in latest[kind])
+            histogram = {}
+            for val in ms:
+                bucket = next((f'<={b}ms' for b in BUCKETS_MS if val <= b), f'>{BUCKETS_MS[-1]}ms')
+                histogram[bucket] = histogram.get(bucket, 0) + 1
+            rows.append({
+                'name': 'command',
+                'command': kind,
+                'count': counts[kind],
+                'window': len(ms),
+                'p50_ms': round(percentile(ms, 50), 3),
+                'p95_ms': round(percentile(ms, 95), 3),
+                'p99_ms': round(percentile(ms, 99), 3),
+                'max_ms': round(ms[-1], 3),
+                'round_trips': round(sum(sample[1] for sample in latest[kind]) / len(ms), 2),
+                'histogram': histogram,
+            })
+        return rows
+
+
+class SlowLog:
+    '''
+        json lines describing commands slower than threshold_ms
+    '''
+
+    def __init__(self, server_dir, threshold_ms=SLOW_MS):
+        self.path = os.path.join(server_dir, SLOW_LOG)
+        self.profile_dir = os.path.join(server_dir, PROFILE_DIR)
+        self.threshold_ms = threshold_ms
+        self.lock = threading.Lock()
+
+    def is_slow(self, ms) -> bool:
+        return 0 < self.threshold_ms <= ms
+
+    def dump(self, profiler, kind) -> str:
+        '''
+            saves the cProfile stats of a slow command, returns their path
+        '''
+        os.makedirs(self.profile_dir, exist_ok=True)
+        stamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        path = os.path.join(self.profile_dir, f'{stamp}-{kind}.prof')
+        profiler.dump_stats(path)
+        return path
+
+    def write(self, command, database, ms, profile, dump=None):
+        entry = {
+            'time': datetime.datetime.now().isoformat(timespec='milliseconds'),
+            'database': database,
+            'command': command[:1000],
+            'ms': round(ms, 3),
+            'round_trips': profile.round_trips,
+            'phases': profile.breakdown(),
+        }
+        if dump is not None:
+            entry['profile'] = dump
+        with self.lock, open(self.path, 'a') as f:
+            f.write(json.dumps(entry) + '\n')
+
+
+def start_profiler() -> cProfile.Profile | None:
+    '''
+        a running cProfile, or None if another one is already running
+    '''
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        return None
+    return profiler
@@ -0,0 +1,149 @@
+'''
+    reading and type checking the rows of CSV and JSONL files for load
+
+    Files are cut into chunks of whole records in the loading process and
+    parsed by parse_chunk in a process pool. A CSV file may start with a
+    header naming every column, in any order; without one, fields are in
+    column order. A JSONL line is an array of values in column order or an
+    object keyed by column name.
+'''
+import csv
+import json
+import os
+import sys
+import time
+import parser
+from error import Error
+from functools import lru_cache
+from catalog import Table
+
+FORMATS = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl'}
+PROGRESS_SECONDS = 1  # between progress lines
+
+
+def file_format(path, format=None) -> str | None:
+    if format is not None:
+        return format if format in FORMATS.values() else None
+    return FORMATS.get(os.path.splitext(path)[1].lower())
+
+
+def read_header(path, names) -> list | None:
+    '''
+        positions of the columns in the fields of a CSV file, None if its
+        first line is not a header naming every column
+    '''
+    with open(path, newline='') as f:
+        fields = next(csv.reader([f.readline()]), [])
+    if sorted(fields) != sorted(names):
+        return None
+    return [fields.index(name) for name in names]
+
+
+def chunks(path, format, size, skip=0):
+    '''
+        yields (offset, lines) of up to size records, offset being the
+        number of records before them; quoted CSV fields may span lines
+    '''
+    offset = 0
+    lines = []
+    record = ''
+    with open(path, newline='') as f:
+        for line in f:
+            if format == 'csv':
+                record += line
+                if record.count('"') % 2 != 0:
+                    continue
+                line, record = record, ''
+            if skip > 0:
+                skip -= 1
+                continue
+            if len(line.strip()) == 0:
+                continue
+            lines.append(line)
+            if len(lines) == size:
+                yield offset, lines
+                offset += len(lines)
+                lines = []
+    if len(lines) != 0:
+        yield offset, lines
+
+
+@lru_cache(maxsize=16)
+def table(name, columns) -> Table:
+    return Table(name, json.loads(columns))
+
+
+def text(value) -> str:
+    return value if isinstance(value, str) else json.dumps(value)
+
+
+def parse_chunk(name, columns, format, order, offset, lines):
+    '''
+        returns (valid, errors) of the records of a chunk: valid as
+        [(row number, values, document, comparable values)] with values
+        as text, in column order, errors as (row number, code, message)
+
+        columns is the json of the column definitions, order the positions
+        of the columns in the fields of a CSV record, if not the same
+    '''
+    tab = table(name, columns)
+    names = [col['name'] for col in tab.columns]
+    if format == 'csv':
+        records = csv.reader(lines)
+    else:
+        records = map(str.rstrip, lines)
+
+    valid = []
+    errors = []
+    for i, record in enumerate(records, offset):
+        if format == 'jsonl':
+            try:
+                record = json.loads(record)
+            except json.decoder.JSONDecodeError as e:
+                errors.append((i, Error.INVALID_JSON, str(e)))
+                continue
+            if isinstance(record, dict):
+                if sorted(record) != sorted(names):
+                    errors.append((i, Error.INVALID_NUMBER_OF_FIELDS, ''))
+                    continue
+                record = [record[name] for name in names]
+            elif not isinstance(record, list):
+                errors.append((i, Error.INVALID_JSON, 'not an array or object'))
+                continue
+            values = list(map(text, record))
+        elif order is not None and len(record) == len(order):
+            values = [record[j] for j in order]
+        else:
+            values = record
+
+        if len(values) != len(tab.columns):
+            errors.append((i, Error.INVALID_NUMBER_OF_FIELDS, ''))
+        elif not all(map(lambda cv: parser.parser_input(cv[1], cv[0]['type']), zip(tab.columns, values))):
+            errors.append((i, Error.INVALID_TYPE, ''))
+        else:
+            typed = tab.typed(values)
+            valid.append((i, values, tab.encode(typed), typed))
+    return valid, errors
+
+
+class Progress:
+    '''
+        prints the rows loaded so far and the rate, at most once per interval
+    '''
+
+    def __init__(self, out=sys.stderr, interval=PROGRESS_SECONDS):
+        self.out = out
+        self.interval = interval
+        self.start = time.perf_counter()
+        self.printed = self.start
+
+    def line(self, inserted, rejected) -> str:
+        elapsed = time.perf_counter() - self.start
+        rate = inserted / elapsed if elapsed > 0 else 0
+        return f'{inserted} inserted, {rejected} rejected, {elapsed:.1f}s, {rate:.0f} rows/s'
+
+    def __call__(self, inserted, rejected):
+        now = time.perf_counter()
+        if now - self.printed >= self.interval:
+            self.printed = now
+            print(self.line(inserted, rejected), file=self.out, flush=True)
@@ -24,3 +24,99 @@ def parser_input(input, type_input):
     except ValueError:
         return False
     return False
+
+
+def parse_value(input, type_input):
+    '''
+        returns the value of a valid input in its comparable form:
+        int for int and bit, float, str, datetime for date and datetime
+    '''
+    match type_input:
+        case 'int' | 'bit':
+            return int(input)
+        case 'float':
+            return float(input)
+        case 'date':
+            return datetime.datetime.strptime(input, '%Y-%m-%d')
+        case 'datetime':
+            return datetime.datetime.strptime(input, '%Y-%m-%d-%H:%M:%S')
+    return str(input)
+
+
+def format_value(value, type_input):
+    '''
+        inverse of parse_value, every value has exactly one text form
+    '''
+    match type_input:
+        case 'date':
+            return value.strftime('%Y-%m-%d')
+        case 'datetime':
+            return value.strftime('%Y-%m-%d-%H:%M:%S')
+    return str(value)
+
+
+class Range:
+    '''
+        interval of values, a bound is None when that side is open
+    '''
+
+    def __init__(self, lo=None, hi=None, lo_incl=True, hi_incl=True):
+        self.lo = lo
+        self.hi = hi
+        self.lo_incl = lo_incl
+        self.hi_incl = hi_incl
+
+    def __contains__(self, value):
+        if self.lo is not None and (value < self.lo or value == self.lo and not self.lo_incl):
+            return False
+        if self.hi is not None and (value > self.hi or value == self.hi and not self.hi_incl):
+            return False
+        return True
+
+    def __and__(self, other):
+        lo, lo_incl = self.lo, self.lo_incl
+        if other.lo is not None and (lo is None or other.lo > lo):
+            lo, lo_incl = other.lo, other.lo_incl
+        elif other.lo is not None and other.lo == lo:
+            lo_incl = lo_incl and other.lo_incl
+
+        hi, hi_incl = self.hi, self.hi_incl
+        if other.hi is not None and (hi is None or other.hi < hi):
+            hi, hi_incl = other.hi, other.hi_incl
+        elif other.hi is not None and other.hi == hi:
+            hi_incl = hi_incl and other.hi_incl
+        return Range(lo, hi, lo_incl, hi_incl)
+
+    def map(self, func):
+        '''
+            the same range with func applied to its bounds
+        '''
+        return Range(None if self.lo is None else func(self.lo),
+                     None if self.hi is None else func(self.hi),
+                     self.lo_incl, self.hi_incl)
+
+    def describe(self, name):
+        text = name
+        if self.lo is not None:
+            text = f'{self.lo}{"<=" if self.lo_incl else "<"}{text}'
+        if self.hi is not None:
+            text = f'{text}{"<=" if self.hi_incl else "<"}{self.hi}'
+        return text
+
+    def __repr__(self):
+        return self.describe('_')
+
+
+def intersect(a, b):
+    '''
+        condition allowing only what both a and b allow,
+        conditions are single values or ranges
+    '''
+    if isinstance(a, Range) and isinstance(b, Range):
+        return a & b
+    if isinstance(a, Range):
+        a, b = b, a
+    if a in (b if isinstance(b, Range) else Range(b, b)):
+        return a
+    # nothing matches
+    return Range(a, a, False, False)
@@ -0,0 +1,307 @@
+'''
+    access path selection for select
+
+    Statistics are cheap per-index counts kept per table and refreshed once
+    enough rows changed since they were taken. The planner uses them to
+    pick the most selective indexes, skip probes that would not narrow the
+    result, and choose between index lookups and a collection scan.
+
+    Ranges are estimated by interpolating between the smallest and largest
+    indexed value of numbers and dates, strings get RANGE_SELECTIVITY.
+
+    A compound index with equality on every one of its columns makes one
+    probe for all of them, and when it covers the selected and filtered
+    columns the rows are read from it alone.
+'''
+import copy
+import datetime
+from parser import Range
+
+SCAN_RATIO = 0.3  # index lookups expected to return more than this share of a table lose to a scan
+PROBE_ROWS = 16  # with at most this many candidates, filtering is cheaper than another index probe
+FILTER_SELECTIVITY = 0.1  # assumed share of rows passing a predicate no index can answer
+STALE_RATIO = 0.1  # share of rows that may change before statistics are taken again
+RANGE_SELECTIVITY = 1 / 3  # assumed share of rows in a range that cannot be interpolated
+
+
+class Probe:
+    '''
+        lookup of value in the index of col, or in the compound index
+        named col for the compound role; columns are those it answers
+    '''
+
+    def __init__(self, col, role, value, estimate, columns=None):
+        self.col = col
+        self.role = role
+        self.value = value
+        self.estimate = estimate
+        self.columns = [col] if columns is None else columns
+
+    def bind(self, tab, where) -> 'Probe':
+        '''
+            the same lookup for the value of its columns in where
+        '''
+        value = tab.indexes[self.col].value(where) if self.role == 'compound' else where[self.col]
+        return Probe(self.col, self.role, value, self.estimate, self.columns)
+
+    def __repr__(self):
+        if self.role == 'compound':
+            values = ','.join(f'{name}={val}' for name, val in self.value.items())
+            return f'compound {self.col}({values}) (est {self.estimate:.3g})'
+        if isinstance(self.value, Range):
+            return f'{self.role} {self.value.describe(self.col)} (est {self.estimate:.3g})'
+        return f'{self.role} {self.col}={self.value} (est {self.estimate:.3g})'
+
+
+class Plan:
+    '''
+        access path for one table
+
+        key:      complete primary key to fetch, if any
+        probes:   index lookups to intersect, most selective first
+        skipped:  indexed columns not worth probing, checked as filters
+        filters:  columns checked on the fetched rows
+        covering: compound index the rows are read from, if any
+        rows:     table size the estimates are based on
+        estimate: expected number of result rows
+    '''
+
+    def __init__(self, table, rows):
+        self.table = table
+        self.rows = rows
+        self.key = None
+        self.probes = []
+        self.skipped = []
+        self.filters = []
+        self.covering = None
+        self.estimate = rows
+
+    @property
+    def access(self):
+        if self.key is not None:
+            return 'key'
+        if len(self.probes) != 0:
+            return 'index'
+        return 'scan'
+
+    def bind(self, tab, where) -> 'Plan':
+        '''
+            the same access path for other values of the conditions it was
+            made for, with the estimates made for the first ones
+        '''
+        plan = copy.copy(self)
+        if self.key is not None:
+            plan.key = tab.make_key([where[col['name']] for col in tab.keys])
+        plan.probes = [probe.bind(tab, where) for probe in self.probes]
+        return plan
+
+    def describe(self):
+        match self.access:
+            case 'key':
+                steps = [f'key {self.key}']
+            case 'index':
+                steps = [repr(probe) for probe in self.probes]
+            case _:
+                steps = ['scan']
+        if len(self.skipped) != 0:
+            steps.append(f'skip index {",".join(self.skipped)}')
+        if len(self.filters) != 0:
+            steps.append(f'filter {",".join(self.filters)}')
+        if self.covering is not None:
+            steps.append(f'covering {self.covering}')
+        return f'{self.table}: {" -> ".join(steps)} (est {self.estimate:.3g} of {self.rows} rows)'
+
+
+class Statistics:
+    '''
+        row counts and distinct index values per table of the current database
+    '''
+
+    def __init__(self, server):
+        self.server = server
+        self.tables = {}  # (database, table) -> {'rows': .., 'changes': .., col: distinct}
+
+    def __entry(self, table):
+        name = (self.server.database[0], table)
+        entry = self.tables.get(name)
+        if entry is None or entry['changes'] > STALE_RATIO * entry['rows'] + PROBE_ROWS:
+            entry = {'rows': self.server.engine.count(table), 'changes': 0}
+            self.tables[name] = entry
+        return entry
+
+    def rows(self, table):
+        return self.__entry(table)['rows']
+
+    def current(self, table) -> dict:
+        '''
+            the statistics of a table plans are made with now, a new
+            dict each time they are taken again
+        '''
+        return self.__entry(table)
+
+    def distinct(self, tab, col):
+        '''
+            number of distinct values stored in the index of a column
+        '''
+        entry = self.__entry(tab.name)
+        distinct = entry.get(col['name'])
+        if distinct is not None:
+            return distinct
+
+        engine = self.server.engine
+        match col['role']:
+            case 'unique':
+                distinct = entry['rows']
+            case 'index':
+                distinct = engine.index_count(f'{tab.name}_nq', col['name'], 'keys')
+            case 'foreign-key':
+                ref_tab, ref_col = col['reference'].split('.')
+                distinct = engine.refs_count(f'{ref_tab}_fk', ref_col, tab.name)
+        entry[col['name']] = distinct
+        return distinct
+
+    def entries(self, tab, index):
+        '''
+            number of distinct values stored in a compound index
+        '''
+        entry = self.__entry(tab.name)
+        name = ('compound', index.name)
+        if name not in entry:
+            entry[name] = self.server.engine.index_count(index.collection, index.name, 'rows')
+        return entry[name]
+
+    def bounds(self, tab, col):
+        '''
+            (smallest, largest) value stored in the index of a column, or None
+        '''
+        entry = self.__entry(tab.name)
+        name = ('bounds', col['name'])
+        if name not in entry:
+            index = f'{tab.name}_uq' if col['role'] == 'unique' else f'{tab.name}_nq'
+            entry[name] = self.server.engine.index_bounds(index, col['name'])
+        return entry[name]
+
+    def touch(self, table, changes=1):
+        entry = self.tables.get((self.server.database[0], table))
+        if entry is not None:
+            entry['changes'] += changes
+
+    def invalidate(self, table=None):
+        if table is None:
+            self.tables = {}
+        else:
+            self.tables.pop((self.server.database[0], table), None)
+
+
+class Planner:
+
+    def __init__(self, server):
+        self.stats = Statistics(server)
+
+    def estimate(self, tab, col):
+        '''
+            expected rows matching one value of an indexed column
+        '''
+        rows = self.stats.rows(tab.name)
+        if col['role'] == 'unique':
+            return min(1, rows)
+        distinct = self.stats.distinct(tab, col)
+        if distinct == 0:
+            return 0
+        return rows / distinct
+
+    def compound_estimate(self, tab, index):
+        '''
+            expected rows matching one value of a compound index
+        '''
+        entries = self.stats.entries(tab, index)
+        if entries == 0:
+            return 0
+        return self.stats.rows(tab.name) / entries
+
+    def range_estimate(self, tab, col, rng):
+        '''
+            expected rows with a value in rng, for unique and index columns
+        '''
+        rows = self.stats.rows(tab.name)
+        bounds = self.stats.bounds(tab, col)
+        if bounds is None:
+            return 0
+        low, high = bounds
+        if not isinstance(low, (int, float, datetime.datetime)):
+            return rows * RANGE_SELECTIVITY
+        if low == high:
+            return rows if low in rng else 0
+
+        def span(a, b):
+            diff = b - a
+            return diff.total_seconds() if isinstance(diff, datetime.timedelta) else diff
+
+        lo = low if rng.lo is None else max(low, rng.lo)
+        hi = high if rng.hi is None else min(high, rng.hi)
+        if lo > hi:
+            return 0
+        return rows * span(lo, hi) / span(low, high)
+
+    def plan(self, tab, where, columns=None) -> Plan:
+        '''
+            columns are those read from the rows, all of them if None
+        '''
+        plan = Plan(tab.name, self.stats.rows(tab.name))
+        key_cols = [col['name'] for col in tab.keys]
+
+        # a complete primary key beats any index
+        if len(key_cols) != 0 and all(name in where and not isinstance(where[name], Range) for name in key_cols):
+            plan.key = tab.make_key([where[name] for name in key_cols])
+            plan.filters = [name for name in where if name not in key_cols]
+            plan.estimate = min(1, plan.rows)
+            return plan
+
+        # the compound index answering equality on the most columns
+        probes = []
+        compound = None
+        for index in tab.ready.values():
+            if all(name in where and not isinstance(where[name], Range) for name in index.columns):
+                if compound is None or len(index.columns) > len(compound.columns):
+                    compound = index
+        answered = set()
+        if compound is not None:
+            probes.append(Probe(compound.name, 'compound', compound.value(where),
+                                self.compound_estimate(tab, compound), compound.columns))
+            answered = set(compound.columns)
+
+        for name, val in where.items():
+            if name in answered:
+                continue
+            col = tab.cols[name]
+            if isinstance(val, Range) and col['role'] in ('unique', 'index'):
+                probes.append(Probe(name, col['role'], val, self.range_estimate(tab, col, val)))
+            elif not isinstance(val, Range) and col['role'] in ('unique', 'index', 'foreign-key'):
+                probes.append(Probe(name, col['role'], val, self.estimate(tab, col)))
+            else:
+                plan.filters.append(name)
+        probes.sort(key=lambda probe: probe.estimate)
+
+        # every probe assumed independent of the others
+        estimate = plan.rows
+        for probe in probes:
+            if len(plan.probes) == 0 and probe.estimate > SCAN_RATIO * plan.rows:
+                # most of the table matches anyway, scanning is cheaper
+                plan.skipped.append(probe.col)
+            elif len(plan.probes) != 0 and estimate <= PROBE_ROWS:
+                # few enough candidates left, filter instead of probing
+                plan.skipped.append(probe.col)
+            else:
+                plan.probes.append(probe)
+                estimate = estimate * probe.estimate / plan.rows if plan.rows else 0
+                continue
+            plan.filters.extend(probe.columns)
+
+        plan.estimate = estimate * FILTER_SELECTIVITY ** (len(plan.filters))
+
+        # one compound probe covering every column read needs no rows
+        if columns is not None and len(plan.probes) == 1 and plan.probes[0].role == 'compound':
+            index = tab.indexes[plan.probes[0].col]
+            if index.covered >= set(columns) | set(plan.filters):
+                plan.covering = index.name
+        return plan
@@ -0,0 +1,140 @@
+'''
+    framed request/response protocol spoken over Server.listen
+
+    request:       @ID COMMAND
+    result row:    @ID = ROW
+    result header: @ID # COLUMNS
+    result batch:  @ID * ENCODING COMPRESSION BYTES, then BYTES bytes
+    response:      @ID STATUS ROWS MESSAGE
+
+    ID is chosen by the client and echoed on every line of the response, so
+    a client may send many requests before reading any reply; responses
+    come back in request order. ROW is a json object, STATUS the name of an
+    error code and ROWS the number of rows sent before it.
+
+    After format binary, rows come in batches instead: a header, the json
+    list of the column names, is sent before the first batch and whenever
+    the columns change, and every batch is a list of rows, each the list
+    of its values in header order. ENCODING is msgpack, or json when
+    msgpack is not installed or cannot encode a value, COMPRESSION is zlib,
+    lz4 or - for batches sent as they are.
+
+    Lines not starting with '@' are answered the way older clients expect:
+    rows as python dicts, then '[STATUS] MESSAGE'.
+'''
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+BATCH_ROWS = 1024  # rows sent in one binary batch
+COMPRESS_BYTES = 4096  # smaller batches are not worth compressing
+
+
+def encode_request(rid, command) -> str:
+    return f'@{rid} {command}\n'
+
+
+def decode_request(line) -> (int | None, str):
+    '''
+        returns (id, command), id is None for unframed lines
+    '''
+    if not line.startswith('@'):
+        return None, line
+    rid, _, command = line[1:].partition(' ')
+    if not rid.isdigit():
+        return None, line
+    return int(rid), command.strip()
+
+
+def encode_row(rid, row) -> str:
+    if rid is None:
+        return f'{row}\n'
+    return f'@{rid} = {json.dumps(row, default=str)}\n'
+
+
+def encode_status(rid, status, rows, message) -> str:
+    if rid is None:
+        return f'[{status}] {message}\n'
+    return f'@{rid} {status} {rows} {message}\n'
+
+
+def encoding() -> str:
+    '''
+        encoding of binary batches, when every value fits it
+    '''
+    return 'json' if msgpack is None else 'msgpack'
+
+
+def compressions() -> list:
+    return ['zlib'] if lz4 is None else ['zlib', 'lz4']
+
+
+def encode_header(rid, columns) -> bytes:
+    return f'@{rid} # {json.dumps(columns)}\n'.encode()
+
+
+def packable(value):
+    if isinstance(value, int):
+        # ints beyond 64 bits, sent as json instead
+        raise OverflowError(value)
+    return str(value)
+
+
+def encode_batch(rid, rows, compression=None) -> bytes:
+    '''
+        rows as lists of values, compressed when that makes them smaller
+    '''
+    encoding = 'json'
+    data = None
+    if msgpack is not None:
+        try:
+            data = msgpack.packb(rows, default=packable)
+            encoding = 'msgpack'
+        except OverflowError:
+            pass
+    if data is None:
+        data = json.dumps(rows, default=str).encode()
+
+    method = '-'
+    if compression is not None and len(data) >= COMPRESS_BYTES:
+        packed = zlib.compress(data, 1) if compression == 'zlib' else lz4.frame.compress(data)
+        if len(packed) < len(data):
+            method, data = compression, packed
+    return f'@{rid} * {encoding} {method} {len(data)}\n'.encode() + data
+
+
+def decode_batch(encoding, compression, data) -> list:
+    match compression:
+        case 'zlib':
+            data = zlib.decompress(data)
+        case 'lz4':
+            data = lz4.frame.decompress(data)
+    if encoding == 'msgpack':
+        return msgpack.unpackb(data)
+    return json.loads(data)
+
+
+def decode_response(line) -> (int, str, dict | list | tuple):
+    '''
+        returns (id, '=', row) for result rows, (id, '#', columns) for
+        result headers, (id, '*', (encoding, compression, bytes)) for the
+        line before a result batch and (id, STATUS, (rows, message)) for
+        the end of a response
+    '''
+    rid, kind, rest = line[1:].rstrip('\n').split(' ', 2)
+    if kind in ('=', '#'):
+        return int(rid), kind, json.loads(rest)
+    if kind == '*':
+        encoding, compression, size = rest.split(' ')
+        return int(rid), kind, (encoding, compression, int(size))
+    rows, _, message = rest.partition(' ')
+    return int(rid), kind, (int(rows), message)
@@ -1,26 +1,217 @@
+import argparse
+import asyncio
+import columnar
+import contextvars
 import json
+import loader
 import os
 import sys
+import threading
 import shutil
-import socket
 import parser
+import random
+import re
 from sys import stdin, stdout, stderr
 from error import Error, ServerError
-from itertools import chain
-from pymongo import MongoClient
-import pymongo
+from catalog import Catalog, Index, IndexBuild, Table
+from planner import Planner, PROBE_ROWS
+from parser import Range
+from session import Session, Statement, Transaction, current_session
+from protocol import (BATCH_ROWS, compressions, decode_request, encode_batch, encode_header, encode_row,
+                      encode_status, encoding)
+from wal import WAL_FILE, WriteAheadLog
+from cache import CACHE_BYTES, CachedEngine, LRUCache
+from bloom import Filters
+from instrument import (PROFILE_SAMPLE, SLOW_MS, InstrumentedEngine, Metrics, Profile, SlowLog,
+                        current_profile, phase, start_profiler, timed)
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import chain, islice
+from time import perf_counter
+from storage import ENGINES, DEFAULT_ENGINE, ENGINE_FILE, Engine, connect_mongo, hashable, open_engine
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+MAX_CURSORS = 64  # open select cursors kept for paging
+MAX_LINE = 2 ** 24  # longest command accepted from a client, in bytes
+SEND_CHUNK = 2 ** 16  # result bytes collected before writing them to a client
+SEND_QUEUE = 64  # chunks waiting for a slow client before its command is paused
+FLUSH_LINES = 256  # responses buffered by run before flushing its output
+WAL = os.getenv('PYTHONDB_WAL', 'on') != 'off'  # log changes ahead of the engine
+LOAD_WRITERS = 4  # threads writing the batches of load_file
+BUILD_WRITERS = 4  # threads writing the entries of an index build
+DRAIN_SECONDS = 60  # longest an index build waits for the writes under way when it starts
+LOCK_FILE = 'lock'  # locked by the process using a database, inside its directory
+FORMAT_FILE = 'typed'  # written once the rows of a database and their index entries are typed
+LOAD_ERRORS = 10  # rejected rows listed in the reply of load
+
+COMPARISON = re.compile(r'^([^<>=]+)(<=|>=|<|>|=)(.*)$')
+AGGREGATE = re.compile(r'^(count|sum|min|max|avg)\((.+)\)$')
+PARAM = '\0'  # starts the marker of a parameter of a prepared select, followed by its number
+
+
+def lock_database(path):
+    '''
+        returns the lock file of a database, locked for this process, or
+        None where files cannot be locked
+
+        Caches, Bloom filters and the write-ahead log assume that a
+        database is written by one process alone.
+    '''
+    if fcntl is None:
+        return None
+    f = open(os.path.join(path, LOCK_FILE), 'a')
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        f.close()
+        raise ServerError(Error.DATABASE_IN_USE, 'database: open in another process')
+    return f
+
+
+def batched(iterable, size):
+    it = iter(iterable)
+    while batch := list(islice(it, size)):
+        yield batch
+
+
+def parameters(words) -> (list, int):
+    '''
+        returns (words, count) of a where clause with markers in place of
+        each ? standing for a value, numbered in order of appearance
+    '''
+    res = []
+    count = 0
+    for prev, word in zip([None, *words], words):
+        comparison = COMPARISON.match(word)
+        if word == '?' and prev not in ('limit', 'offset', 'page') or \
+                comparison is not None and comparison.group(3) == '?':
+            word = f'{word[:-1]}{PARAM}{count}'
+            count += 1
+        res.append(word)
+    return res, count
+
+
+def bind(cond, values):
+    '''
+        a where condition with the values in place of its parameter markers
+    '''
+    if isinstance(cond, list):
+        return [bind(c, values) for c in cond]
+    if isinstance(cond, Range):
+        return cond.map(lambda c: bind(c, values))
+    if cond.startswith(PARAM):
+        return values[int(cond[len(PARAM):])]
+    return cond
+
+
+def is_aggregate(columns, options) -> bool:
+    return 'group' in options or any(AGGREGATE.match(col) for col in columns)
+
+
+def fold(func, acc, val):
+    '''
+        accumulator of an aggregate after one more value, acc is None before the first
+    '''
+    if acc is None:
+        return 1 if func == 'count' else (val, 1) if func == 'avg' else val
+    match func:
+        case 'count':
+            return acc + 1
+        case 'sum':
+            return acc + val
+        case 'min':
+            return min(acc, val)
+        case 'max':
+            return max(acc, val)
+        case 'avg':
+            return acc[0] + val, acc[1] + 1
+
+
+def finish(func, acc):
+    if func == 'count':
+        return 0 if acc is None else acc
+    if func == 'avg' and acc is not None:
+        return acc[0] / acc[1]
+    return acc
 
 
 class Server:
 
-    def __init__(self, server_dir):
+    def __init__(self, server_dir, batch_size=1000, wal=WAL, cache_bytes=CACHE_BYTES,
+                 slow_ms=SLOW_MS, profile_sample=PROFILE_SAMPLE):
         assert os.path.exists(server_dir)
 
         self.server_dir = server_dir
-        self.database = None
-        self.db = None  # holds current mongo database
-        self.idb = None  # holds index cluster associated with current db
-        self.mongo = MongoClient(os.getenv('MONGO_HOST'))
+        self.lock = threading.RLock()  # guards catalogs, engines, logs and the mongo client
+        self.batch_size = batch_size  # rows per round trip in bulk operations
+        self.wal_enabled = wal
+        self.cache_bytes = cache_bytes  # row and index cache budget per database
+        self.metrics = Metrics()  # latencies by command type
+        self.slow_log = SlowLog(server_dir, slow_ms)
+        self.profile_sample = profile_sample  # share of commands run under cProfile
+        self.default_session = Session()
+        self.catalogs = {}  # database name -> table definitions, shared by sessions
+        self.engines = {}  # database name -> storage engine, shared by sessions
+        self.logs = {}  # database name -> write-ahead log, shared by sessions
+        self.filters = {}  # database name -> bloom filters of unique columns, shared by sessions
+        self.writers = {}  # database name -> lock held from the checks of a change through its writes
+        self.locks = {}  # database name -> its lock file, held while the server runs
+        self.builds = {}  # (database name, index collection) -> IndexBuild in progress
+        self.planner = Planner(self)
+        self.mongo = None  # connected when a mongo database is first used
+
+    #
+    # SESSION STATE
+    #
+
+    @property
+    def session(self) -> Session:
+        return current_session.get(self.default_session)
+
+    def __live(self) -> Session:
+        '''
+            the current session, no longer in a database dropped by another
+        '''
+        session = self.session
+        if session.catalog is not None and session.catalog.dropped:
+            session.close()
+        return session
+
+    @property
+    def database(self):
+        return self.__live().database
+
+    @property
+    def engine(self) -> Engine:
+        return self.__live().engine
+
+    @property
+    def catalog(self) -> Catalog:
+        return self.__live().catalog
+
+    @property
+    def cursors(self):
+        return self.__live().cursors
+
+    @property
+    def wal(self) -> WriteAheadLog | None:
+        return self.__live().wal
+
+    @property
+    def write_lock(self) -> threading.RLock:
+        return self.writers[self.database[0]]
+
+    @property
+    def bloom(self) -> Filters | None:
+        if self.database is None:
+            return None
+        return self.filters.get(self.database[0])
 
     #
     # UTILITY METHODS
@@ -35,38 +226,23 @@ class Server:
     def check_table(self, table):
         if self.database is None:
             raise ServerError(Error.NO_DATABASE_IN_USE)
-        path = self.tab_path(table)
-        if not os.path.exists(path):
-            raise ServerError(Error.DOES_NOT_EXIST, f"table: {table}")
+        self.catalog.get(table)
 
-    def open_table(self, table, mode):
-        self.check_table(table)
-        path = self.tab_path(table)
-        return open(path, mode)
+    def get_table(self, table) -> Table:
+        if self.database is None:
+            raise ServerError(Error.NO_DATABASE_IN_USE)
+        with phase('catalog'):
+            return self.catalog.get(table)
 
     def read_table(self, table) -> list | Error:
-        table_io = self.open_table(table, 'r')
-        with table_io as f:
-            table_def = f.read()
-        try:
-            data = json.loads(table_def)
-            return data
-        except json.decoder.JSONDecodeError:
-            raise ServerError(Error.INVALID_JSON, f"path: {self.tab_path(table)}")
+        return self.get_table(table).columns
 
     def read_table_dict(self, table) -> dict | Error:
-        tab_def = self.read_table(table)
-        table = {}
-        for col in tab_def:
-            table[col['name']] = col
-        return table
+        return self.get_table(table).cols
 
     def write_table(self, table, table_def) -> None | Error:
-        table_io = self.open_table(table, 'w')
-        with table_io:
-            table_io.write(json.dumps(table_def))
-            data = json.dumps(table_def)
-            return data
+        self.check_table(table)
+        return self.catalog.write(table, table_def)
 
     def is_reference_valid(self, reference):
         try:
@@ -92,369 +268,2033 @@ class Server:
     # INNER DATABASE METHODS
     #
 
-    def create_database(self, database: str):
+    def mongo_client(self):
+        with self.lock:
+            if self.mongo is None:
+                self.mongo = connect_mongo()
+            return self.mongo
+
+    def open_database(self, database) -> (Catalog, Engine, WriteAheadLog | None):
+        '''
+            returns the catalog, engine and log of a database, opening them
+            on first use and replaying what the log holds
+        '''
+        path = self.db_path(database)
+        with self.lock:
+            if database not in self.locks:
+                self.locks[database] = lock_database(path)
+            if database not in self.catalogs:
+                self.catalogs[database] = Catalog(path)
+            if database not in self.engines:
+                # with a log of its own, mongo need not journal every write
+                engine = InstrumentedEngine(open_engine(path, database, self.mongo_client, journal=not self.wal_enabled))
+                if self.cache_bytes > 0:
+                    engine = CachedEngine(engine, LRUCache(self.cache_bytes))
+                self.engines[database] = engine
+                self.__abandon_builds(self.catalogs[database], engine)
+                if not os.path.exists(os.path.join(path, FORMAT_FILE)):
+                    self.__upgrade(self.catalogs[database], engine)
+                    open(os.path.join(path, FORMAT_FILE), 'w').close()
+                for ref_tab in {col['reference'].split('.')[0] for tab in self.catalogs[database].tables.values()
+                                for col in tab.role('foreign-key')}:
+                    engine.refs_convert(f'{ref_tab}_fk')
+            if database not in self.writers:
+                self.writers[database] = threading.RLock()
+            if database not in self.filters:
+                # before replay, which adds to them
+                self.filters[database] = Filters(path)
+                for tab in list(self.catalogs[database].tables.values()):
+                    self.__open_filters(self.engines[database], self.filters[database], tab)
+            if self.wal_enabled and database not in self.logs:
+                self.logs[database] = WriteAheadLog(os.path.join(path, WAL_FILE),
+                                                    lambda: self.__checkpoint(database))
+                self.__recover(database)
+            return self.catalogs[database], self.engines[database], self.logs.get(database)
+
+    def __abandon_builds(self, catalog, engine):
+        '''
+            drops the indexes whose build was cut short by a restart, they
+            have to be created again
+        '''
+        for tab in list(catalog.tables.values()):
+            if len(tab.ready) != len(tab.indexes):
+                catalog.write(tab.name, tab.columns, [index.definition for index in tab.ready.values()])
+                for index in tab.indexes.values():
+                    if not index.ready:
+                        engine.drop_index(index.collection)
+
+    def __upgrade(self, catalog, engine):
+        '''
+            types the rows of a database that may hold rows written as
+            '#'-joined strings, and writes every index entry again from
+            the typed rows; a row written since, taking the key or a unique
+            value of such a row, is dropped
+
+            Each step can be run again, a cut short upgrade is finished
+            the next time the database is opened.
+        '''
+        tables = list(catalog.tables.values())
+        # references are written again by every referencing table
+        for tab in tables:
+            engine.drop_index(f'{tab.name}_fk')
+        for tab in tables:
+            table = tab.name
+            legacy = []
+            rows = {}  # hashable key -> (document, comparable values), legacy rows first
+            typed = []
+            converted = set()  # keys of the rows written as strings
+            for doc in engine.scan(table):
+                (typed if 'v' in doc else legacy).append(doc)
+            for doc in legacy:
+                row = tab.reconstruct(doc)
+                values = [row[col['name']] for col in tab.columns]
+                new = tab.encode(values)
+                if hashable(new['_id']) not in rows:
+                    rows[hashable(new['_id'])] = (new, values)
+                    converted.add(hashable(new['_id']))
+            dropped = []
+            for doc in typed:
+                key = hashable(doc['_id'])
+                if key in rows:
+                    dropped.append(doc['_id'])
+                    continue
+                row = tab.reconstruct(doc)
+                rows[key] = (doc, [row[col['name']] for col in tab.columns])
+            for col in tab.role('unique'):
+                j = tab.columns.index(col)
+                seen = set()
+                for key, (doc, values) in list(rows.items()):
+                    val = hashable(values[j])
+                    if val in seen:
+                        dropped.append(doc['_id'])
+                        del rows[key]
+                    seen.add(val)
+            if len(dropped) != 0:
+                print(f'{table}: dropped {len(dropped)} rows taking the key or a unique value of older rows: '
+                      f'{dropped[:10]}', file=stderr)
+
+            # typed rows are written before the legacy ones go, so that no row is lost
+            engine.delete(table, dropped)
+            for batch in batched([new for key, (new, _) in rows.items() if key in converted], self.batch_size):
+                engine.put_many(table, batch)
+            engine.delete(table, [doc['_id'] for doc in legacy])
+
+            for name in (f'{table}_uq', f'{table}_nq', *(index.collection for index in tab.indexes.values())):
+                engine.drop_index(name)
+            for batch in batched(rows.values(), self.batch_size):
+                self.__write_entries(engine, tab, batch)
+                entries = [tab.reconstruct(doc) for doc, _ in batch]
+                for index in tab.indexes.values():
+                    engine.index_push(index.collection, 'rows', index.entries(entries))
+
+    def __checkpoint(self, database):
+        # the log is emptied with no change in flight, filters can be rebuilt
+        self.engines[database].sync()
+        filters = self.filters.get(database)
+        if filters is not None:
+            filters.grow()
+            filters.save()
+
+    def bloom_columns(self, tab) -> list:
+        '''
+            columns of tab with a bloom filter: the unique ones and a
+            primary key of one column
+        '''
+        cols = list(tab.role('unique'))
+        if len(tab.keys) == 1:
+            cols.append(tab.keys[0])
+        return cols
+
+    def __open_filters(self, engine, filters, tab):
+        '''
+            opens the filters a table is missing, drops those it no longer has
+        '''
+        table = tab.name
+        names = [col['name'] for col in self.bloom_columns(tab)]
+        for name in filters.columns(table):
+            if name not in names:
+                filters.drop(table, name)
+        for col in self.bloom_columns(tab):
+            name = col['name']
+            if filters.get(table, name) is not None:
+                continue
+            if col['role'] == 'unique':
+                source = lambda name=name: (doc['_id'][name] for doc in engine.index_range(f'{table}_uq', name))
+            else:
+                source = lambda: (doc['_id'] for doc in engine.scan(table))
+            filters.open(table, name, source)
+
+    def __bloom_add(self, tab, rows):
+        '''
+            adds the comparable values of rows to the filters of tab,
+            before their index entries are written
+        '''
+        bloom = self.bloom
+        if bloom is None:
+            return
+        for col in self.bloom_columns(tab):
+            filt = bloom.get(tab.name, col['name'])
+            if filt is not None:
+                j = tab.columns.index(col)
+                filt.add([typed[j] for typed in rows])
+
+    def __bloom_remove(self, tab, rows):
+        '''
+            removes reconstructed rows from the filters of tab, once deleted
+        '''
+        bloom = self.bloom
+        if bloom is None:
+            return
+        for col in self.bloom_columns(tab):
+            filt = bloom.get(tab.name, col['name'])
+            if filt is not None:
+                filt.remove([row[col['name']] for row in rows])
+
+    def __recover(self, database):
+        '''
+            replays the changes of a database's log that were not marked done
+        '''
+        catalog, wal = self.catalogs[database], self.logs[database]
+        if len(wal.pending) != 0:
+            # replay in a session of its own, without logging again
+            session = Session()
+            session.catalog, session.engine = catalog, self.engines[database]
+            session.database = (database, self.db_path(database))
+            token = current_session.set(session)
+            try:
+                for _, record in wal.pending:
+                    self.__replay(catalog, record)
+            finally:
+                current_session.reset(token)
+            self.planner.stats.invalidate()
+        wal.checkpoint()
+
+    def __replay(self, catalog, record):
+        match record:
+            case ('insert', table, rows) if table in catalog.tables:
+                tab = catalog.get(table)
+                self.__repair(tab, rows)
+                self.__insert_batch(tab, rows, 0)
+            case ('delete', table, keys) if table in catalog.tables:
+                tab = catalog.get(table)
+                self.__remove(tab, list(map(tab.reconstruct, self.engine.multi_get(table, keys))))
+            case ('drop_table', table) if table in catalog.tables:
+                self.__drop_table(catalog.get(table))
+            case ('commit', records):
+                for record in records:
+                    self.__replay(catalog, record)
+
+    @contextmanager
+    def logged(self, *record):
+        '''
+            makes a change durable in the write-ahead log before the block
+            applies it, and marks it done once the block is through
+        '''
+        wal = self.wal
+        if wal is None:
+            yield
+            return
+        with phase('wal'):
+            lsn = wal.commit(*record)
+        try:
+            yield
+        except ServerError:
+            # refused changes clean up after themselves
+            wal.done(lsn)
+            raise
+        except BaseException:
+            # any other error leaves the record to be replayed on the next start
+            wal.fail(lsn)
+            raise
+        wal.done(lsn)
+        if self.bloom is not None and self.bloom.full():
+            # filters are rebuilt larger while nothing is in flight
+            wal.checkpoint()
+
+    def create_database(self, database: str, engine=DEFAULT_ENGINE):
         path = self.db_path(database)
         if os.path.exists(path):
             raise ServerError(Error.ALREADY_EXISTS)
+        if engine not in ENGINES:
+            raise ServerError(Error.DOES_NOT_EXIST, f'engine: {engine}')
         os.makedirs(path)
-        # mongo: noop
+        with open(os.path.join(path, ENGINE_FILE), 'w') as f:
+            f.write(engine)
+        open(os.path.join(path, FORMAT_FILE), 'w').close()
 
     def use_database(self, database: str):
         path = self.db_path(database)
         if not os.path.exists(path):
             raise ServerError(Error.DOES_NOT_EXIST)
-        self.database = (database, path)
-        self.db = self.mongo[database]
-        self.idb = self.mongo[f'_{database}_index']
+        session = self.session
+        if session.tx is not None:
+            # its writes would be lost with the database they were made in
+            raise ServerError(Error.INVALID_COMMAND, 'transaction open, commit or rollback first')
+        session.close()
+        session.catalog, session.engine, session.wal = self.open_database(database)
+        session.database = (database, path)
 
     def drop_database(self, database):
         path = self.db_path(database)
         if self.database is not None and database == self.database[0]:
-            self.database = None
-            self.db = None
-            self.idb = None
+            if self.session.tx is not None:
+                raise ServerError(Error.INVALID_COMMAND, 'transaction open, commit or rollback first')
+            self.session.close()
         if not os.path.exists(path):
             raise ServerError(Error.DOES_NOT_EXIST)
-        shutil.rmtree(path)
-
-        self.mongo.drop_database(database)
-        self.mongo.drop_database(f'_{database}_index')
+        catalog, engine, wal = self.open_database(database)
+        with self.lock, self.writers[database]:
+            # sessions still using it find no database in use from now on
+            catalog.dropped = True
+            engine.drop_database()
+            if wal is not None:
+                wal.close()
+            shutil.rmtree(path)
+            self.catalogs.pop(database, None)
+            self.engines.pop(database, None)
+            self.logs.pop(database, None)
+            self.filters.pop(database, None)
+            self.writers.pop(database, None)
+            lock = self.locks.pop(database, None)
+            if lock is not None:
+                lock.close()
+        self.planner.stats.invalidate()
 
     def create_table(self, table: str):
         if self.database is None:
             raise ServerError(Error.NO_DATABASE_IN_USE)
-        path = self.tab_path(table)
-        if os.path.exists(path):
-            raise ServerError(Error.ALREADY_EXISTS)
-        with open(path, 'w') as f:
-            f.write('[]')
+        with self.catalog.lock:
+            if table in self.catalog:
+                raise ServerError(Error.ALREADY_EXISTS)
+            self.catalog.write(table, [])
 
-        # self.db.create_collection(table)
+        # engine: noop
 
-    def create_column(self, table, col_name, col_type, index_type):
-        table_def = self.read_table(table)
-
-        if any(map(lambda c: c['name'] == col_name, table_def)):
-            raise ServerError(Error.ALREADY_EXISTS)
-
-        if index_type == 'primary-key-unique' and any(map(lambda c: c['role'] == 'primary-key-unique', table_def)):
-            raise ServerError(Error.DUPLICATE_KEY,
-                "Cannot have more than one unique primary key")
-
-        column = {
-            "name": col_name,
-            "type": col_type,
-            "role": index_type
-        }
+    def create_column(self, table, col_name, col_type, index_type, default=None):
+        '''
+            adds a column to a table; the rows it already has take the value
+            default, which they need, and get the index entries of its role
 
-        if index_type.startswith('foreign-key'):
-            reference = index_type.split('=')[1]
-            ref_tab, ref_col = self.get_reference(reference)
+            Writes wait while the rows are written again. A key column cannot
+            be added to a table with rows, nor a unique one to a table of
+            more than one, whose rows would share the value.
+        '''
+        self.check_table(table)
+        # no row may be written meanwhile, stored rows are written with the default
+        with self.write_lock, self.catalog.lock:
+            # copy, the cached definition is only replaced by write_table
+            table_def = list(self.read_table(table))
+
+            if any(map(lambda c: c['name'] == col_name, table_def)):
+                raise ServerError(Error.ALREADY_EXISTS)
+
+            if index_type == 'primary-key-unique' and any(map(lambda c: c['role'] == 'primary-key-unique', table_def)):
+                raise ServerError(Error.DUPLICATE_KEY,
+                    "Cannot have more than one unique primary key")
+
+            rows = self.engine.count(table)
+            if rows != 0 and index_type.startswith('primary-key'):
+                raise ServerError(Error.INVALID_COMMAND, f'column: {table} already has rows, a key cannot be added')
+            if rows != 0 and default is None:
+                raise ServerError(Error.INVALID_COMMAND, f'column: {table} already has rows, a default is needed')
+            if default is not None:
+                if not parser.parser_input(default, col_type):
+                    raise ServerError(Error.INVALID_TYPE, f'{table}.{col_name}: {default}')
+                default = parser.parse_value(default, col_type)
+            if rows > 1 and index_type == 'unique':
+                raise ServerError(Error.DUPLICATE_UNIQUE, f'{table}.{col_name}: {rows} rows would share {default}')
+
+            column = {
+                "name": col_name,
+                "type": col_type,
+                "role": index_type
+            }
+
+            if index_type.startswith('foreign-key'):
+                reference = index_type.split('=')[1]
+                ref_tab, ref_col = self.get_reference(reference)
+
+                if ref_col['role'] not in ['primary-key-unique', 'unique']:
+                    raise ServerError(Error.INVALID_REFERENCE, f'ref: {reference}: referenced column not unique')
+                if rows != 0 and len(self.existing_values(reference.split('.')[0], ref_col['name'], [default])) == 0:
+                    raise ServerError(Error.FOREIGN_KEY_CONSTRAINT, f'{table}.{col_name}: {reference}: {default}')
+
+                column['role'] = 'foreign-key'
+                column['reference'] = reference
+
+            if rows != 0:
+                self.__fill_column(self.get_table(table), column, default)
+            table_def.append(column)
+            self.write_table(table, table_def)
+            if self.bloom is not None:
+                self.__open_filters(self.engine, self.bloom, self.get_table(table))
+        self.planner.stats.invalidate(table)
+
+    def __fill_column(self, tab, column, default):
+        '''
+            writes the rows of tab again with default as the value of a new
+            column, and the index entries of its role; the definition is
+            written after, so an attempt cut short leaves nothing to undo
+            that another does not redo
+        '''
+        table, name = tab.name, column['name']
+        size = len(tab.value_idx)
+        for batch in batched(self.engine.scan(table), self.batch_size):
+            keys = [doc['_id'] for doc in batch]
+            match column['role']:
+                case 'unique':
+                    self.engine.index_delete(f'{table}_uq', name, [default])
+                    self.engine.index_insert(f'{table}_uq', name, {default: {'key': keys[0]}})
+                case 'index':
+                    self.engine.index_add(f'{table}_nq', 'keys', {(name, default): keys})
+                case 'foreign-key':
+                    ref_tab, ref_col = column['reference'].split('.')
+                    self.engine.refs_remove(f'{ref_tab}_fk', table, {(ref_col, default): keys})
+                    self.engine.refs_add(f'{ref_tab}_fk', table, {(ref_col, default): keys})
+            self.engine.replace_many(table, [{'_id': doc['_id'], 'v': [*doc['v'][:size], default]} for doc in batch])
+        # the rows hold the value before any reads it
+        self.engine.sync()
+
+    def create_index(self, table, name, columns, include=(), writers=BUILD_WRITERS) -> int:
+        '''
+            declares a compound index on columns, also holding the values
+            of the include columns, builds it from the stored rows and
+            returns their number
+
+            The table stays open to reads and writes during the build: the
+            index is declared building, so that writes keep it up to date,
+            and only turns ready, and used by select, once every row read
+            by the build has its entry. stats reports the rows read so far.
+            Without the write-ahead log, the build cannot wait for writes
+            already under way when the index is declared, which may miss it.
+        '''
+        self.check_table(table)
+        with self.catalog.lock:
+            tab = self.get_table(table)
+            if name in tab.indexes:
+                raise ServerError(Error.ALREADY_EXISTS, f'index: {name}')
+            for col in [*columns, *include]:
+                if col not in tab.cols:
+                    raise ServerError(Error.DOES_NOT_EXIST, f'column: {table}.{col}')
+            if len(set(columns)) != len(columns):
+                raise ServerError(Error.INVALID_COMMAND, f'index: {name}: repeated column')
+
+            definition = {
+                'name': name,
+                'columns': list(columns),
+                'include': [col for col in dict.fromkeys(include) if col not in columns],
+                'state': 'building',
+            }
+            index = Index(tab, definition)
+
+            # entries left by a build that did not finish
+            self.engine.drop_index(index.collection)
+            indexes = [index.definition for index in tab.indexes.values()]
+            self.catalog.write(table, tab.columns, indexes + [definition])
+            build = IndexBuild(index, self.engine.count(table))
+            self.builds[(self.database[0], index.collection)] = build
 
-            if ref_col['role'] not in ['primary-key-unique', 'unique']:
-                raise ServerError(Error.INVALID_REFERENCE, f'ref: {reference}: referenced column not unique')
+        try:
+            # writes that began before the index was declared do not know of it
+            if self.wal is not None and not self.wal.drain(DRAIN_SECONDS):
+                raise ServerError(Error.INVALID_COMMAND, f'index: {name}: writes under way did not finish')
+            self.__backfill(self.get_table(table), build, writers)
+        except Exception:
+            if not build.cancelled:
+                # a declared index is otherwise only dropped by a restart
+                self.drop_index(table, name)
+            raise
+        finally:
+            self.builds.pop((self.database[0], index.collection), None)
+
+        with self.catalog.lock:
+            if build.cancelled:
+                raise ServerError(Error.DOES_NOT_EXIST, f'index: {name}')
+            tab = self.get_table(table)
+            indexes = [dict(other.definition, state='ready') if other.name == name else other.definition
+                       for other in tab.indexes.values()]
+            self.catalog.write(table, tab.columns, indexes)
+        self.planner.stats.invalidate(table)
+        return build.done
+
+    def __backfill(self, tab, build, writers):
+        '''
+            adds the entries of the stored rows to the index of a build, the
+            batches written by a pool of writers
+        '''
+        index = build.index
+
+        def wait(future):
+            try:
+                future.result()
+            except Exception:
+                # the index may be dropped under a write
+                if not build.cancelled:
+                    raise
+
+        with ThreadPoolExecutor(writers) as pool:
+            pending = deque()
+            for batch in batched(map(tab.reconstruct, self.engine.scan(tab.name)), self.batch_size):
+                if build.cancelled:
+                    break
+                # rows inserted meanwhile may already have their entries
+                pending.append(pool.submit(contextvars.copy_context().run, self.engine.index_add,
+                                           index.collection, 'rows', index.entries(batch)))
+                build.done += len(batch)
+                while len(pending) > writers:
+                    wait(pending.popleft())
+            for future in pending:
+                wait(future)
+
+        # changes made meanwhile, until writes no longer make any
+        while not build.cancelled:
+            added, removed = build.take()
+            if len(added) == 0 and len(removed) == 0:
+                break
+            self.engine.index_pull(index.collection, 'rows', removed)
+            self.engine.index_add(index.collection, 'rows', added)
+        if build.cancelled:
+            self.engine.drop_index(index.collection)
+
+    def __cancel_builds(self, table, name=None):
+        for (database, _), build in list(self.builds.items()):
+            index = build.index
+            if database == self.database[0] and index.table.name == table and name in (None, index.name):
+                build.cancelled = True
+
+    def __indexes(self, tab):
+        '''
+            the compound indexes of tab written by a change, read from the
+            catalog, since a build may have declared one after tab was read
+        '''
+        return self.catalog.tables.get(tab.name, tab).indexes.values()
 
-            column['role'] = 'foreign-key'
-            column['reference'] = reference
+    def __push(self, index, rows):
+        '''
+            adds the entries of reconstructed rows to a compound index; a
+            build may add them too, until it is done they are not repeated
+        '''
+        entries = index.entries(rows)
+        if index.ready:
+            self.engine.index_push(index.collection, 'rows', entries)
+            return
+        build = self.builds.get((self.database[0], index.collection))
+        if build is not None:
+            build.capture(entries, True)
+        self.engine.index_add(index.collection, 'rows', entries)
+
+    def __pull(self, index, rows):
+        entries = index.entries(rows)
+        build = self.builds.get((self.database[0], index.collection))
+        if build is not None:
+            build.capture(entries, False)
+        self.engine.index_pull(index.collection, 'rows', entries)
+
+    def drop_index(self, table, name):
+        self.check_table(table)
+        with self.catalog.lock:
+            tab = self.get_table(table)
+            index = tab.indexes.get(name)
+            if index is None:
+                raise ServerError(Error.DOES_NOT_EXIST, f'index: {name}')
+            # forgotten first, so that no select probes it while it goes
+            indexes = [other.definition for other in tab.indexes.values() if other is not index]
+            self.catalog.write(table, tab.columns, indexes)
+            self.__cancel_builds(table, name)
+            self.engine.drop_index(index.collection)
+        self.planner.stats.invalidate(table)
 
-        table_def.append(column)
-        self.write_table(table, table_def)
+    def drop_table(self, table):
+        tab = self.get_table(table)
 
-        # mongo: noop
+        with self.write_lock:
+            self.__check_unchanged(tab)
+            # rows of other tables referencing this one stop the drop
+            for other in list(self.catalog.tables.values()):
+                if other.name == table:
+                    continue
+                for col in other.role('foreign-key'):
+                    ref_tab, ref_col = col['reference'].split('.')
+                    if ref_tab == table and self.engine.refs_count(f'{table}_fk', ref_col, other.name) != 0:
+                        raise ServerError(Error.FOREIGN_KEY_CONSTRAINT, f"ref: {other.name}.{col['name']}")
 
-    def drop_table(self, table):
-        self.check_table(table)
-        self.delete(table, {})
+            with self.logged('drop_table', table):
+                self.__drop_table(tab)
 
-        os.remove(self.tab_path(table))
-        self.db[table].drop()
-        self.idb[f'{table}_fk'].drop()
-        self.idb[f'{table}_uq'].drop()
+    def __check_unchanged(self, tab):
+        '''
+            raises unless tab is still defined with the same columns, for
+            changes checked against it before they held the write lock
+        '''
+        if self.get_table(tab.name).columns != tab.columns:
+            raise ServerError(Error.INVALID_COMMAND, f'table: {tab.name} changed meanwhile')
+
+    def __drop_table(self, tab):
+        table = tab.name
+
+        # no rows are left behind, only the references they hold elsewhere
+        for col in tab.role('foreign-key'):
+            ref_tab, ref_col = col['reference'].split('.')
+            if ref_tab != table:
+                self.engine.refs_purge(f'{ref_tab}_fk', table)
+
+        self.engine.drop(table)
+        self.engine.drop_index(f'{table}_fk')
+        self.engine.drop_index(f'{table}_uq')
+        self.engine.drop_index(f'{table}_nq')
+        self.__cancel_builds(table)
+        for index in tab.indexes.values():
+            self.engine.drop_index(index.collection)
+        if self.bloom is not None:
+            self.bloom.drop(table)
+        # last, a replayed drop finds the table until it is complete
+        self.catalog.drop(table)
+        self.planner.stats.invalidate(table)
 
     def insert(self, table, values):
-        tab_def = self.read_table(table)
+        tab = self.get_table(table)
+        tab_def = tab.columns
         if len(tab_def) != len(values):
             raise ServerError(Error.INVALID_NUMBER_OF_FIELDS)
         if any(map(lambda cv: not parser.parser_input(cv[1], cv[0]['type']), zip(tab_def, values))):
             raise ServerError(Error.INVALID_TYPE)
 
-        keys = []
-        vals = []
-        for col, val in zip(tab_def, values):
-            match col['role']:
-                case 'primary-key-unique' | 'primary-key-not-unique': keys.append(val)
-                case _: vals.append(val)
-
-        key = "#".join(keys)
-
-        # check for duplicate primary key
-        # NOTE: redundant, mongo handles this, but need to synchronize
-        # duplicate key exceptions with normal and index inserts
-        # TODO: try-except mongo's exception, delete index, then rethrow
-        row = self.db[table].find_one({'_id': key})
-        if row is not None:
-            raise ServerError(Error.DUPLICATE_KEY)
-
-        for col, val in zip(tab_def, values):
-            match col['role']:
-                case 'foreign-key':
-                    # check that referenced key exists
-                    ref_tab, ref_col = col['reference'].split('.')
-                    ref_rows = self.select(ref_tab, ['*'], {ref_col: val})
-                    if len(ref_rows) == 0:
-                        raise ServerError(Error.INVALID_REFERENCE, f"ref: {col['reference']}={val}: no such row")
-                    # reference is valid, let's index it
-                    row = self.idb[f'{ref_tab}_fk'].find_one_and_update(
-                        {'_id': {ref_col: val}}, {"$push": {"refs": {'table': table, 'key': key}}})
-                    if row is None:
-                        self.idb[f'{ref_tab}_fk'].insert_one(
-                            {'_id': {ref_col: val}, "refs": [{'table': table, 'key': key}]})
-                case 'unique':
-                    # unique index
-                    row = self.idb[f'{table}_uq']\
-                        .find_one({'_id': {col['name']: val}})
-                    if row is not None:
-                        raise ServerError(Error.DUPLICATE_UNIQUE)
-                    self.idb[f'{table}_uq'].insert_one(
-                        {'_id': {col['name']: val}, "key": key})
-                case 'index':
-                    # not unique index
-                    row = self.idb[f'{table}_nq'].find_one_and_update(
-                        {'_id': {col['name']: val}}, {"$push": {"keys": key}})
-                    if row is None:
-                        self.idb[f'{table}_nq'].insert_one(
-                            {'_id': {col['name']: val}, "keys": [key]})
-
-        doc = {
-            "_id": '#'.join(keys),
-            "values": '#'.join(vals)
-        }
-        self.db[table].insert_one(doc)
-
-    def delete(self, table, where):
-        tab_def = self.read_table_dict(table)
-
-        # no need to validate 'where', select handles it
-        rows = self.select(table, ['*'], where)
-
-        # check if fk constraints let us delete
-        # dont delete anything until then
-        for row in rows:
-            for col in row:
-                res = self.idb[f'{table}_fk']\
-                    .find_one({'_id': {col: row[col]}})
-                if res is not None and len(res['refs']) != 0:
-                    raise ServerError(Error.FOREIGN_KEY_CONSTRAINT)
-
-        # delete
-        for row in rows:
-            for colname in row:
-                key = row['_id']
-                val = row[colname]
-                col = tab_def[colname]
-                if col is None:
-                    continue
+        typed = tab.typed(values)
+        doc = tab.encode(typed)
+        key = doc['_id']
+
+        tx = self.session.tx
+        if tx is not None:
+            # checked along with the rest of the transaction at commit
+            tx.inserts.setdefault(table, []).append((tab.reconstruct(doc), values))
+            return
+
+        with self.write_lock:
+            self.__check_unchanged(tab)
+            # check for duplicate primary key
+            # NOTE: redundant, the engine checks too, but failing here
+            # saves writing index entries only to remove them again
+            if len(tab.keys) == 1:
+                taken = len(self.existing_values(table, tab.keys[0]['name'], [key])) != 0
+            else:
+                taken = self.engine.get(table, key) is not None
+            if taken:
+                raise ServerError(Error.DUPLICATE_KEY)
+
+            with self.logged('insert', table, [values]):
+                try:
+                    self.__bloom_add(tab, [typed])
+                    for col, text, val in zip(tab_def, values, typed):
+                        match col['role']:
+                            case 'foreign-key':
+                                # check that referenced key exists
+                                ref_tab, ref_col = col['reference'].split('.')
+                                if len(self.existing_values(ref_tab, ref_col, [val])) == 0:
+                                    raise ServerError(Error.INVALID_REFERENCE,
+                                                      f"ref: {col['reference']}={text}: no such row")
+                                # reference is valid, let's index it
+                                self.engine.refs_add(f'{ref_tab}_fk', table, {(ref_col, val): [key]})
+                            case 'unique':
+                                # unique index
+                                self.engine.index_insert(f'{table}_uq', col['name'], {val: {'key': key}})
+                            case 'index':
+                                # not unique index
+                                self.engine.index_push(f'{table}_nq', 'keys', {(col['name'], val): [key]})
+                    for index in self.__indexes(tab):
+                        self.__push(index, [tab.reconstruct(doc)])
+
+                    self.engine.put(table, doc)
+                except ServerError:
+                    # remove the index entries written so far
+                    self.__repair(tab, [values])
+                    raise
+        self.planner.stats.touch(table)
+
+    def stats(self) -> list:
+        '''
+            rows describing the server's caches and counters
+        '''
+        rows = []
+        if isinstance(self.engine, CachedEngine):
+            rows.append({'name': 'cache', 'database': self.database[0]} | self.engine.cache.stats())
+        if self.bloom is not None:
+            for (table, col), filt in sorted(self.bloom.filters.items()):
+                rows.append({'name': 'bloom', 'table': table, 'column': col,
+                             'values': filt.bloom.size, 'capacity': filt.bloom.capacity})
+        for (database, _), build in list(self.builds.items()):
+            if self.database is not None and database == self.database[0]:
+                rows.append({'name': 'index build', 'table': build.index.table.name, 'index': build.index.name,
+                             'rows': build.done, 'of': build.rows})
+        return rows + self.metrics.rows()
+
+    def begin(self):
+        if self.database is None:
+            raise ServerError(Error.NO_DATABASE_IN_USE)
+        if self.session.tx is not None:
+            raise ServerError(Error.INVALID_COMMAND, 'transaction already open')
+        self.session.tx = Transaction()
 
-                # delete fk index
-                if col['role'] == 'foreign-key':
-                    ref_tab, ref_col = col['reference'].split('.')
-                    self.idb[f'{ref_tab}_fk'].find_one_and_update(
-                        {'_id': {ref_col: val}}, {"$pull": {"refs": {"table": table, "key": key}}})
-                # delete uq index
-                elif col['role'] == 'unique':
-                    self.idb[f'{table}_uq'].delete_one(
-                        {'_id': {col['name']: val}})
-                # delete nq index
-                elif col['role'] == 'index':
-                    self.idb[f'{table}_nq'].find_one_and_update(
-                        {'_id': {col['name']: val}}, {"$pull": {"keys": key}})
-            # delete row
-            self.db[table].delete_one({'_id': key})
+    def rollback(self):
+        if self.session.tx is None:
+            raise ServerError(Error.INVALID_COMMAND, 'no transaction open')
+        self.session.tx = None
+
+    def commit(self) -> (int, int):
+        '''
+            applies the writes of the open transaction, returns (inserted, deleted)
+
+            Deletes and inserts are checked together, in bulk, before anything
+            is written; a violation rolls back the whole transaction. The
+            changes are logged as one record and written with one bulk request
+            per collection and batch.
+        '''
+        tx = self.session.tx
+        if tx is None:
+            raise ServerError(Error.INVALID_COMMAND, 'no transaction open')
+        self.session.tx = None
+
+        # referenced tables first, their new rows may be referenced
+        order = []
+
+        def visit(table, seen):
+            if table in order or table in seen:
+                return
+            seen.add(table)
+            for col in self.get_table(table).role('foreign-key'):
+                ref_tab = col['reference'].split('.')[0]
+                if ref_tab in tx.inserts:
+                    visit(ref_tab, seen)
+            order.append(table)
+
+        for table in tx.inserts:
+            visit(table, set())
+
+        with self.write_lock:
+            for table, rows in tx.deletes.items():
+                self.__check_delete(self.get_table(table), rows.values(), tx.deletes)
+            checked = {}
+            for table in order:
+                rows = [values for _, values in tx.inserts[table]]
+                accepted, errors = self.__check_batch(self.get_table(table), rows, 0, tx, checked)
+                if len(errors) != 0:
+                    i, code, msg = min(errors, key=lambda err: err[0])
+                    raise ServerError(code, f'{table} row {i}: {msg}'.rstrip())
+                checked[table] = accepted
+
+            records = [('delete', table, [row['_id'] for row in rows.values()]) for table, rows in tx.deletes.items()]
+            records += [('insert', table, [values for _, values in tx.inserts[table]]) for table in order]
+            if len(records) == 0:
+                return 0, 0
+
+            with self.logged('commit', records):
+                for table, rows in tx.deletes.items():
+                    self.__remove(self.get_table(table), list(rows.values()))
+                try:
+                    for table in order:
+                        for batch in batched(checked[table], self.batch_size):
+                            self.__write_batch(self.get_table(table), batch)
+                except ServerError:
+                    for table in order:
+                        self.__repair(self.get_table(table), [values for _, values in tx.inserts[table]])
+                    raise
+
+        for table, rows in tx.deletes.items():
+            self.planner.stats.touch(table, len(rows))
+        for table in order:
+            self.planner.stats.touch(table, len(checked[table]))
+        return sum(map(len, checked.values())), sum(map(len, tx.deletes.values()))
+
+    def existing_values(self, table, column, values) -> set:
+        '''
+            returns the subset of comparable values that are present in a
+            unique or primary-key-unique column, in one round trip
+        '''
+        tab = self.get_table(table)
+        col = tab.cols[column]
+        values = list(values)
+        filt = None if self.bloom is None else self.bloom.get(table, column)
+        if filt is not None:
+            # values the filter has never seen need no lookup
+            values = [val for val in values if val in filt]
+        if len(values) == 0:
+            return set()
+
+        if col['role'] == 'unique':
+            return set(self.engine.index_get(f'{table}_uq', column, values))
+
+        # primary key: the value is the row key, or one part of it
+        if len(tab.keys) == 1:
+            return {doc['_id'] for doc in self.engine.multi_get(table, values)}
+        return self.engine.match_keys(table, column, values)
+
+    def bulk_insert(self, table, rows, batch_size=None) -> (int, list):
+        '''
+            inserts rows in batches of batch_size, returns (inserted, errors)
+
+            Constraints are checked with one query per constraint and batch,
+            rows and index entries are written with one bulk request each.
+            Rejected rows do not stop the load; they are reported in errors
+            as (row number, code, message).
+        '''
+        tab = self.get_table(table)
+        batch_size = batch_size or self.batch_size
+
+        errors = []
+        inserted = 0
+        tx = self.session.tx
+        if tx is not None:
+            # only types are checked now, constraints at commit
+            buffered = tx.inserts.setdefault(table, [])
+            for i, values in enumerate(rows):
+                if len(values) != len(tab.columns):
+                    errors.append((i, Error.INVALID_NUMBER_OF_FIELDS, ''))
+                elif not all(map(lambda cv: parser.parser_input(cv[1], cv[0]['type']), zip(tab.columns, values))):
+                    errors.append((i, Error.INVALID_TYPE, ''))
+                else:
+                    buffered.append((tab.reconstruct(tab.encode(tab.typed(values))), values))
+                    inserted += 1
+            return inserted, errors
+
+        for n, batch in enumerate(batched(rows, batch_size)):
+            with self.write_lock:
+                self.__check_unchanged(tab)
+                with self.logged('insert', table, batch):
+                    try:
+                        batch_errors = self.__insert_batch(tab, batch, n * batch_size)
+                    except ServerError:
+                        self.__repair(tab, batch)
+                        raise
+            inserted += len(batch) - len(batch_errors)
+            self.planner.stats.touch(table, len(batch) - len(batch_errors))
+            errors.extend(sorted(batch_errors, key=lambda err: err[0]))
+        return inserted, errors
+
+    def load_file(self, table, path, format=None, workers=None, writers=LOAD_WRITERS, batch_size=None,
+                  progress=None) -> (int, list):
+        '''
+            inserts the rows of a CSV or JSONL file, returns (inserted, errors)
+            as bulk_insert does, rows numbered from the first after any header
+
+            Chunks of batch_size records are parsed and type checked by a pool
+            of workers processes, checked against the constraints one by one in
+            file order, and written by writers threads. The keys and unique
+            values of batches being written are claimed in memory, so that the
+            batches after them cannot take them. Other writes to the database
+            wait for the load. progress(inserted, rejected) is called as
+            batches are written.
+        '''
+        tab = self.get_table(table)
+        if self.session.tx is not None:
+            raise ServerError(Error.INVALID_COMMAND, 'load: in a transaction')
+        fmt = loader.file_format(path, format)
+        if fmt is None:
+            raise ServerError(Error.INVALID_COMMAND, f'load: format of {path}')
+        if not os.path.isfile(path):
+            raise ServerError(Error.DOES_NOT_EXIST, f'file: {path}')
+        batch_size = batch_size or self.batch_size
+        workers = workers or os.cpu_count()
+
+        order = loader.read_header(path, [col['name'] for col in tab.columns]) if fmt == 'csv' else None
+        columns = json.dumps(tab.columns)
+        uniques = [(tab.columns.index(col), col['name']) for col in tab.role('unique')]
+        lock = threading.Lock()
+        claims = {}  # batch number -> {'_id': keys, column: values} until written
+
+        def write(n, accepted, rows):
+            try:
+                with self.logged('insert', table, rows):
+                    try:
+                        self.__write_batch(tab, accepted)
+                    except ServerError:
+                        self.__repair(tab, rows)
+                        raise
+                self.planner.stats.touch(table, len(accepted))
+            finally:
+                with lock:
+                    del claims[n]
+            return len(accepted)
+
+        inserted = 0
+        errors = []
+        chunks = loader.chunks(path, fmt, batch_size, 0 if order is None else 1)
+        with self.write_lock, ProcessPoolExecutor(workers) as pool, ThreadPoolExecutor(writers) as threads:
+            self.__check_unchanged(tab)
+            parsing = deque()
+            writing = deque()
+
+            def parse_next():
+                chunk = next(chunks, None)
+                if chunk is not None:
+                    parsing.append(pool.submit(loader.parse_chunk, table, columns, fmt, order, *chunk))
+
+            def collect(limit):
+                # waits for the oldest writes until at most limit are in flight
+                nonlocal inserted
+                while len(writing) > limit or len(writing) != 0 and writing[0].done():
+                    inserted += writing.popleft().result()
+                    if progress is not None:
+                        progress(inserted, len(errors))
+
+            for _ in range(2 * workers):
+                parse_next()
+            n = 0  # batches written
+            while len(parsing) != 0:
+                valid, batch_errors = parsing.popleft().result()
+                parse_next()
+
+                # claims are taken before the engine is asked, a batch written
+                # in between is found by one or the other
+                with lock:
+                    claimed = {'_id': set().union(*(claim['_id'] for claim in claims.values()))}
+                    for _, name in uniques:
+                        claimed[name] = set().union(*(claim[name] for claim in claims.values()))
+                accepted, batch_errors = self.__check_rows(
+                    tab, [(i, doc, typed) for i, _, doc, typed in valid], batch_errors, claimed=claimed)
+                errors.extend(sorted(batch_errors, key=lambda err: err[0]))
+
+                if len(accepted) != 0:
+                    rejected = {err[0] for err in batch_errors}
+                    rows = [values for i, values, _, _ in valid if i not in rejected]
+                    claim = {'_id': {hashable(doc['_id']) for doc, _ in accepted}}
+                    claim |= {name: {typed[j] for _, typed in accepted} for j, name in uniques}
+                    with lock:
+                        claims[n] = claim
+                    writing.append(threads.submit(contextvars.copy_context().run, write, n, accepted, rows))
+                    n += 1
+                # at most two batches per writer in flight
+                collect(2 * writers - 1)
+
+                if self.wal is not None and self.bloom is not None and self.bloom.full():
+                    # filters holding too many values let every value through,
+                    # they are rebuilt at a checkpoint with no write in flight
+                    collect(0)
+                    self.wal.checkpoint()
+            collect(0)
+        return inserted, errors
+
+    def __repair(self, tab, rows):
+        '''
+            removes the index entries of the rows of an insert that did not
+            make it to the table; the row is written last, so a stored row
+            has all of its entries if it is the one the insert wrote
+        '''
+        valid = [values for values in rows if len(values) == len(tab.columns) and all(
+            map(lambda cv: parser.parser_input(cv[1], cv[0]['type']), zip(tab.columns, values)))]
+        docs = [tab.encode(tab.typed(values)) for values in valid]
+        stored = {hashable(doc['_id']): tab.reconstruct(doc)
+                  for doc in self.engine.multi_get(tab.name, [doc['_id'] for doc in docs])}
+        missing = []
+        for doc in docs:
+            row = tab.reconstruct(doc)
+            other = stored.get(hashable(doc['_id']))
+            if other is None:
+                missing.append(row)
+            elif other != row:
+                # another row holds the key, the entries it shares are its own
+                self.__unindex(tab, [row], False, {name for name, val in row.items() if other.get(name) != val})
+        self.__remove(tab, missing, owned=False)
+
+    def __insert_batch(self, tab, rows, offset):
+        accepted, errors = self.__check_batch(tab, rows, offset)
+        if len(accepted) != 0:
+            self.__write_batch(tab, accepted)
+        return errors
+
+    def __check_batch(self, tab, rows, offset, tx=None, pending=None):
+        '''
+            returns (accepted, errors) of rows to insert, accepted as
+            [(document, comparable values)]
+
+            With a transaction, its deleted rows no longer take keys and
+            values, and rows of pending {table: accepted} can be referenced.
+        '''
+        errors = []
+
+        # type validation, in one pass
+        valid = []
+        for i, values in enumerate(rows, offset):
+            if len(values) != len(tab.columns):
+                errors.append((i, Error.INVALID_NUMBER_OF_FIELDS, ''))
+            elif not all(map(lambda cv: parser.parser_input(cv[1], cv[0]['type']), zip(tab.columns, values))):
+                errors.append((i, Error.INVALID_TYPE, ''))
+            else:
+                typed = tab.typed(values)
+                valid.append((i, tab.encode(typed), typed))
+        return self.__check_rows(tab, valid, errors, tx, pending)
+
+    def __check_rows(self, tab, valid, errors, tx=None, pending=None, claimed=None):
+        '''
+            returns (accepted, errors) of typed rows [(row number, document,
+            comparable values)], errors extending those given
+
+            claimed {'_id': hashable keys, column: values} are taken by rows
+            on their way to being written.
+        '''
+        table = tab.name
+        deleted = {} if tx is None else tx.deletes
+        pending = pending or {}
+        claimed = claimed or {}
+
+        # fetch everything that already exists, one query per constraint
+        uniques = [(tab.columns.index(col), col) for col in tab.role('unique')]
+        foreigns = [(tab.columns.index(col), col) for col in tab.role('foreign-key')]
+
+        keys = [doc['_id'] for _, doc, _ in valid]
+        if len(tab.keys) == 1:
+            taken_keys = self.existing_values(table, tab.keys[0]['name'], keys)
+        else:
+            taken_keys = {hashable(doc['_id']) for doc in self.engine.multi_get(table, keys)}
+        taken_keys -= deleted.get(table, {}).keys()
+        taken_keys |= claimed.get('_id', set())
+        taken = {}
+        for j, col in uniques:
+            taken[col['name']] = self.existing_values(
+                table, col['name'], {typed[j] for _, _, typed in valid})
+            taken[col['name']] -= {row[col['name']] for row in deleted.get(table, {}).values()}
+            taken[col['name']] |= claimed.get(col['name'], set())
+        present = {}
+        for j, col in foreigns:
+            ref_tab, ref_col = col['reference'].split('.')
+            present[col['name']] = self.existing_values(
+                ref_tab, ref_col, {typed[j] for _, _, typed in valid})
+            present[col['name']] -= {row[ref_col] for row in deleted.get(ref_tab, {}).values()}
+            if ref_tab in pending:
+                j_ref = self.get_table(ref_tab).columns.index(self.get_table(ref_tab).cols[ref_col])
+                present[col['name']] |= {typed[j_ref] for _, typed in pending[ref_tab]}
+
+        # check rows in order, so that earlier rows win duplicates
+        accepted = []
+        for i, doc, typed in valid:
+            key = hashable(doc['_id'])
+            if key in taken_keys:
+                errors.append((i, Error.DUPLICATE_KEY, doc['_id']))
+                continue
+            dup = next((col for j, col in uniques if typed[j] in taken[col['name']]), None)
+            if dup is not None:
+                errors.append((i, Error.DUPLICATE_UNIQUE, dup['name']))
+                continue
+            ref = next((col for j, col in foreigns if typed[j] not in present[col['name']]), None)
+            if ref is not None:
+                errors.append((i, Error.INVALID_REFERENCE, f"ref: {ref['reference']}: no such row"))
+                continue
+
+            taken_keys.add(key)
+            for j, col in uniques:
+                taken[col['name']].add(typed[j])
+            accepted.append((doc, typed))
+        return accepted, errors
+
+    def __write_batch(self, tab, accepted):
+        self.__bloom_add(tab, [typed for _, typed in accepted])
+
+        # write indexes, then rows
+        self.__write_entries(self.engine, tab, accepted)
+
+        indexes = self.__indexes(tab)
+        if len(indexes) != 0:
+            rows = [tab.reconstruct(doc) for doc, _ in accepted]
+            for index in indexes:
+                self.__push(index, rows)
+
+        self.engine.put_many(tab.name, [doc for doc, _ in accepted])
+
+    @staticmethod
+    def __write_entries(engine, tab, accepted):
+        '''
+            writes the unique, not unique and reference entries of
+            [(document, comparable values)]
+        '''
+        table = tab.name
+        for col in tab.role('unique'):
+            j = tab.columns.index(col)
+            engine.index_insert(f'{table}_uq', col['name'], {typed[j]: {'key': doc['_id']} for doc, typed in accepted})
+
+        nq = {}
+        for col in tab.role('index'):
+            j = tab.columns.index(col)
+            for doc, typed in accepted:
+                nq.setdefault((col['name'], typed[j]), []).append(doc['_id'])
+        engine.index_push(f'{table}_nq', 'keys', nq)
+
+        fk = {}
+        for col in tab.role('foreign-key'):
+            j = tab.columns.index(col)
+            ref_tab, ref_col = col['reference'].split('.')
+            for doc, typed in accepted:
+                fk.setdefault(ref_tab, {}).setdefault((ref_col, typed[j]), []).append(doc['_id'])
+        for ref_tab, refs in fk.items():
+            engine.refs_add(f'{ref_tab}_fk', table, refs)
+
+    def delete(self, table, where) -> int:
+        '''
+            deletes the rows matching where, returns their number
+
+            A row still referenced by a foreign key stops the delete before
+            anything is removed. References are checked with one query per
+            referenced column and batch; index entries and rows are removed
+            with one bulk request per index and batch.
+        '''
+        tab = self.get_table(table)
+
+        tx = self.session.tx
+        if tx is not None:
+            # no need to validate 'where', select handles it
+            rows = list(self.select(table, ['*'], where))
+
+            # buffered inserts are dropped, stored rows deleted at commit;
+            # select passes buffered rows through as they are, so they are
+            # told apart from stored ones with the same key by identity
+            found = {id(row) for row in rows}
+            inserts = tx.inserts.get(table, [])
+            kept = [(row, values) for row, values in inserts if id(row) not in found]
+            if len(kept) != len(inserts):
+                tx.inserts[table] = kept
+            buffered = {id(row) for row, _ in inserts}
+            stored = {hashable(row['_id']): row for row in rows if id(row) not in buffered}
+            if len(stored) != 0:
+                tx.deletes.setdefault(table, {}).update(stored)
+            return len(rows)
+
+        with self.write_lock:
+            self.__check_unchanged(tab)
+            rows = list(self.select(table, ['*'], where))
+
+            # check if fk constraints let us delete
+            # dont delete anything until then
+            self.__check_delete(tab, rows)
+
+            with self.logged('delete', table, [row['_id'] for row in rows]):
+                self.__remove(tab, rows)
+
+        self.planner.stats.touch(table, len(rows))
+        return len(rows)
+
+    def __check_delete(self, tab, rows, deleted=None):
+        '''
+            raises FOREIGN_KEY_CONSTRAINT if a row is referenced, except by
+            rows of deleted {table: {hashable key: row}}
+
+            The counts of referencing rows are compared with those of the
+            deleted ones, the references themselves are not read.
+        '''
+        table = tab.name
+        deleted = deleted or {}
+        for col in tab.role('primary-key-unique') + tab.role('unique'):
+            name = col['name']
+            # referencing rows deleted too, by table and value
+            gone = {}
+            for other, rows_gone in deleted.items():
+                for ref in self.get_table(other).role('foreign-key'):
+                    if ref['reference'] == f'{table}.{name}':
+                        counts = gone.setdefault(other, {})
+                        for row in rows_gone.values():
+                            val = hashable(row[ref['name']])
+                            counts[val] = counts.get(val, 0) + 1
+            for values in batched({row[name] for row in rows}, self.batch_size):
+                for val, doc in self.engine.index_get(f'{table}_fk', name, values).items():
+                    for other, count in doc['counts'].items():
+                        if count > gone.get(other, {}).get(val, 0):
+                            raise ServerError(Error.FOREIGN_KEY_CONSTRAINT, f"{name}={doc['_id'][name]}")
+
+    def __remove(self, tab, rows, owned=True):
+        '''
+            deletes index entries, then rows; unless owned, unique entries
+            are only deleted where they point to the row
+        '''
+        for batch in batched(rows, self.batch_size):
+            self.__unindex(tab, batch, owned)
+            self.engine.delete(tab.name, [row['_id'] for row in batch])
+            # counts of values that may never have been added stay, they only cost a lookup
+            if owned:
+                self.__bloom_remove(tab, batch)
+
+    def __unindex(self, tab, rows, owned=True, columns=None):
+        '''
+            deletes the index entries of rows, only those of columns and
+            of the compound indexes holding them if given
+        '''
+        table = tab.name
+        kept = (lambda name: True) if columns is None else columns.__contains__
+        for col in tab.role('foreign-key'):
+            if not kept(col['name']):
+                continue
+            ref_tab, ref_col = col['reference'].split('.')
+            refs = {}
+            for row in rows:
+                refs.setdefault((ref_col, row[col['name']]), []).append(row['_id'])
+            self.engine.refs_remove(f'{ref_tab}_fk', table, refs)
+        for col in tab.role('unique'):
+            if not kept(col['name']):
+                continue
+            values = [row[col['name']] for row in rows]
+            if not owned:
+                keys = {hashable(row['_id']) for row in rows}
+                found = self.engine.index_get(f'{table}_uq', col['name'], values)
+                values = [val for val, doc in found.items() if hashable(doc['key']) in keys]
+            self.engine.index_delete(f'{table}_uq', col['name'], values)
+        for col in tab.role('index'):
+            if not kept(col['name']):
+                continue
+            nq = {}
+            for row in rows:
+                nq.setdefault((col['name'], row[col['name']]), []).append(row['_id'])
+            self.engine.index_pull(f'{table}_nq', 'keys', nq)
+        for index in self.__indexes(tab):
+            if any(map(kept, [*index.columns, *index.include])):
+                self.__pull(index, rows)
 
     #
     # UTILITY FUNCTIONS FOR SELECT
     #
 
-    def __join_tables(self, name1, name2, rows1, rows2):
-        rows = []
-        # for all pairs of rows
-        for r1 in rows1:
-            for r2 in rows2:
-                # execute join
-                joined = {}
-                for k1 in r1:
-                    if r2.get(k1) is not None:
-                        joined[f'{name1}.{k1}'] = r1[k1]
-                        joined[f'{name2}.{k1}'] = r2[k1]
-                        del r2[k1]
-                    else:
-                        joined[k1] = r1[k1]
-                for k2 in r2:
-                    joined[k2] = r2[k2]
-                rows.append(joined)
-        return rows
+    def resolve_column(self, tab_defs, name):
+        '''
+            returns (table, column) for a column of one of the tables in tab_defs,
+            name is either TABLE.COLUMN or a column name unique among the tables
+        '''
+        split = name.split('.')
+        if len(split) == 2 and split[0] in tab_defs:
+            tab, col = split
+            if tab_defs[tab].cols.get(col) is None:
+                raise ServerError(Error.INVALID_REFERENCE, f'ref: {name}')
+            return tab, col
+
+        ref = None
+        for tab in tab_defs.values():
+            if tab.cols.get(name) is not None:
+                if ref is not None:
+                    raise ServerError(Error.AMBIGUOUS_REFERENCE, name)
+                ref = (tab.name, name)
+        if ref is None:
+            raise ServerError(Error.INVALID_REFERENCE, f'ref: {",".join(tab_defs)}.{name}')
+        return ref
+
+    def is_indexed(self, tab, col_name):
+        match tab.cols[col_name]['role']:
+            case 'unique' | 'index' | 'foreign-key':
+                return True
+            case 'primary-key-unique':
+                return len(tab.keys) == 1
+        return False
+
+    def row_filter(self, tab, where):
+        '''
+            returns a predicate over reconstructed rows of tab that checks
+            the typed conditions of where
+        '''
+        checks = []
+        for name, cond in where.items():
+            if isinstance(cond, Range):
+                checks.append(lambda row, name=name, cond=cond: row[name] in cond)
+            else:
+                checks.append(lambda row, name=name, cond=cond: row[name] == cond)
+        return lambda row: all(check(row) for check in checks)
+
+    def range_keys(self, tab, col_name, rng) -> list:
+        '''
+            row keys of a unique or index column with values in rng,
+            read in value order from the ordered index
+        '''
+        if tab.cols[col_name]['role'] == 'unique':
+            docs = self.engine.index_range(f'{tab.name}_uq', col_name, rng.lo, rng.hi, rng.lo_incl, rng.hi_incl)
+            return [doc['key'] for doc in docs]
+        docs = self.engine.index_range(f'{tab.name}_nq', col_name, rng.lo, rng.hi, rng.lo_incl, rng.hi_incl)
+        return list(chain.from_iterable(doc['keys'] for doc in docs))
+
+    def compound_keys(self, tab, name, value) -> list:
+        '''
+            row keys holding value in the compound index name
+        '''
+        index = tab.indexes[name]
+        docs = self.engine.index_get(index.collection, name, [value]).values()
+        return [item['key'] for doc in docs for item in doc['rows']]
+
+    def index_keys(self, tab, col_name, values) -> dict | None:
+        '''
+            looks up several comparable values of an indexed column in one
+            round trip, returns {value: [row key, ..]}, or None if the column has no index
+        '''
+        table = tab.name
+        col = tab.cols[col_name]
+        values = list(values)
+        found = {}
+        match col['role']:
+            case 'unique':
+                for val, doc in self.engine.index_get(f'{table}_uq', col_name, values).items():
+                    found[val] = [doc['key']]
+            case 'index':
+                for val, doc in self.engine.index_get(f'{table}_nq', col_name, values).items():
+                    found[val] = doc['keys']
+            case 'foreign-key':
+                ref_tab, ref_col = col['reference'].split('.')
+                for val, keys in self.engine.refs_keys(f'{ref_tab}_fk', ref_col, table, values):
+                    found.setdefault(hashable(val), []).extend(keys)
+            case 'primary-key-unique' if len(tab.keys) == 1:
+                # the value is the row key, row existence is checked on fetch
+                found = {val: [val] for val in values}
+            case _:
+                return None
+        return found
+
+    def __scan(self, tab, where, plan=None, limit=None, offset=0, columns=None):
+        '''
+            yields the reconstructed rows of one table matching where,
+            skipping offset rows and stopping after limit rows
+
+            Rows read from a covering index hold only the columns it covers,
+            which include every filtered one and every one of columns.
+        '''
+        table = tab.name
+        if plan is None:
+            with phase('plan'):
+                plan = self.planner.plan(tab, where, columns)
+
+        tx = self.session.tx
+        if tx is not None and tx.touches(table):
+            # stored rows the transaction deleted give way to the ones it inserted
+            deleted = tx.deletes.get(table, {})
+            res = chain(
+                filter(lambda row: hashable(row['_id']) not in deleted, self.__read(tab, where, plan)),
+                filter(self.row_filter(tab, where), (row for row, _ in tx.inserts.get(table, []))))
+            return islice(res, offset, None if limit is None else offset + limit)
+        return self.__read(tab, where, plan, limit, offset)
+
+    def __read(self, tab, where, plan, limit=None, offset=0):
+        table = tab.name
+        filters = {name: where[name] for name in plan.filters}
+
+        if plan.covering is not None:
+            # the rows are in the index entry
+            index = tab.indexes[plan.covering]
+            docs = self.engine.index_get(index.collection, index.name, [plan.probes[0].value]).values()
+            res = filter(timed('filter', self.row_filter(tab, filters)), chain.from_iterable(map(index.rows, docs)))
+            return islice(res, offset, None if limit is None else offset + limit)
+
+        # construct query with indexes
+        if plan.key is not None:
+            keys = [plan.key]
+        elif len(plan.probes) != 0:
+            ids = None
+            for n, probe in enumerate(plan.probes):
+                # few enough candidates left, check the remaining probes as filters
+                if ids is not None and len(ids) <= PROBE_ROWS:
+                    for rest in plan.probes[n:]:
+                        filters.update((name, where[name]) for name in rest.columns)
+                    break
+
+                if probe.role == 'compound':
+                    keys = self.compound_keys(tab, probe.col, probe.value)
+                elif isinstance(probe.value, Range):
+                    keys = self.range_keys(tab, probe.col, probe.value)
+                else:
+                    found = self.index_keys(tab, probe.col, [probe.value])
+                    keys = next(iter(found.values()), [])
+
+                # if first loop then create new set, else intersect with newly found keys;
+                # a dict keeps the order of the first probe, ranges come in value order
+                if ids is None:
+                    ids = {hashable(key): key for key in keys}
+                else:
+                    keys = set(map(hashable, keys))
+                    ids = {h: key for h, key in ids.items() if h in keys}
+            keys = list(ids.values())
+        elif len(filters) == 0:
+            # without filters, the engine can skip and limit by itself
+            return map(timed('reconstruct', tab.reconstruct), self.engine.scan(table, offset, limit))
+        else:
+            keys = None
+
+        if keys is None and self.session.columnar:
+            # whole batches are filtered at once, only matching rows are reconstructed
+            res = columnar.scan(tab, self.engine.scan(table), filters, self.row_filter(tab, filters))
+            return islice(res, offset, None if limit is None else offset + limit)
+
+        res = self.engine.scan(table) if keys is None else self.engine.multi_get(table, keys)
+        res = filter(timed('filter', self.row_filter(tab, filters)), map(timed('reconstruct', tab.reconstruct), res))
+        return islice(res, offset, None if limit is None else offset + limit)
 
-    def __reconstruct_row(tab_def: dict, row):
-        keys = row['_id'].split('#')
-        vals = row['values'].split('#')
+    def __plan_join(self, tab_defs, filters, joins):
+        '''
+            orders the tables of a join and picks how each one is joined,
+            returns [(table, plan, strategy, conditions)]
 
-        doc = {'_id': row['_id']}
-        for tab in tab_def:
-            if tab['role'].startswith('primary-key'):
-                doc[tab['name']] = keys.pop(0)
+            Tables linked by an equality are joined with a hash join on the smaller
+            side, or with an index nested-loop join when the larger side's column
+            is indexed; unlinked tables produce a cross product.
+        '''
+        pending = list(tab_defs.values())
+        first = pending.pop(0)
+        plan = self.planner.plan(first, filters[first.name])
+        steps = [(first, plan, 'scan', [])]
+        joined = {first.name}
+        estimate = plan.estimate
+
+        while len(pending) != 0:
+            # prefer a table linked to what is already joined
+            tab = next((t for t in pending if any(
+                {l[0], r[0]} & joined and t.name in (l[0], r[0]) for l, r in joins)), pending[0])
+            pending.remove(tab)
+
+            # equalities between the joined tables and this one, as (TABLE.COLUMN, column)
+            conds = []
+            for left, right in joins:
+                if left[0] in joined and right[0] == tab.name:
+                    conds.append((f'{left[0]}.{left[1]}', right[1]))
+                elif right[0] in joined and left[0] == tab.name:
+                    conds.append((f'{right[0]}.{right[1]}', left[1]))
+            joined.add(tab.name)
+
+            plan = self.planner.plan(tab, filters[tab.name])
+            if len(conds) == 0:
+                strategy = 'cross'
+                estimate = estimate * plan.estimate
+            elif plan.estimate <= estimate:
+                strategy = 'hash'
+            elif len(conds) == 1 and self.is_indexed(tab, conds[0][1]) and not (
+                    self.session.tx is not None and self.session.tx.touches(tab.name)):
+                # the index does not know about rows buffered by a transaction
+                strategy = 'index nested-loop'
             else:
-                doc[tab['name']] = vals.pop(0)
-        return doc
+                strategy = 'hash build joined'
+            estimate = max(estimate, plan.estimate)
+            steps.append((tab, plan, strategy, conds))
+        return steps, estimate
+
+    def __join(self, steps, filters, joins):
+        '''
+            executes a join planned by __plan_join, yields rows with TABLE.COLUMN keys
+        '''
+        def scan(tab, plan):
+            prefix = f'{tab.name}.'
+            rows = self.__scan(tab, filters[tab.name], plan)
+            return map(lambda row: {prefix + col: val for col, val in row.items()}, rows)
+
+        rows = None
+        for tab, plan, strategy, conds in steps:
+            match strategy:
+                case 'scan':
+                    rows = scan(tab, plan)
+                case 'cross':
+                    rows = self.__cross_join(rows, scan(tab, plan))
+                case 'hash':
+                    rows = self.__hash_join(rows, scan(tab, plan), tab, conds, build_left=False)
+                case 'hash build joined':
+                    rows = self.__hash_join(rows, scan(tab, plan), tab, conds, build_left=True)
+                case 'index nested-loop':
+                    rows = self.__index_join(rows, tab, filters[tab.name], conds[0])
+
+        # equalities inside one table are checked last
+        post = [(f'{l[0]}.{l[1]}', f'{r[0]}.{r[1]}') for l, r in joins if l[0] == r[0]]
+        if len(post) != 0:
+            rows = filter(lambda row: all(row[l] == row[r] for l, r in post), rows)
+        return rows
+
+    def __cross_join(self, left, right):
+        right = list(right)
+        for r1 in left:
+            for r2 in right:
+                yield r1 | r2
+
+    def __hash_join(self, left, right, tab, conds, build_left):
+        left_cols = [left_col for left_col, _ in conds]
+        right_cols = [f'{tab.name}.{col}' for _, col in conds]
+
+        def left_key(row):
+            return tuple(row[c] for c in left_cols)
 
-    def select(self, table, columns, where):
-        table_names = table.split(',')
+        def right_key(row):
+            return tuple(row[c] for c in right_cols)
+
+        if build_left:
+            build, probe, build_key, probe_key = left, right, left_key, right_key
+        else:
+            build, probe, build_key, probe_key = right, left, right_key, left_key
+
+        table = {}
+        for row in build:
+            table.setdefault(build_key(row), []).append(row)
+
+        for row in probe:
+            for match in table.get(probe_key(row), ()):
+                yield match | row if build_left else row | match
+
+    def __index_join(self, left, tab, where, cond):
+        left_col, col = cond
+        prefix = f'{tab.name}.'
+        where_check = self.row_filter(tab, where)
+
+        # build on the joined rows, probe the index of the new table in batches
+        table = {}
+        for row in left:
+            table.setdefault(row[left_col], []).append(row)
+
+        for values in batched(table, self.batch_size):
+            found = self.index_keys(tab, col, values)
+            keys = {hashable(key): key for key in chain.from_iterable(found.values())}
+            docs = self.engine.multi_get(tab.name, keys.values())
+            for row in filter(where_check, map(tab.reconstruct, docs)):
+                wide = {prefix + c: v for c, v in row.items()}
+                for match in table.get(row[col], ()):
+                    yield match | wide
+
+    def __resolve_select(self, table, columns, where):
+        '''
+            returns (tab_defs, columns, conds, joins) of a select: conds are
+            [((table, column), condition as text)] filtering single tables,
+            joins [((table, column), (table, column))] equalities between them
+        '''
         tab_defs = {}
-        for tab_name in table_names:
-            tab_defs[tab_name] = self.read_table_dict(tab_name)
+        for tab_name in table.split(','):
+            tab_defs[tab_name] = self.get_table(tab_name)
 
         # check that projection columns and columns used in filtering actually exist
-        if '*' in columns:
-            to_check = where
-        else:
-            to_check = chain(columns, where)
+        if '*' not in columns:
+            columns = {col: self.resolve_column(tab_defs, col) for col in columns}
+
+        # split where into filters on each table and equalities between tables
+        conds = []
+        joins = []
+        for field, val in where.items():
+            ref = self.resolve_column(tab_defs, field)
+            other = val.split('.') if isinstance(val, str) else []
+            if len(tab_defs) > 1 and len(other) == 2 and other[0] in tab_defs:
+                joins.append((ref, self.resolve_column(tab_defs, val)))
+            else:
+                conds.append((ref, val))
+        return tab_defs, columns, conds, joins
+
+    def __parse_select(self, table, columns, where):
+        tab_defs, columns, conds, joins = self.__resolve_select(table, columns, where)
+        return tab_defs, columns, self.__filters(tab_defs, conds), joins
 
-        # check if each word refers to a column
-        for col in to_check:
-            ref = None
-            if self.is_reference_valid(col):
-                ref = self.get_reference(col)
+    def __filters(self, tab_defs, conds) -> dict:
+        '''
+            {table: {column: typed condition}} of the conds of a select
+        '''
+        filters = {name: {} for name in tab_defs}
+        for (tab, col), val in conds:
+            filters[tab][col] = tab_defs[tab].condition(col, val)
+        return filters
+
+    def select(self, table, columns, where, limit=None, offset=0, display=False):
+        '''
+            returns an iterator over the matching rows, rows are read from
+            the cursor only as the iterator is consumed
+
+            Values are those stored, ints, floats, strings and datetimes;
+            with display, dates are formatted the way they are inserted.
+        '''
+        tab_defs, columns, filters, joins = self.__parse_select(table, columns, where)
+        return self.__select(tab_defs, columns, filters, joins, limit, offset, display)
+
+    def __select(self, tab_defs, columns, filters, joins, limit=None, offset=0, display=False, plan=None):
+        if len(tab_defs) == 1:
+            tab = next(iter(tab_defs.values()))
+            needed = None if '*' in columns else {col for _, col in columns.values()}
+            res = self.__scan(tab, filters[tab.name], plan, limit, offset, needed)
+
+            # projection
+            if '*' not in columns:
+                res = map(lambda row: {name: row[col] for name, (_, col) in columns.items()}, res)
+                types = {name: tab.cols[col]['type'] for name, (_, col) in columns.items()}
             else:
-                for tab in tab_defs:
-                    if tab.get(col) is not None:
-                        if ref is not None:
-                            raise ServerError(Error.AMBIGUOUS_REFERENCE)
-                        else:
-                            ref = (tab, col)
-
-            if ref is None:
-                raise ServerError(Error.INVALID_REFERENCE, f'ref: {table}.{wh}')
-
-        def where_check(row):
-            return all(map(lambda field: str(row[field]) == str(where[field]), where))
-
-        # very inefficient
-        # TODO: think about providing a dictionary API to access column defs by name
-        def get_col_def(name):
-            for col in tab_def:
-                if col['name'] == name:
-                    return col
-            return None
+                types = self.__types(tab, lambda col: col)
+            return self.__display(res, types) if display else res
 
-        # check if all primary keys are present in search
-        key = []
-        complete = True
-        for col in tab_def:
-            match col['role']:
-                case 'primary-key-unique' | 'primary-key-not-unique':
-                    keyval = where.get(col['name'])
-                    if keyval is not None:
-                        key.append(keyval)
-                    else:
-                        complete = False
-                        break
-        if complete:
-            key = "#".join(key)
+        with phase('plan'):
+            steps, _ = self.__plan_join(tab_defs, filters, joins)
+        res = self.__join(steps, filters, joins)
+        res = islice(res, offset, None if limit is None else offset + limit)
+
+        # projection: qualify column names only where they collide
+        if '*' in columns:
+            seen = {}
+            for tab in tab_defs.values():
+                for col in chain(['_id'], tab.cols):
+                    seen[col] = seen.get(col, 0) + 1
+            names = {}
+            for tab in tab_defs.values():
+                for col in chain(['_id'], tab.cols):
+                    names[f'{tab.name}.{col}'] = col if seen[col] == 1 else f'{tab.name}.{col}'
+            res = map(lambda row: {names[col]: val for col, val in row.items()}, res)
+            types = {}
+            for tab in tab_defs.values():
+                types |= self.__types(tab, lambda col: names[f'{tab.name}.{col}'])
         else:
-            key = None
+            res = map(lambda row: {name: row[f'{tab}.{col}'] for name, (tab, col) in columns.items()}, res)
+            types = {name: tab_defs[tab].cols[col]['type'] for name, (tab, col) in columns.items()}
+        return self.__display(res, types) if display else res
 
-        # construct query with indexes
-        ids = None
-        to_delete = []
-        for col_name in where:
-            # bail early if we found a complete key
-            if key is not None:
-                break
+    def prepare(self, name, words) -> Statement:
+        '''
+            parses and resolves a select command with ? in place of values,
+            kept by the session under name; it is prepared again when it is
+            executed after the tables changed
+        '''
+        match words:
+            case ["select", cols, "from", table, *where_clause]:
+                where_clause, params = parameters(where_clause)
+            case _:
+                raise ServerError(Error.INVALID_COMMAND, f'prepare: {" ".join(words)}')
+        stmt = Statement(words, params, self.catalog)
+        cols, where, options = self.parse_select(cols, where_clause)
+        stmt.parsed = (table, cols, where, options)
+        if not is_aggregate(cols, options):
+            stmt.select = self.__resolve_select(table, cols, where)
+        self.session.statements[name] = stmt
+        return stmt
+
+    def statement(self, name) -> Statement:
+        stmt = self.session.statements.get(name)
+        if stmt is None:
+            raise ServerError(Error.DOES_NOT_EXIST, f'statement: {name}')
+        return stmt
+
+    def execute(self, name, values, display=False):
+        '''
+            returns an iterator over the rows of a prepared select for the
+            values of its parameters, like select
 
-            val = where[col_name]
-            keys = None
-            col = get_col_def(col_name)
+            A select of one table keeps the plan of its last execution for
+            the next ones, with the estimates made for the values it was
+            made for, until the statistics of the table are taken again or
+            a parameter changes from a value to a range or back.
+        '''
+        stmt = self.statement(name)
+        if len(values) != stmt.params:
+            raise ServerError(Error.INVALID_NUMBER_OF_FIELDS, f'{len(values)} of {stmt.params} values')
+        if stmt.catalog is not self.catalog or stmt.version != self.catalog.version:
+            stmt = self.prepare(name, stmt.words)
+
+        table, cols, where, options = stmt.parsed
+        if stmt.select is None:
+            where = {name: bind(cond, values) for name, cond in where.items()}
+            return self.aggregate(table, cols, where, options.get('group', []),
+                                  options.get('limit'), options.get('offset', 0), display)
+
+        tab_defs, columns, conds, joins = stmt.select
+        filters = self.__filters(tab_defs, [(ref, bind(val, values)) for ref, val in conds])
+        plan = None
+        if len(tab_defs) == 1:
+            tab = next(iter(tab_defs.values()))
+            where = filters[tab.name]
+            stats = self.planner.stats.current(tab.name)
+            shape = {name: isinstance(cond, Range) for name, cond in where.items()}
+            with phase('plan'):
+                if stmt.plan is not None and stmt.stats is stats and stmt.shape == shape:
+                    plan = stmt.plan.bind(tab, where)
+                else:
+                    needed = None if '*' in columns else {col for _, col in columns.values()}
+                    plan = self.planner.plan(tab, where, needed)
+                    stmt.plan, stmt.stats, stmt.shape = plan, stats, shape
+        return self.__select(tab_defs, columns, filters, joins, options.get('limit'), options.get('offset', 0),
+                             display, plan)
+
+    def __types(self, tab, name):
+        '''
+            {output name: column type} of every column of a table, and of
+            the row key when it is the value of a single column
+        '''
+        types = {name(col): col_def['type'] for col, col_def in tab.cols.items()}
+        if len(tab.keys) == 1:
+            types[name('_id')] = tab.keys[0]['type']
+        return types
+
+    def __display(self, rows, types):
+        dates = {name: col_type for name, col_type in types.items() if col_type in ('date', 'datetime')}
+        if len(dates) == 0:
+            return rows
+        return map(lambda row: row | {name: parser.format_value(row[name], col_type)
+                                      for name, col_type in dates.items()}, rows)
+
+    def open_cursor(self, rows) -> int:
+        '''
+            keeps a select result on the server to be paged through with fetch
+        '''
+        session = self.session
+        session.cursor_id += 1
+        session.cursors[session.cursor_id] = rows
+        # forget the oldest cursors first
+        while len(session.cursors) > MAX_CURSORS:
+            del session.cursors[next(iter(session.cursors))]
+        return session.cursor_id
+
+    def fetch(self, cursor, count, emit) -> bool:
+        '''
+            emits up to count more rows of a cursor, returns whether rows remain
+        '''
+        rows = self.cursors.get(cursor)
+        if rows is None:
+            raise ServerError(Error.DOES_NOT_EXIST, f'cursor: {cursor}')
+        for row in islice(rows, count):
+            emit(row)
+
+        # peek, so that an exhausted cursor is closed right away
+        row = next(rows, None)
+        if row is None:
+            del self.cursors[cursor]
+            return False
+        self.cursors[cursor] = chain([row], rows)
+        return True
 
-            # check if indexed
-            match col['role']:
-                case 'unique':
-                    keys = self.idb[f'{table}_uq'].find_one({'_id': {col_name: val}})
-                    if keys is not None:
-                        keys = [keys["key"]]
+    def explain(self, table, columns, where, group=None) -> str:
+        '''
+            describes how select would run, without running it
+        '''
+        if is_aggregate(columns, {} if group is None else {'group': group}):
+            tab_defs, _, filters, joins = self.__parse_select(table, ['*'], where)
+            groups, aggs = self.__parse_aggregate(tab_defs, columns, group or [])
+            strategy, _ = self.__aggregation(table, tab_defs, filters, where, groups, aggs)
+            match strategy:
                 case 'index':
-                    keys = self.idb[f'{table}_nq'].find_one({'_id': {col_name: val}})
-                    if keys is not None:
-                        keys = keys['keys']
-                case 'foreign-key':
-                    ref_tab, ref_col = col['reference'].split('.')
-                    keys = self.idb[f'{ref_tab}_fk'].find_one({'_id': {ref_col: val}})
-                    if keys is not None:
-                        keys = filter(lambda doc: doc['table'] == table, keys['refs'])
-                        keys = map(lambda doc: doc['key'], keys)
-                case _:
-                    continue
-
-            # index assumed to exist and be valid
-            to_delete.append(col_name)
+                    return f'{table}: count from index entries'
+                case 'engine':
+                    return f'{table}: aggregate in engine'
+            needed = {f'{ref[0]}.{ref[1]}' for _, _, ref in aggs if ref is not None}
+            needed |= {f'{ref[0]}.{ref[1]}' for ref in groups.values()}
+            return f'{self.explain(table, sorted(needed), where)} -> aggregate'
+
+        tab_defs, columns, filters, joins = self.__parse_select(table, columns, where)
+
+        if len(tab_defs) == 1:
+            tab = next(iter(tab_defs.values()))
+            needed = None if '*' in columns else {col for _, col in columns.values()}
+            return self.planner.plan(tab, filters[tab.name], needed).describe()
+
+        steps, estimate = self.__plan_join(tab_defs, filters, joins)
+        desc = []
+        for tab, plan, strategy, conds in steps:
+            on = ','.join(f'{left}={tab.name}.{col}' for left, col in conds)
+            desc.append(f'{strategy} {on} [{plan.describe()}]'.replace('  ', ' '))
+        return f'{"; ".join(desc)}; est {estimate:.3g} rows'
+
+    def aggregate(self, table, columns, where, group=(), limit=None, offset=0, display=False):
+        '''
+            returns an iterator over one row per group of the rows matching
+            where, in group order; columns are group columns and aggregates:
+            count(*), count(COL), sum(COL), min(COL), max(COL) or avg(COL)
 
-            # no keys to merge with previously found
-            if keys is None:
-                ids = set()
+            Without group there is exactly one row, count is 0 and the other
+            aggregates None when no row matches. Rows are never collected,
+            only the aggregates of each group.
+        '''
+        tab_defs, _, filters, joins = self.__parse_select(table, ['*'], where)
+        groups, aggs = self.__parse_aggregate(tab_defs, columns, group)
+        _, run = self.__aggregation(table, tab_defs, filters, where, groups, aggs)
+        res = sorted(run(), key=lambda entry: entry[0])
+        if len(groups) == 0 and len(res) == 0:
+            res = [([], [finish(func, None) for _, func, _ in aggs])]
+
+        types = {}
+        for name in columns:
+            ref = groups.get(name)
+            agg = next((agg for agg in aggs if agg[0] == name), None)
+            if agg is not None and agg[1] in ('min', 'max'):
+                ref = agg[2]
+            if ref is not None:
+                types[name] = tab_defs[ref[0]].cols[ref[1]]['type']
+
+        # (is aggregate, position) of every column
+        positions = {name: (False, i) for i, name in enumerate(groups)}
+        positions |= {agg[0]: (True, i) for i, agg in enumerate(aggs)}
+        layout = [(name, *positions[name]) for name in columns]
+        res = ({name: (aggregates if is_agg else values)[i] for name, is_agg, i in layout}
+               for values, aggregates in res)
+        res = islice(res, offset, None if limit is None else offset + limit)
+        return self.__display(res, types) if display else res
+
+    def __parse_aggregate(self, tab_defs, columns, group) -> (dict, list):
+        '''
+            returns groups, {name: (table, column)} of the group columns, and
+            aggregates, [(name, function, (table, column) or None for *)]
+        '''
+        groups = {name: self.resolve_column(tab_defs, name) for name in group}
+        aggs = []
+        for name in columns:
+            parsed = AGGREGATE.match(name)
+            if parsed is None:
+                if name not in groups:
+                    raise ServerError(Error.INVALID_COMMAND, f'not grouped: {name}')
+                continue
+            func, arg = parsed.groups()
+            if arg == '*':
+                if func != 'count':
+                    raise ServerError(Error.INVALID_COMMAND, name)
+                aggs.append((name, func, None))
                 continue
+            ref = self.resolve_column(tab_defs, arg)
+            if func in ('sum', 'avg') and tab_defs[ref[0]].cols[ref[1]]['type'] not in ('int', 'bit', 'float'):
+                raise ServerError(Error.INVALID_TYPE, name)
+            aggs.append((name, func, ref))
+        return groups, aggs
 
-            # if first loop then create new set, else intersect with newly found keys
-            if ids is None:
-                ids = set(keys)
-            else:
-                ids.intersect_update(keys)
+    def __aggregation(self, table, tab_defs, filters, where, groups, aggs):
+        '''
+            returns (strategy, run) of an aggregate select, run returns
+            [([group value, ..], [aggregate, ..])] in any order
 
-        # delete fields searched with index
-        for field in to_delete:
-            del where[field]
+            index:  counts read from index entries, without touching the rows
+            engine: aggregated by the engine where the rows are stored
+            stream: the selected rows folded as they are read
+        '''
+        def stream():
+            names = [f'{ref[0]}.{ref[1]}' for ref in groups.values()]
+            inputs = [None if ref is None else f'{ref[0]}.{ref[1]}' for _, _, ref in aggs]
+            needed = sorted({*names, *filter(None, inputs)})
+            found = {}
+            for row in self.select(table, needed, where):
+                values = [row[name] for name in names]
+                entry = found.setdefault(tuple(map(hashable, values)), (values, [None] * len(aggs)))
+                for i, (_, func, _) in enumerate(aggs):
+                    entry[1][i] = fold(func, entry[1][i], None if inputs[i] is None else row[inputs[i]])
+            return [(values, [finish(func, acc) for (_, func, _), acc in zip(aggs, accs)])
+                    for values, accs in found.values()]
+
+        if len(tab_defs) == 1:
+            tab = next(iter(tab_defs.values()))
+            tx = self.session.tx
+            if tx is None or not tx.touches(tab.name):
+                tab_where = filters[tab.name]
+                group = [col for _, col in groups.values()]
+                if all(func == 'count' for _, func, _ in aggs):
+                    counts = self.__index_counts(tab, tab_where, group)
+                    if counts is not None:
+                        return 'index', lambda: [(list(values), [rows] * len(aggs)) for values, rows in counts()]
+
+                # the engine scans without shipping the rows, indexes would
+                # narrow them down before they are read
+                with phase('plan'):
+                    plan = self.planner.plan(tab, tab_where)
+                if plan.access == 'scan' and self.engine.aggregates:
+                    fields = [(func, None if func == 'count' else tab.field(ref[1])) for _, func, ref in aggs]
+                    conds = [(tab.field(name), cond) for name, cond in tab_where.items()]
+
+                    def pushed():
+                        res = self.engine.aggregate(tab.name, conds, [tab.field(col) for col in group], fields)
+                        return stream() if res is None else res
+                    return 'engine', pushed
+
+        return 'stream', stream
+
+    def __index_counts(self, tab, where, group):
+        '''
+            returns a function yielding ((group value, ..), rows) of the rows
+            matching where, counted from index entries alone; None if the
+            indexes cannot answer where and group
+        '''
+        if any(col not in group for col in where) and len(group) != 0:
+            return None
+        if len(group) > 1:
+            return None
 
-        # query
-        if key is not None:
-            query_doc = {'_id': key}
-        if ids is not None:
-            query_doc = {'_id': {'$in': list(ids)}}
+        if len(group) == 1:
+            name = group[0]
+            if tab.cols[name]['role'] not in ('unique', 'index', 'foreign-key'):
+                return None
+            return lambda: (((val,), rows) for val, rows in self.__value_counts(tab, name, where.get(name)))
+
+        if len(where) == 0:
+            return lambda: [((), self.engine.count(tab.name))]
+        if all(not isinstance(cond, Range) for cond in where.values()):
+            for index in tab.ready.values():
+                if set(index.columns) == set(where):
+                    return lambda: [((), len(self.compound_keys(tab, index.name, index.value(where))))]
+        if len(where) == 1:
+            (name, cond), = where.items()
+            role = tab.cols[name]['role']
+            if role in ('unique', 'index', 'foreign-key') or (
+                    role == 'primary-key-unique' and len(tab.keys) == 1 and not isinstance(cond, Range)):
+                return lambda: [((), sum(rows for _, rows in self.__value_counts(tab, name, cond)))]
+        return None
+
+    def __value_counts(self, tab, name, cond):
+        '''
+            yields (value, rows) of the values of an indexed column matching
+            cond, a value, a Range or None for every value
+        '''
+        col = tab.cols[name]
+        if col['role'] == 'primary-key-unique':
+            for val in self.existing_values(tab.name, name, [cond]):
+                yield val, 1
+            return
+
+        field = name
+        match col['role']:
+            case 'unique':
+                index, count = f'{tab.name}_uq', lambda doc: 1
+            case 'index':
+                index, count = f'{tab.name}_nq', lambda doc: len(doc['keys'])
+            case 'foreign-key':
+                ref_tab, field = col['reference'].split('.')
+                index, count = f'{ref_tab}_fk', lambda doc: doc['counts'].get(tab.name, 0)
+
+        if cond is None:
+            docs = self.engine.index_range(index, field)
+        elif isinstance(cond, Range):
+            docs = self.engine.index_range(index, field, cond.lo, cond.hi, cond.lo_incl, cond.hi_incl)
         else:
-            query_doc = {}
+            docs = self.engine.index_get(index, field, [cond]).values()
+        for doc in docs:
+            rows = count(doc)
+            # entries whose rows were all deleted may be left behind
+            if rows != 0:
+                yield doc['_id'][field], rows
+
+    def parse_where(self, where_clause):
+        '''
+            returns (where, options) of a where clause
 
-        res = self.db[table].find(query_doc)
-        res = filter(lambda doc: doc["values"] != "", res)
-        res = [reconstruct_row(row) for row in res]
+            Conditions are VAR=VAL, VAR<VAL, VAR<=VAL, VAR>VAL, VAR>=VAL and
+            VAR between LO and HI, optionally joined by and. Comparisons become
+            ranges; a column compared more than once gets a list of conditions.
+            options are the trailing limit, offset and page numbers, and the
+            columns of group by.
+        '''
+        match where_clause:
+            case ["where", *_]:
+                where_clause = where_clause[1:]
+
+        where = {}
+        options = {}
+        words = iter(where_clause)
+        for word in words:
+            if word == 'and':
+                continue
+            if word in ('limit', 'offset', 'page'):
+                num = next(words, '')
+                if not num.isdigit():
+                    raise ServerError(Error.INVALID_COMMAND, f'{word} {num}')
+                options[word] = int(num)
+                continue
+            if word == 'group':
+                match [next(words, ''), next(words, '')]:
+                    case ['by', cols] if len(cols) != 0:
+                        options['group'] = cols.split(',')
+                    case _:
+                        raise ServerError(Error.INVALID_COMMAND, 'group by')
+                continue
 
-        # filter
-        res = list(filter(lambda row: where_check(row), res))
+            comparison = COMPARISON.match(word)
+            if comparison is not None:
+                name, op, val = comparison.groups()
+                match op:
+                    case '=':
+                        cond = val
+                    case '<':
+                        cond = Range(hi=val, hi_incl=False)
+                    case '<=':
+                        cond = Range(hi=val)
+                    case '>':
+                        cond = Range(lo=val, lo_incl=False)
+                    case '>=':
+                        cond = Range(lo=val)
+            else:
+                match [word, next(words, ''), next(words, ''), next(words, ''), next(words, '')]:
+                    case [name, 'between', lo, 'and', hi] if len(lo) != 0 and len(hi) != 0:
+                        cond = Range(lo, hi)
+                    case _:
+                        raise ServerError(Error.INVALID_COMMAND, f'where: {word}')
+
+            if name not in where:
+                where[name] = cond
+            elif isinstance(where[name], list):
+                where[name].append(cond)
+            else:
+                where[name] = [where[name], cond]
+        return where, options
 
-        # ugly projection
-        if '*' not in columns:
-            for rowi in range(len(res)):
-                row = res[rowi]
-                keys = list(row.keys())
-                for col in keys:
-                    if col not in columns:
-                        del row[col]
-        return res
+    def parse_select(self, cols, where_clause):
+        '''
+            returns (columns, where, options) of a select command
+        '''
+        cols = cols.split(',')
+        if '*' in cols:
+            cols = ['*']
+        where, options = self.parse_where(where_clause)
+        return cols, where, options
 
-    def run_command(self, command) -> (int, str):
+    def run_command(self, command, emit=print) -> (int, str):
         '''
-            returns (code, message)
+            returns (code, message), result rows are passed to emit one by one
 
-            create_database DATABASE
+            create_database DATABASE [ mongo, local ]
             drop_database DATABASE
             use_database DATABASE
             create_table TABLE
             create_column TABLE CNAME CTYPE [ primary-key-unique,
-                primary-key-not-unique, foreign-key=TABLE.COLNAME, unique, index, none ]
+                primary-key-not-unique, foreign-key=TABLE.COLNAME, unique, index, none ] [ default VALUE ]
+            create_index TABLE NAME COL,.. [ include COL,.. ]
+            drop_index TABLE NAME
             drop_table TABLE
             insert into TABLE values VALUES#..
-            delete TABLE [ where VAR=VAL .. ]
-            select [ * | COL,.. ] from TABLE [ where VAR=VAL .. ]
+            bulk_insert into TABLE values VALUES#..;VALUES#..;.. [ batch SIZE ]
+            load TABLE FILE [ format csv, jsonl ]
+            delete TABLE [ where COND .. ]
+            select [ * | COL,.. | AGG,.. ] from TABLE [ where COND .. ] [ group by COL,.. ]
+                [ limit N ] [ offset N ] [ page N ]
+            fetch CURSOR N
+            close CURSOR
+            begin
+            commit
+            rollback
+            stats
+            profile [ on, off ]
+            columnar [ on, off ]
+            format [ text, binary [ zlib, lz4 ] ]
+            explain select [ * | COL,.. | AGG,.. ] from TABLE [ where COND .. ] [ group by COL,.. ]
+            prepare NAME select [ * | COL,.. | AGG,.. ] from TABLE [ where COND .. ] ..
+            execute NAME [ VAL .. ]
+            deallocate NAME
+
+            COND is VAR=VAL, VAR<VAL, VAR<=VAL, VAR>VAL, VAR>=VAL or
+            VAR between LO and HI, conditions may be joined by and
+
+            AGG is count(*), count(COL), sum(COL), min(COL), max(COL) or
+            avg(COL); the other selected columns must be grouped by
+
+            A prepared select has ? in place of the values of its conditions,
+            VAR=?, VAR<? or VAR between ? and ?; execute gives them in order.
+
+            Between begin and commit, inserts and deletes are buffered and
+            seen only by the session; their constraints are checked at commit.
+            The session cannot switch or drop its database until then.
+
+            With profile on, the message of every response of the session ends
+            with where the time of the command went. With columnar on, the
+            session filters rows no index narrows down in vectorized batches.
+            With format binary, framed responses send their rows in batches,
+            optionally compressed; text is the default.
         '''
+        profile = Profile(self.session.profile)
+        token = current_profile.set(profile)
+        profiler = start_profiler() if self.profile_sample > random.random() else None
+        start = perf_counter()
+        try:
+            code, message = self.__dispatch(command, timed('send', emit))
+        finally:
+            elapsed = perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+            current_profile.reset(token)
+
+        ms = elapsed * 1000
+        kind = command.split(maxsplit=1)[0] if len(command.strip()) != 0 else ''
+        self.metrics.record(kind, ms, profile.round_trips)
+        if self.slow_log.is_slow(ms):
+            dump = None if profiler is None else self.slow_log.dump(profiler, kind)
+            database = None if self.database is None else self.database[0]
+            self.slow_log.write(command, database, ms, profile, dump)
+        if profile.detailed:
+            message = f'{message} | {profile.describe(elapsed)}'.lstrip(' |')
+        return code, message
+
+    def __dispatch(self, command, emit) -> (int, str):
         try:
             match command.split():
                 case ["create_database", db]:
                     self.create_database(db)
+                case ["create_database", db, engine]:
+                    self.create_database(db, engine)
                 case ["drop_database", db]:
                     self.drop_database(db)
                 case ["use_database", db]:
@@ -465,37 +2305,112 @@ class Server:
                         "primary-key-unique", "primary-key-not-unique",
                         "foreign-key", "unique", "index", "none"]:
                     self.create_column(table, col_name, col_type, index_type)
+                case ["create_column", table, col_name, col_type, index_type, "default", default] if (
+                        index_type.split('=')[0] in ["foreign-key", "unique", "index", "none"]):
+                    self.create_column(table, col_name, col_type, index_type, default)
                 case ["drop_table", table]:
                     self.drop_table(table)
+                case ["create_index", table, name, cols]:
+                    rows = self.create_index(table, name, cols.split(','))
+                    return int(Error.SUCCESS), f'{rows} rows indexed'
+                case ["create_index", table, name, cols, "include", include]:
+                    rows = self.create_index(table, name, cols.split(','), include.split(','))
+                    return int(Error.SUCCESS), f'{rows} rows indexed'
+                case ["drop_index", table, name]:
+                    self.drop_index(table, name)
                 case ["insert", "into", table, "values", values]:
                     values = values.split('#')
                     self.insert(table, values)
+                case ["bulk_insert", "into", table, "values", rows, *opts]:
+                    match opts:
+                        case []:
+                            batch_size = None
+                        case ["batch", size] if size.isdigit() and int(size) > 0:
+                            batch_size = int(size)
+                        case _:
+                            return int(Error.INVALID_COMMAND), command
+                    rows = [row.split('#') for row in rows.split(';') if len(row) > 0]
+                    inserted, errors = self.bulk_insert(table, rows, batch_size)
+                    message = f'{inserted} inserted, {len(errors)} rejected'
+                    for i, code, msg in errors:
+                        message += f'; row {i}: {Error(code).name} {msg}'.rstrip()
+                    if len(errors) != 0:
+                        return int(errors[0][1]), message
+                    return int(Error.SUCCESS), message
+                case ["load", table, path, *opts]:
+                    match opts:
+                        case []:
+                            fmt = None
+                        case ["format", fmt]:
+                            pass
+                        case _:
+                            return int(Error.INVALID_COMMAND), command
+                    inserted, errors = self.load_file(table, path, fmt)
+                    message = f'{inserted} inserted, {len(errors)} rejected'
+                    for i, code, msg in errors[:LOAD_ERRORS]:
+                        message += f'; row {i}: {Error(code).name} {msg}'.rstrip()
+                    if len(errors) > LOAD_ERRORS:
+                        message += f'; .. {len(errors) - LOAD_ERRORS} more'
+                    if len(errors) != 0:
+                        return int(errors[0][1]), message
+                    return int(Error.SUCCESS), message
                 case ["delete", table, *where_clause]:
-                    match where_clause:
-                        case ["where", *_]:
-                            where_clause = where_clause[1:]
-                    where = {}
-                    for k, v in map(lambda w: w.split('='), where_clause):
-                        where[k] = v
+                    where, options = self.parse_where(where_clause)
+                    if len(options) != 0:
+                        return int(Error.INVALID_COMMAND), command
                     self.delete(table, where)
                 case ["select", cols, "from", table, *where_clause]:
-                    match where_clause:
-                        case ["where", *_]:
-                            where_clause = where_clause[1:]
-                    where_clause = filter(lambda st: "and" not in st, where_clause)
-                    cols = cols.split(',')
-                    if '*' in cols:
-                        cols = ['*']
-
-                    where = {}
-                    split = map(lambda w: w.split('='), where_clause)
-                    for arr in split:
-                        k, v = arr
-                        where[k] = v
-
-                    rows = self.select(table, cols, where)
-                    for row in rows:
-                        print(row)
+                    cols, where, options = self.parse_select(cols, where_clause)
+                    if is_aggregate(cols, options):
+                        rows = self.aggregate(table, cols, where, options.get('group', []),
+                                              options.get('limit'), options.get('offset', 0), display=True)
+                    else:
+                        rows = self.select(table, cols, where,
+                                           options.get('limit'), options.get('offset', 0), display=True)
+                    return self.__send(rows, options, emit)
+                case ["prepare", name, *select]:
+                    stmt = self.prepare(name, select)
+                    return int(Error.SUCCESS), f'{stmt.params} parameters'
+                case ["execute", name, *values]:
+                    rows = self.execute(name, values, display=True)
+                    return self.__send(rows, self.statement(name).parsed[3], emit)
+                case ["deallocate", name]:
+                    if self.session.statements.pop(name, None) is None:
+                        raise ServerError(Error.DOES_NOT_EXIST, f'statement: {name}')
+                case ["fetch", cursor, count] if cursor.isdigit() and count.isdigit():
+                    if self.fetch(int(cursor), int(count), emit):
+                        return int(Error.SUCCESS), f'cursor {cursor}'
+                case ["stats"]:
+                    for row in self.stats():
+                        emit(row)
+                case ["profile", state] if state in ("on", "off"):
+                    self.session.profile = state == "on"
+                case ["columnar", state] if state in ("on", "off"):
+                    if state == "on" and not columnar.available():
+                        raise ServerError(Error.INVALID_COMMAND, 'columnar: numpy is not installed')
+                    self.session.columnar = state == "on"
+                case ["format", "text"]:
+                    self.session.binary = False
+                    self.session.compression = None
+                case ["format", "binary", *compression] if len(compression) <= 1:
+                    if len(compression) != 0 and compression[0] not in compressions():
+                        raise ServerError(Error.INVALID_COMMAND, f'format: {compression[0]} is not available')
+                    self.session.binary = True
+                    self.session.compression = compression[0] if len(compression) != 0 else None
+                    return int(Error.SUCCESS), encoding()
+                case ["begin"]:
+                    self.begin()
+                case ["commit"]:
+                    inserted, deleted = self.commit()
+                    return int(Error.SUCCESS), f'{inserted} inserted, {deleted} deleted'
+                case ["rollback"]:
+                    self.rollback()
+                case ["close", cursor] if cursor.isdigit():
+                    if self.cursors.pop(int(cursor), None) is None:
+                        raise ServerError(Error.DOES_NOT_EXIST, f'cursor: {cursor}')
+                case ["explain", "select", cols, "from", table, *where_clause]:
+                    cols, where, options = self.parse_select(cols, where_clause)
+                    return int(Error.SUCCESS), self.explain(table, cols, where, options.get('group'))
                 case _ :
                     # if command == "SECTION":
                     #     breakpoint()
@@ -503,53 +2418,214 @@ class Server:
 
         except ServerError as e:
             return e.code, e.message
-        except pymongo.errors.DuplicateKeyError as e:
-            return Error.DUPLICATE_KEY, ""
+        return int(Error.SUCCESS), ""
+
+    def __send(self, rows, options, emit) -> (int, str):
+        '''
+            emits the rows of a select, or its first page with page in options
+        '''
+        if 'page' not in options:
+            for row in rows:
+                emit(row)
+        else:
+            cursor = self.open_cursor(rows)
+            if self.fetch(cursor, options['page'], emit):
+                return int(Error.SUCCESS), f'cursor {cursor}'
         return int(Error.SUCCESS), ""
 
     def run(self, io_read, io_write, io_log=None):
         if io_log is None:
             io_log = io_write
 
-        # for line in io_read:
-        while True:
-            if io_read.seekable():
-                cur_pos = io_read.tell()
-            line = io_read.readline()[:-1]
-            if io_read.seekable() and cur_pos == io_read.tell():
-                break
+        # flush after every command only when someone is typing them
+        interactive = io_read.isatty()
+        pending = 0
 
+        for line in io_read:
             line = line.strip()
             if len(line) == 0:
                 continue
 
-            code, message = self.run_command(line)
-            message = f'[{Error(code).name}] {message}\n'
+            code, message = self.run_command(line, lambda row: io_write.write(encode_row(None, row)))
+            message = encode_status(None, Error(code).name, 0, message)
             if code != Error.SUCCESS:
                 io_log.write(message)
-                io_log.flush()
             else:
                 io_write.write(message)
+
+            pending += 1
+            if interactive or pending >= FLUSH_LINES:
                 io_write.flush()
+                io_log.flush()
+                pending = 0
 
-    def listen(self, address=('localhost', 25565)):
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.bind(address)
-        sock.listen(5)
-        print(f'Server running on {address}')
+        io_write.flush()
+        io_log.flush()
+
+    def listen(self, address=('localhost', 25565), max_connections=64, workers=8):
+        '''
+            serves clients concurrently, each with its own session
 
-        with sock:
+            Commands run on a pool of worker threads, since engines block.
+            A worker producing rows faster than its client reads them waits
+            for the socket to drain.
+        '''
+        asyncio.run(self.serve(address, max_connections, workers))
+
+    async def serve(self, address, max_connections, workers):
+        self.executor = ThreadPoolExecutor(workers)
+        self.max_connections = max_connections
+        self.connections = 0
+
+        sock = await asyncio.start_server(self.__handle, *address, limit=MAX_LINE)
+        print(f'Server running on {address}')
+        async with sock:
+            await sock.serve_forever()
+
+    async def __handle(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        if self.connections >= self.max_connections:
+            writer.write(encode_status(None, Error.TOO_MANY_CONNECTIONS.name, 0, '').encode())
+            await writer.drain()
+            writer.close()
+            return
+
+        self.connections += 1
+        print(f'{addr} connected')
+        loop = asyncio.get_running_loop()
+        session = Session()
+
+        # responses are queued and written by one task, which sends whatever
+        # piled up while it waited in a single write; a full queue makes the
+        # worker producing rows wait for the client to read
+        queue = asyncio.Queue(SEND_QUEUE)
+
+        async def sender():
             while True:
-                s, addr = sock.accept()
-                print(f'{addr} connected')
-                with s:
-                    s_rd = s.makefile('r')
-                    s_wr = s.makefile('w')
-                    self.run(s_rd, s_wr)
-                print(f'{addr} disconnected')
+                batch = [await queue.get()]
+                while not queue.empty():
+                    batch.append(queue.get_nowait())
+                writer.write(b''.join(filter(None, batch)))
+                await writer.drain()
+                if batch[-1] is None:
+                    return
+
+        async def put(data):
+            # a sender stopped by a lost connection no longer drains the queue
+            if not send.done():
+                pending = asyncio.ensure_future(queue.put(data))
+                await asyncio.wait([pending, send], return_when=asyncio.FIRST_COMPLETED)
+                if pending.done():
+                    return
+                pending.cancel()
+            raise ConnectionError('connection lost')
+
+        def execute(line):
+            # runs on a worker, rows are queued in chunks as they are produced
+            current_session.set(session)
+            rid, command = decode_request(line)
+            chunk = []
+            size = 0
+            count = 0
+            columns = None
+            batch = []
+
+            def emit(row):
+                nonlocal count, columns
+                count += 1
+                if rid is None or not session.binary:
+                    add(encode_row(rid, row).encode())
+                    return
+                if columns is None or len(row) != len(columns) or any(a != b for a, b in zip(row, columns)):
+                    send_batch()
+                    columns = list(row)
+                    add(encode_header(rid, columns))
+                batch.append(list(row.values()))
+                if len(batch) >= BATCH_ROWS:
+                    send_batch()
+
+            def send_batch():
+                nonlocal batch
+                if len(batch) != 0:
+                    add(encode_batch(rid, batch, session.compression))
+                    batch = []
+
+            def add(data):
+                nonlocal size
+                chunk.append(data)
+                size += len(data)
+                if size >= SEND_CHUNK:
+                    flush()
+
+            def flush():
+                nonlocal chunk, size
+                asyncio.run_coroutine_threadsafe(put(b''.join(chunk)), loop).result()
+                chunk = []
+                size = 0
+
+            code, message = self.run_command(command, emit)
+            send_batch()
+            chunk.append(encode_status(rid, Error(code).name, count, message).encode())
+            return b''.join(chunk)
+
+        send = asyncio.create_task(sender())
+        try:
+            while len(line := await reader.readline()) > 0:
+                line = line.decode().strip()
+                if len(line) == 0:
+                    continue
+                ctx = contextvars.copy_context()
+                data = await loop.run_in_executor(self.executor, ctx.run, execute, line)
+                await put(data)
+            await put(None)
+            await send
+        except (ConnectionError, asyncio.LimitOverrunError, ValueError) as e:
+            print(f'{addr} dropped: {e}')
+        finally:
+            send.cancel()
+            self.connections -= 1
+            session.close()
+            writer.close()
+            print(f'{addr} disconnected')
+
+
+def load(argv) -> int:
+    '''
+        python server.py load DATABASE TABLE FILE [options]
+
+        Fails with DATABASE_IN_USE while a server has the database open;
+        the load command of the server does the same load through it.
+    '''
+    args = argparse.ArgumentParser(prog='server.py load', description='bulk load a CSV or JSONL file into a table')
+    args.add_argument('database')
+    args.add_argument('table')
+    args.add_argument('file')
+    args.add_argument('--format', choices=sorted(set(loader.FORMATS.values())), help='by default, from the file extension')
+    args.add_argument('--workers', type=int, help='parsing processes, one per cpu by default')
+    args.add_argument('--writers', type=int, default=LOAD_WRITERS, help='writing threads')
+    args.add_argument('--batch', type=int, help='rows per chunk and write')
+    args = args.parse_args(argv)
+
+    server = Server(os.getcwd())
+    progress = loader.Progress()
+    try:
+        server.use_database(args.database)
+        inserted, errors = server.load_file(args.table, args.file, args.format, args.workers, args.writers,
+                                            args.batch, progress)
+    except ServerError as e:
+        print(f'[{Error(e.code).name}] {e.message}'.rstrip(), file=stderr)
+        return 1
+    for i, code, msg in errors[:10]:
+        print(f'row {i}: {Error(code).name} {msg}'.rstrip(), file=stderr)
+    if len(errors) > 10:
+        print(f'.. {len(errors) - 10} more rejected', file=stderr)
+    print(progress.line(inserted, len(errors)), file=stderr)
+    return 0 if len(errors) == 0 else 1
 
 
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == 'load':
+        sys.exit(load(sys.argv[2:]))
     server = Server(os.getcwd())
     if len(sys.argv) > 1:
         for path in sys.argv[1:]:
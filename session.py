@@ -0,0 +1,80 @@
+import contextvars
+
+
+class Transaction:
+    '''
+        writes of a session buffered between begin and commit
+
+        inserts: table -> [(row, values)] in insert order, row as select
+                 returns it and values as they were given
+        deletes: table -> {hashable key: row} of stored rows
+    '''
+
+    def __init__(self):
+        self.inserts = {}
+        self.deletes = {}
+
+    def touches(self, table):
+        return table in self.inserts or table in self.deletes
+
+
+class Statement:
+    '''
+        select prepared by a session, made for one version of the catalog
+
+        words:  the select command, with ? in place of its parameters
+        params: number of parameters
+        parsed: (table, columns, where, options) of the select
+        select: (tab_defs, columns, conds, joins) of a select of rows
+        plan:   plan of the last execution reading one table, with the
+                statistics and the shape of the conditions it was made for
+    '''
+
+    def __init__(self, words, params, catalog):
+        self.words = words
+        self.params = params
+        self.catalog = catalog
+        self.version = catalog.version
+        self.parsed = None
+        self.select = None
+        self.plan = None
+        self.stats = None
+        self.shape = None
+
+
+class Session:
+    '''
+        state of one client: the database in use and its open cursors
+    '''
+
+    def __init__(self):
+        self.database = None  # (name, path) of the database in use
+        self.engine = None  # holds storage of current db
+        self.catalog = None  # holds table definitions of current db
+        self.wal = None  # write-ahead log of current db, None when disabled
+        self.cursors = {}  # cursor id -> remaining rows of a paged select
+        self.cursor_id = 0
+        self.tx = None  # open transaction, if any
+        self.profile = False  # report timings with every response
+        self.columnar = False  # filter full scans column by column
+        self.binary = False  # send results in batches, see protocol
+        self.compression = None  # of binary batches, None to send them as they are
+        self.statements = {}  # name -> prepared Statement
+
+    def close(self):
+        '''
+            forgets the database in use and what was made in it; options
+            set by the client stay
+        '''
+        self.database = None
+        self.engine = None
+        self.catalog = None
+        self.wal = None
+        self.cursors = {}
+        self.tx = None
+        self.statements = {}
+
+
+# session of the command being run; commands run outside of any
+# connection use the server's default session
+current_session = contextvars.ContextVar('session')
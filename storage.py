@@ -0,0 +1,985 @@
+'''
+    storage engines
+
+    An engine stores one database: tables of row documents keyed by their
+    primary key, and the index collections kept next to them. A row key is
+    a single value, or a dict of the values of a composite primary key.
+    Index entries are documents keyed by (column, value):
+
+        TABLE_uq  unique index       (col, val) -> {'key': row key}
+        TABLE_nq  not unique index   (col, val) -> {'keys': [row key, ..]}
+        TABLE_fk  referenced column  (col, val) -> {'counts': {referencing table: rows, ..}}
+
+    and those of compound indexes, described in catalog.Index. The keys of
+    the rows referencing a value are kept apart, in buckets of at most
+    BUCKET_KEYS keys per value and referencing table, in TABLE_fk.REFTABLE;
+    entries holding them all in one 'refs' list are converted by
+    refs_convert.
+
+    MongoEngine keeps them in a mongo database and its '_DATABASE_index'
+    companion. LocalEngine keeps them in the server process, backed by
+    append-only files under the database directory.
+'''
+import mmap
+import os
+import pickle
+import shutil
+import struct
+import threading
+from bisect import bisect_left, bisect_right, insort
+from error import Error, ServerError
+from itertools import chain, islice
+from parser import Range
+
+try:
+    import pymongo
+    from pymongo import MongoClient, UpdateOne, WriteConcern
+except ImportError:  # only the local engine is available
+    pymongo = None
+
+ENGINES = ['mongo', 'local']
+DEFAULT_ENGINE = os.getenv('PYTHONDB_ENGINE', 'local' if pymongo is None else 'mongo')
+ENGINE_FILE = 'engine'  # names the engine of a database, inside its directory
+BUCKET_KEYS = 1024  # row keys per bucket of the rows referencing a value
+SCAN_CHUNK = 1024  # keys a local scan takes at once
+
+
+class Engine:
+    aggregates = False  # aggregate runs next to the rows
+
+    #
+    # ROWS
+    #
+
+    def get(self, table, key) -> dict | None:
+        raise NotImplementedError
+
+    def multi_get(self, table, keys):
+        '''
+            yields the rows of the keys that exist
+        '''
+        raise NotImplementedError
+
+    def put(self, table, doc):
+        '''
+            inserts a row, raises DUPLICATE_KEY if its key is taken
+        '''
+        raise NotImplementedError
+
+    def put_many(self, table, docs):
+        raise NotImplementedError
+
+    def replace_many(self, table, docs):
+        '''
+            writes rows over the stored rows of their keys
+        '''
+        raise NotImplementedError
+
+    def delete(self, table, keys):
+        raise NotImplementedError
+
+    def scan(self, table, offset=0, limit=None):
+        raise NotImplementedError
+
+    def match_keys(self, table, col, values) -> set:
+        '''
+            returns the values found as part col of a composite row key
+        '''
+        raise NotImplementedError
+
+    def count(self, table) -> int:
+        raise NotImplementedError
+
+    def aggregate(self, table, match, group, fields) -> list | None:
+        '''
+            aggregates the rows where they are stored, for engines with
+            aggregates set; returns None if some rows cannot be aggregated
+            there. Paths name values in a row document, see catalog.Table.field
+
+            match:  [(path, value or Range)] the rows must satisfy
+            group:  [path] of the values rows are grouped by
+            fields: [(func, path or None)], func one of count, sum, min, max, avg
+
+            returns [([group value, ..], [field value, ..])], one per group
+        '''
+        return None
+
+    def drop(self, table):
+        raise NotImplementedError
+
+    #
+    # INDEXES
+    #
+
+    def index_get(self, index, col, values) -> dict:
+        '''
+            returns {value: entry} for the values that have an entry,
+            values that are documents are keyed by hashable(value)
+        '''
+        raise NotImplementedError
+
+    def index_insert(self, index, col, entries):
+        '''
+            creates the entries of {value: entry}
+        '''
+        raise NotImplementedError
+
+    def index_delete(self, index, col, values):
+        raise NotImplementedError
+
+    def index_push(self, index, field, items):
+        '''
+            appends to the list field of {(col, value): [item, ..]},
+            creating missing entries
+        '''
+        raise NotImplementedError
+
+    def index_add(self, index, field, items):
+        '''
+            like index_push, leaving out the items a list already holds
+        '''
+        raise NotImplementedError
+
+    def index_pull(self, index, field, items):
+        '''
+            removes from the list field of {(col, value): [item, ..]}
+        '''
+        raise NotImplementedError
+
+    def index_purge(self, index, col, field, item):
+        '''
+            removes the items with the fields of item from the list field
+            of every entry of col
+        '''
+        raise NotImplementedError
+
+    def index_count(self, index, col, field, item=None) -> int:
+        '''
+            number of entries of col whose list field is not empty, or
+            holds an item with the fields of item when given
+        '''
+        raise NotImplementedError
+
+    def index_range(self, index, col, lo=None, hi=None, lo_incl=True, hi_incl=True):
+        '''
+            yields the entries of col with values between lo and hi in
+            value order, a bound of None leaves that side open
+        '''
+        raise NotImplementedError
+
+    def refs_add(self, index, table, refs):
+        '''
+            adds {(col, value): [row key, ..]} of rows of table referencing
+            each value to its last bucket, starting another when it is full,
+            and to the counts of the entry of the value
+        '''
+        raise NotImplementedError
+
+    def refs_remove(self, index, table, refs):
+        '''
+            removes {(col, value): [row key, ..]}, the counts go down by
+            the keys found
+        '''
+        raise NotImplementedError
+
+    def refs_keys(self, index, col, table, values):
+        '''
+            yields (value, [row key, ..]) of the rows of table referencing
+            values, one bucket at a time
+        '''
+        raise NotImplementedError
+
+    def refs_count(self, index, col, table) -> int:
+        '''
+            number of values of col referenced by rows of table
+        '''
+        raise NotImplementedError
+
+    def refs_purge(self, index, table):
+        '''
+            forgets every row of table referencing index
+        '''
+        raise NotImplementedError
+
+    def refs_convert(self, index):
+        '''
+            moves the keys of entries holding a 'refs' list into buckets
+        '''
+        raise NotImplementedError
+
+    def index_bounds(self, index, col) -> tuple | None:
+        '''
+            returns the (smallest, largest) value of col, None if it has no entries
+        '''
+        raise NotImplementedError
+
+    def drop_index(self, index):
+        raise NotImplementedError
+
+    def drop_database(self):
+        raise NotImplementedError
+
+    def sync(self):
+        '''
+            returns once every write made so far is durable
+        '''
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class MongoEngine(Engine):
+    '''
+        journal=False leaves durability to the server's write-ahead log,
+        writes are acknowledged before mongo journals them
+    '''
+    aggregates = True
+
+    def __init__(self, client, database, journal=True):
+        self.client = client
+        self.database = database
+        concern = WriteConcern(w=1, j=journal)
+        self.db = client.get_database(database, write_concern=concern)
+        self.idb = client.get_database(f'_{database}_index', write_concern=concern)
+        self.ordered = set()  # (collection, col) known to have a mongo index on _id.col
+        self.current = set()  # tables known to hold no rows of the '#'-joined format
+
+    def get(self, table, key):
+        return self.db[table].find_one({'_id': key})
+
+    def multi_get(self, table, keys):
+        return self.db[table].find({'_id': {'$in': list(keys)}})
+
+    def put(self, table, doc):
+        try:
+            self.db[table].insert_one(doc)
+        except pymongo.errors.DuplicateKeyError:
+            raise ServerError(Error.DUPLICATE_KEY)
+
+    def put_many(self, table, docs):
+        try:
+            self.db[table].insert_many(docs, ordered=False)
+        except pymongo.errors.BulkWriteError:
+            raise ServerError(Error.DUPLICATE_KEY)
+
+    def replace_many(self, table, docs):
+        self.db[table].bulk_write([pymongo.ReplaceOne({'_id': doc['_id']}, doc) for doc in docs], ordered=False)
+
+    def delete(self, table, keys):
+        self.db[table].delete_many({'_id': {'$in': list(keys)}})
+
+    def scan(self, table, offset=0, limit=None):
+        res = self.db[table].find()
+        if offset:
+            res = res.skip(offset)
+        if limit is not None:
+            res = res.limit(limit)
+        return res
+
+    def match_keys(self, table, col, values):
+        if (table, col) not in self.ordered:
+            self.db[table].create_index(f'_id.{col}')
+            self.ordered.add((table, col))
+        docs = self.db[table].find({f'_id.{col}': {'$in': list(values)}}, {'_id': 1})
+        return {doc['_id'][col] for doc in docs}
+
+    def count(self, table):
+        return self.db[table].estimated_document_count()
+
+    def aggregate(self, table, match, group, fields):
+        if table not in self.current:
+            # rows written as '#'-joined strings have no paths to aggregate
+            if self.db[table].find_one({'v': {'$exists': False}}, {'_id': 1}) is not None:
+                return None
+            self.current.add(table)
+
+        def expr(path):
+            # a path into an array selects from every element in expressions
+            if path.startswith('v.'):
+                return {'$arrayElemAt': ['$v', int(path[2:])]}
+            return f'${path}'
+
+        query = {}
+        for path, cond in match:
+            if isinstance(cond, Range):
+                query[path] = {}
+                if cond.lo is not None:
+                    query[path]['$gte' if cond.lo_incl else '$gt'] = cond.lo
+                if cond.hi is not None:
+                    query[path]['$lte' if cond.hi_incl else '$lt'] = cond.hi
+            else:
+                query[path] = cond
+        stage = {'_id': {f'g{i}': expr(path) for i, path in enumerate(group)}}
+        for i, (func, path) in enumerate(fields):
+            stage[f'f{i}'] = {'$sum': 1} if func == 'count' else {f'${func}': expr(path)}
+        docs = self.db[table].aggregate([{'$match': query}, {'$group': stage}])
+        return [([doc['_id'][f'g{i}'] for i in range(len(group))], [doc[f'f{i}'] for i in range(len(fields))])
+                for doc in docs]
+
+    def drop(self, table):
+        self.db[table].drop()
+        self.ordered = {entry for entry in self.ordered if entry[0] != table}
+        self.current.discard(table)
+
+    def index_get(self, index, col, values):
+        docs = self.idb[index].find({'_id': {'$in': [{col: val} for val in values]}})
+        # documents come back as dicts, which cannot be keys
+        return {hashable(doc['_id'][col]): doc for doc in docs}
+
+    def index_insert(self, index, col, entries):
+        try:
+            self.idb[index].insert_many(
+                [{'_id': {col: val}} | entry for val, entry in entries.items()], ordered=False)
+        except pymongo.errors.BulkWriteError:
+            raise ServerError(Error.DUPLICATE_UNIQUE)
+
+    def index_delete(self, index, col, values):
+        self.idb[index].delete_many({'_id': {'$in': [{col: val} for val in values]}})
+
+    def index_push(self, index, field, items):
+        if len(items) != 0:
+            self.idb[index].bulk_write(
+                [UpdateOne({'_id': {col: val}}, {'$push': {field: {'$each': list(vals)}}}, upsert=True)
+                 for (col, val), vals in items.items()], ordered=False)
+
+    def index_add(self, index, field, items):
+        if len(items) != 0:
+            self.idb[index].bulk_write(
+                [UpdateOne({'_id': {col: val}}, {'$addToSet': {field: {'$each': list(vals)}}}, upsert=True)
+                 for (col, val), vals in items.items()], ordered=False)
+
+    def index_pull(self, index, field, items):
+        if len(items) != 0:
+            self.idb[index].bulk_write(
+                [UpdateOne({'_id': {col: val}}, {'$pull': {field: {'$in': list(vals)}}})
+                 for (col, val), vals in items.items()], ordered=False)
+
+    def index_purge(self, index, col, field, item):
+        self.idb[index].update_many({f'_id.{col}': {'$exists': True}}, {'$pull': {field: item}})
+
+    def index_count(self, index, col, field, item=None):
+        query = {f'_id.{col}': {'$exists': True}}
+        if item is None:
+            query[f'{field}.0'] = {'$exists': True}
+        else:
+            query.update({f'{field}.{name}': val for name, val in item.items()})
+        return self.idb[index].count_documents(query)
+
+    def __ordered(self, index, col):
+        # range scans walk a sorted index on the value, made on first use
+        if (index, col) not in self.ordered:
+            self.idb[index].create_index(f'_id.{col}')
+            self.ordered.add((index, col))
+        return self.idb[index]
+
+    def index_range(self, index, col, lo=None, hi=None, lo_incl=True, hi_incl=True):
+        cond = {'$exists': True}
+        if lo is not None:
+            cond['$gte' if lo_incl else '$gt'] = lo
+        if hi is not None:
+            cond['$lte' if hi_incl else '$lt'] = hi
+        return self.__ordered(index, col).find({f'_id.{col}': cond}).sort(f'_id.{col}', 1)
+
+    def __buckets(self, index, table):
+        # buckets are found by column and value, with a mongo index made on first use
+        name = f'{index}.{table}'
+        if (name, 'c') not in self.ordered:
+            self.idb[name].create_index([('c', 1), ('v', 1)])
+            self.ordered.add((name, 'c'))
+        return self.idb[name]
+
+    def refs_add(self, index, table, refs):
+        if len(refs) == 0:
+            return
+        requests = []
+        for (col, val), keys in refs.items():
+            for i in range(0, len(keys), BUCKET_KEYS):
+                chunk = list(keys[i:i + BUCKET_KEYS])
+                # a bucket with room for the chunk, or a new one
+                room = {f'keys.{BUCKET_KEYS - len(chunk)}': {'$exists': False}}
+                requests.append(UpdateOne({'c': col, 'v': val} | room, {'$push': {'keys': {'$each': chunk}}},
+                                          upsert=True))
+        self.__buckets(index, table).bulk_write(requests)
+        self.idb[index].bulk_write(
+            [UpdateOne({'_id': {col: val}}, {'$inc': {f'counts.{table}': len(keys)}}, upsert=True)
+             for (col, val), keys in refs.items()], ordered=False)
+
+    def refs_remove(self, index, table, refs):
+        if len(refs) == 0:
+            return
+        buckets = self.__buckets(index, table)
+        drop = {(col, hashable(val)): {hashable(key) for key in keys} for (col, val), keys in refs.items()}
+        found = {}
+        ids = []
+        requests = []
+        for doc in buckets.find({'$or': [{'c': col, 'v': val, 'keys': {'$in': list(keys)}}
+                                         for (col, val), keys in refs.items()]}):
+            entry = (doc['c'], hashable(doc['v']))
+            gone = [key for key in doc['keys'] if hashable(key) in drop[entry]]
+            found[entry] = found.get(entry, 0) + len(gone)
+            ids.append(doc['_id'])
+            requests.append(UpdateOne({'_id': doc['_id']}, {'$pull': {'keys': {'$in': gone}}}))
+        if len(requests) == 0:
+            return
+        buckets.bulk_write(requests, ordered=False)
+        buckets.delete_many({'_id': {'$in': ids}, 'keys': {'$size': 0}})
+        self.idb[index].bulk_write(
+            [UpdateOne({'_id': {col: val}}, {'$inc': {f'counts.{table}': -found[(col, hashable(val))]}})
+             for (col, val) in refs if (col, hashable(val)) in found], ordered=False)
+
+    def refs_keys(self, index, col, table, values):
+        for doc in self.__buckets(index, table).find({'c': col, 'v': {'$in': list(values)}}):
+            yield doc['v'], doc['keys']
+
+    def refs_count(self, index, col, table):
+        return self.idb[index].count_documents({f'_id.{col}': {'$exists': True}, f'counts.{table}': {'$gt': 0}})
+
+    def refs_purge(self, index, table):
+        self.idb[f'{index}.{table}'].drop()
+        self.ordered.discard((f'{index}.{table}', 'c'))
+        self.idb[index].update_many({f'counts.{table}': {'$exists': True}}, {'$unset': {f'counts.{table}': ''}})
+
+    def refs_convert(self, index):
+        coll = self.idb[index]
+        for doc in coll.find({'refs': {'$exists': True}}):
+            (col, val), = doc['_id'].items()
+            keys = {}
+            for ref in doc['refs']:
+                keys.setdefault(ref['table'], []).append(ref['key'])
+            # buckets written over, in case a conversion was cut short
+            for table, refs in keys.items():
+                buckets = self.__buckets(index, table)
+                buckets.delete_many({'c': col, 'v': val})
+                buckets.insert_many([{'c': col, 'v': val, 'keys': refs[i:i + BUCKET_KEYS]}
+                                     for i in range(0, len(refs), BUCKET_KEYS)])
+            coll.update_one({'_id': doc['_id']}, {'$set': {'counts': {table: len(refs) for table, refs in keys.items()}},
+                                                  '$unset': {'refs': ''}})
+
+    def index_bounds(self, index, col):
+        coll = self.__ordered(index, col)
+        query = {f'_id.{col}': {'$exists': True}}
+        first = next(coll.find(query).sort(f'_id.{col}', 1).limit(1), None)
+        if first is None:
+            return None
+        last = next(coll.find(query).sort(f'_id.{col}', -1).limit(1))
+        return first['_id'][col], last['_id'][col]
+
+    def drop_index(self, index):
+        buckets = [name for name in self.idb.list_collection_names() if name.startswith(f'{index}.')]
+        for name in [index, *buckets]:
+            self.idb[name].drop()
+        self.ordered = {entry for entry in self.ordered if entry[0] != index and entry[0] not in buckets}
+
+    def drop_database(self):
+        self.client.drop_database(self.database)
+        self.client.drop_database(f'_{self.database}_index')
+
+    def sync(self):
+        self.client.admin.command('fsync')
+
+
+class Collection:
+    '''
+        documents of one local collection
+
+        Documents live in a dict; every change is appended to a log file as
+        a length-prefixed pickle of (key, document), None deleting the key.
+        The log is mapped and replayed on open, and rewritten with only the
+        live documents once it grows well past them.
+
+        Keys are also listed in the order they were added, deleted ones
+        leaving an empty place until the list is rebuilt, so that scans
+        can read them a chunk at a time while others write.
+    '''
+
+    COMPACT_RATIO = 2
+    COMPACT_MIN = 4096
+
+    def __init__(self, path):
+        self.path = path
+        self.data = {}
+        self.records = 0
+        self.lock = threading.RLock()
+        if os.path.exists(path):
+            self.__replay()
+        self.__reorder()
+        self.log = open(path, 'ab')
+
+    def __replay(self):
+        size = os.path.getsize(self.path)
+        pos = 0
+        if size != 0:
+            with open(self.path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+                while pos + 4 <= size:
+                    length, = struct.unpack_from('>I', buf, pos)
+                    if pos + 4 + length > size:
+                        break
+                    key, doc = pickle.loads(buf[pos + 4:pos + 4 + length])
+                    pos += 4 + length
+                    if doc is None:
+                        self.data.pop(key, None)
+                    else:
+                        self.data[key] = doc
+                    self.records += 1
+        # drop a record torn by a crash
+        if pos != size:
+            with open(self.path, 'r+b') as f:
+                f.truncate(pos)
+
+    @staticmethod
+    def __record(key, doc):
+        data = pickle.dumps((key, doc), pickle.HIGHEST_PROTOCOL)
+        return struct.pack('>I', len(data)) + data
+
+    def write(self, changes):
+        '''
+            applies [(key, document or None)]
+        '''
+        with self.lock:
+            self.log.write(b''.join(self.__record(key, doc) for key, doc in changes))
+            self.log.flush()
+            for key, doc in changes:
+                if doc is None:
+                    if self.data.pop(key, None) is not None:
+                        self.order[self.place.pop(key)] = None
+                else:
+                    if key not in self.data:
+                        self.place[key] = len(self.order)
+                        self.order.append(key)
+                    self.data[key] = doc
+            self.records += len(changes)
+            if self.records > self.COMPACT_RATIO * len(self.data) + self.COMPACT_MIN:
+                self.__compact()
+            if len(self.order) > self.COMPACT_RATIO * len(self.data) + self.COMPACT_MIN:
+                self.__reorder()
+
+    def __reorder(self):
+        # a new list, scans keep reading the one they started with
+        self.order = list(self.data)
+        self.place = {key: i for i, key in enumerate(self.order)}
+
+    def __compact(self):
+        tmp = f'{self.path}.tmp'
+        with open(tmp, 'wb') as f:
+            for key, doc in self.data.items():
+                f.write(self.__record(key, doc))
+        self.log.close()
+        os.replace(tmp, self.path)
+        self.log = open(self.path, 'ab')
+        self.records = len(self.data)
+
+    def items(self):
+        '''
+            yields the (key, document) pairs stored when it starts and
+            still stored when it gets to them
+        '''
+        with self.lock:
+            order = self.order
+            end = len(order)
+        for start in range(0, end, SCAN_CHUNK):
+            with self.lock:
+                keys = order[start:min(start + SCAN_CHUNK, end)]
+            for key in keys:
+                doc = None if key is None else self.data.get(key)
+                if doc is not None:
+                    yield key, doc
+
+    def sync(self):
+        with self.lock:
+            os.fsync(self.log.fileno())
+
+    def close(self):
+        self.log.close()
+
+
+def hashable(key):
+    if isinstance(key, dict):
+        return tuple((k, hashable(v)) for k, v in key.items())
+    if isinstance(key, list):
+        return tuple(map(hashable, key))
+    return key
+
+
+class LocalEngine(Engine):
+    '''
+        embedded engine, no round trips and no outside service
+
+        Every collection is held in memory once it is used, so a database
+        has to fit in the memory of the server; the files only make it
+        durable.
+
+        Range scans use a sorted list of the values of an index column,
+        built on first use and kept up to date by the index writes.
+    '''
+
+    def __init__(self, path):
+        self.path = os.path.join(path, 'data')
+        self.lock = threading.Lock()
+        self.tables = {}
+        self.indexes = {}
+        self.ordered = {}  # (index, col) -> sorted values
+        for kind in ('tables', 'indexes'):
+            os.makedirs(os.path.join(self.path, kind), exist_ok=True)
+
+    def __open(self, kind, name) -> Collection:
+        colls = getattr(self, kind)
+        coll = colls.get(name)
+        if coll is None:
+            with self.lock:
+                coll = colls.get(name)
+                if coll is None:
+                    coll = Collection(os.path.join(self.path, kind, f'{name}.log'))
+                    colls[name] = coll
+        return coll
+
+    def __table(self, name):
+        return self.__open('tables', name)
+
+    def __index(self, name):
+        return self.__open('indexes', name)
+
+    def __drop(self, kind, name):
+        with self.lock:
+            coll = getattr(self, kind).pop(name, None)
+            if coll is not None:
+                coll.close()
+            path = os.path.join(self.path, kind, f'{name}.log')
+            if os.path.exists(path):
+                os.remove(path)
+
+    def get(self, table, key):
+        return self.__table(table).data.get(hashable(key))
+
+    def multi_get(self, table, keys):
+        data = self.__table(table).data
+        for key in keys:
+            doc = data.get(hashable(key))
+            if doc is not None:
+                yield doc
+
+    def put(self, table, doc):
+        self.put_many(table, [doc])
+
+    def put_many(self, table, docs):
+        coll = self.__table(table)
+        changes = [(hashable(doc['_id']), doc) for doc in docs]
+        with coll.lock:
+            if any(key in coll.data for key, _ in changes) or len({key for key, _ in changes}) != len(changes):
+                raise ServerError(Error.DUPLICATE_KEY)
+            coll.write(changes)
+
+    def replace_many(self, table, docs):
+        coll = self.__table(table)
+        with coll.lock:
+            coll.write([(hashable(doc['_id']), doc) for doc in docs if hashable(doc['_id']) in coll.data])
+
+    def delete(self, table, keys):
+        coll = self.__table(table)
+        coll.write([(key, None) for key in map(hashable, keys) if key in coll.data])
+
+    def scan(self, table, offset=0, limit=None):
+        docs = (doc for _, doc in self.__table(table).items())
+        yield from islice(docs, offset, None if limit is None else offset + limit)
+
+    def match_keys(self, table, col, values):
+        values = set(values)
+        found = set()
+        for key, _ in self.__table(table).items():
+            part = dict(key)[col]
+            if part in values:
+                found.add(part)
+        return found
+
+    def count(self, table):
+        return len(self.__table(table).data)
+
+    def drop(self, table):
+        self.__drop('tables', table)
+
+    def index_get(self, index, col, values):
+        data = self.__index(index).data
+        found = {}
+        for val in values:
+            key = hashable(val)
+            doc = data.get((col, key))
+            if doc is not None:
+                found[key] = doc
+        return found
+
+    def index_insert(self, index, col, entries):
+        coll = self.__index(index)
+        changes = [((col, hashable(val)), {'_id': {col: val}} | entry) for val, entry in entries.items()]
+        with coll.lock:
+            if any(key in coll.data for key, _ in changes):
+                raise ServerError(Error.DUPLICATE_UNIQUE)
+            coll.write(changes)
+            self.__reorder(index, col, added=[key[1] for key, _ in changes])
+
+    def index_delete(self, index, col, values):
+        coll = self.__index(index)
+        with coll.lock:
+            keys = [key for key in ((col, hashable(val)) for val in values) if key in coll.data]
+            coll.write([(key, None) for key in keys])
+            self.__reorder(index, col, removed=[key[1] for key in keys])
+
+    def index_push(self, index, field, items):
+        coll = self.__index(index)
+        with coll.lock:
+            changes = []
+            for (col, val), vals in items.items():
+                key = (col, hashable(val))
+                doc = coll.data.get(key)
+                if doc is None:
+                    doc = {'_id': {col: val}, field: []}
+                    self.__reorder(index, col, added=[key[1]])
+                # copy on write, readers may hold the previous document
+                changes.append((key, doc | {field: doc[field] + list(vals)}))
+            coll.write(changes)
+
+    def index_add(self, index, field, items):
+        coll = self.__index(index)
+        with coll.lock:
+            changes = []
+            for (col, val), vals in items.items():
+                key = (col, hashable(val))
+                doc = coll.data.get(key)
+                if doc is None:
+                    doc = {'_id': {col: val}, field: []}
+                    self.__reorder(index, col, added=[key[1]])
+                held = set(map(hashable, doc[field]))
+                added = []
+                for v in vals:
+                    if hashable(v) not in held:
+                        held.add(hashable(v))
+                        added.append(v)
+                if len(added) != 0 or key not in coll.data:
+                    changes.append((key, doc | {field: doc[field] + added}))
+            coll.write(changes)
+
+    def index_pull(self, index, field, items):
+        coll = self.__index(index)
+        with coll.lock:
+            changes = []
+            for (col, val), vals in items.items():
+                key = (col, hashable(val))
+                doc = coll.data.get(key)
+                if doc is not None:
+                    drop = set(map(hashable, vals))
+                    changes.append((key, doc | {field: [v for v in doc[field] if hashable(v) not in drop]}))
+            coll.write(changes)
+
+    def index_purge(self, index, col, field, item):
+        coll = self.__index(index)
+        with coll.lock:
+            changes = []
+            for key, doc in coll.data.items():
+                if key[0] != col:
+                    continue
+                kept = [v for v in doc[field] if not all(v.get(k) == val for k, val in item.items())]
+                if len(kept) != len(doc[field]):
+                    changes.append((key, doc | {field: kept}))
+            coll.write(changes)
+
+    def index_count(self, index, col, field, item=None):
+        count = 0
+        for (name, _), doc in list(self.__index(index).data.items()):
+            if name != col:
+                continue
+            if item is None:
+                count += len(doc[field]) != 0
+            else:
+                count += any(all(v.get(k) == val for k, val in item.items()) for v in doc[field])
+        return count
+
+    def __reorder(self, index, col, added=(), removed=()):
+        # called holding the lock of the index collection
+        values = self.ordered.get((index, col))
+        if values is None:
+            return
+        for val in removed:
+            i = bisect_left(values, val)
+            if i < len(values) and values[i] == val:
+                del values[i]
+        for val in added:
+            insort(values, val)
+
+    def __sorted(self, index, col):
+        coll = self.__index(index)
+        with coll.lock:
+            values = self.ordered.get((index, col))
+            if values is None:
+                values = sorted(val for name, val in coll.data if name == col)
+                self.ordered[(index, col)] = values
+        return coll, values
+
+    def index_range(self, index, col, lo=None, hi=None, lo_incl=True, hi_incl=True):
+        coll, values = self.__sorted(index, col)
+        with coll.lock:
+            start = 0 if lo is None else (bisect_left if lo_incl else bisect_right)(values, lo)
+            end = len(values) if hi is None else (bisect_right if hi_incl else bisect_left)(values, hi)
+            # a copy, writers keep the list sorted in place
+            values = values[start:end]
+        for val in values:
+            doc = coll.data.get((col, val))
+            if doc is not None:
+                yield doc
+
+    def refs_add(self, index, table, refs):
+        heads, buckets = self.__index(index), self.__index(f'{index}.{table}')
+        with heads.lock, buckets.lock:
+            changes = []
+            added = []
+            for (col, val), keys in refs.items():
+                key = (col, hashable(val))
+                head = heads.data.get(key)
+                if head is None:
+                    head = {'_id': {col: val}, 'counts': {}, 'buckets': {}}
+                    self.__reorder(index, col, added=[key[1]])
+                n = max(1, head['buckets'].get(table, 0))
+                bucket = list(buckets.data.get((*key, n - 1), {'keys': []})['keys'])
+                for row_key in keys:
+                    if len(bucket) == BUCKET_KEYS:
+                        changes.append(((*key, n - 1), {'keys': bucket}))
+                        n += 1
+                        bucket = []
+                    bucket.append(row_key)
+                changes.append(((*key, n - 1), {'keys': bucket}))
+                counts = head['counts']
+                added.append((key, head | {'counts': counts | {table: counts.get(table, 0) + len(keys)},
+                                           'buckets': head['buckets'] | {table: n}}))
+            buckets.write(changes)
+            heads.write(added)
+
+    def refs_remove(self, index, table, refs):
+        heads, buckets = self.__index(index), self.__index(f'{index}.{table}')
+        with heads.lock, buckets.lock:
+            changes = []
+            removed = []
+            for (col, val), keys in refs.items():
+                key = (col, hashable(val))
+                head = heads.data.get(key)
+                if head is None:
+                    continue
+                drop = set(map(hashable, keys))
+                n = head['buckets'].get(table, 0)
+                found = 0
+                left = []
+                for i in range(n):
+                    bucket = buckets.data.get((*key, i), {'keys': []})['keys']
+                    kept = [row_key for row_key in bucket if hashable(row_key) not in drop]
+                    if len(kept) != len(bucket):
+                        found += len(bucket) - len(kept)
+                        changes.append(((*key, i), {'keys': kept}))
+                    left.append(len(kept))
+                # trailing empty buckets go, the last one is filled next
+                while n > 0 and left[n - 1] == 0:
+                    n -= 1
+                    changes.append(((*key, n), None))
+                if found != 0:
+                    counts = head['counts']
+                    removed.append((key, head | {'counts': counts | {table: counts[table] - found},
+                                                 'buckets': head['buckets'] | {table: n}}))
+            buckets.write(changes)
+            heads.write(removed)
+
+    def refs_keys(self, index, col, table, values):
+        heads, buckets = self.__index(index), self.__index(f'{index}.{table}')
+        for val in values:
+            key = (col, hashable(val))
+            head = heads.data.get(key)
+            if head is None:
+                continue
+            for i in range(head['buckets'].get(table, 0)):
+                bucket = buckets.data.get((*key, i))
+                if bucket is not None and len(bucket['keys']) != 0:
+                    yield val, bucket['keys']
+
+    def refs_count(self, index, col, table):
+        return sum(name == col and doc['counts'].get(table, 0) > 0
+                   for (name, _), doc in list(self.__index(index).data.items()))
+
+    def refs_purge(self, index, table):
+        self.__drop('indexes', f'{index}.{table}')
+        heads = self.__index(index)
+        with heads.lock:
+            heads.write([(key, doc | {'counts': {t: n for t, n in doc['counts'].items() if t != table},
+                                      'buckets': {t: n for t, n in doc['buckets'].items() if t != table}})
+                         for key, doc in heads.data.items() if table in doc['buckets']])
+
+    def refs_convert(self, index):
+        heads = self.__index(index)
+        with heads.lock:
+            legacy = [(key, doc) for key, doc in heads.data.items() if 'refs' in doc]
+        for key, doc in legacy:
+            keys = {}
+            for ref in doc['refs']:
+                keys.setdefault(ref['table'], []).append(ref['key'])
+            head = {'_id': doc['_id'], 'counts': {}, 'buckets': {}}
+            for table, refs in keys.items():
+                buckets = self.__index(f'{index}.{table}')
+                chunks = [refs[i:i + BUCKET_KEYS] for i in range(0, len(refs), BUCKET_KEYS)]
+                buckets.write([((*key, i), {'keys': chunk}) for i, chunk in enumerate(chunks)])
+                head['counts'][table] = len(refs)
+                head['buckets'][table] = len(chunks)
+            heads.write([(key, head)])
+
+    def index_bounds(self, index, col):
+        coll, values = self.__sorted(index, col)
+        with coll.lock:
+            if len(values) == 0:
+                return None
+            return values[0], values[-1]
+
+    def drop_index(self, index):
+        with self.lock:
+            files = os.listdir(os.path.join(self.path, 'indexes'))
+            buckets = {name for name in chain(self.indexes, (os.path.splitext(file)[0] for file in files))
+                       if name.startswith(f'{index}.')}
+        for name in [index, *buckets]:
+            self.__drop('indexes', name)
+        with self.lock:
+            self.ordered = {entry: values for entry, values in self.ordered.items() if entry[0] != index}
+
+    def drop_database(self):
+        self.close()
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def sync(self):
+        with self.lock:
+            colls = list(chain(self.tables.values(), self.indexes.values()))
+        for coll in colls:
+            coll.sync()
+
+    def close(self):
+        with self.lock:
+            for coll in chain(self.tables.values(), self.indexes.values()):
+                coll.close()
+            self.tables = {}
+            self.indexes = {}
+            self.ordered = {}
+
+
+def connect_mongo():
+    if pymongo is None:
+        raise ServerError(Error.DOES_NOT_EXIST, 'engine: mongo: pymongo is not installed')
+    return MongoClient(os.getenv('MONGO_HOST'))
+
+
+def open_engine(path, database, mongo=connect_mongo, journal=True) -> Engine:
+    '''
+        opens the engine a database was created with,
+        mongo is called for a client when the engine needs one
+    '''
+    engine_file = os.path.join(path, ENGINE_FILE)
+    name = 'mongo'
+    if os.path.exists(engine_file):
+        with open(engine_file) as f:
+            name = f.read().strip()
+
+    match name:
+        case 'local':
+            return LocalEngine(path)
+        case 'mongo':
+            return MongoEngine(mongo(), database, journal)
+    raise ServerError(Error.DOES_NOT_EXIST, f'engine: {name}')
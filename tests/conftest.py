@@ -0,0 +1,70 @@
+import os
+import sys
+
+import pytest
+
+# the modules of the server live at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from error import Error
+from server import Server
+from session import Session, current_session
+
+
+class Runner:
+    '''
+        runs commands in a session of its own, as a connection would
+    '''
+
+    def __init__(self, server):
+        self.server = server
+        self.session = Session()
+
+    def __call__(self, command) -> (str, list, str):
+        '''
+            returns (status, rows, message)
+        '''
+        rows = []
+        token = current_session.set(self.session)
+        try:
+            code, message = self.server.run_command(command, rows.append)
+        finally:
+            current_session.reset(token)
+        return Error(code).name, rows, message
+
+
+def create(run, *commands):
+    '''
+        runs commands in a new local database, each must succeed
+    '''
+    for command in ['create_database db local', 'use_database db', *commands]:
+        status, _, message = run(command)
+        assert status == 'SUCCESS', (command, message)
+
+
+def reopen(server) -> Server:
+    '''
+        a new server of the directory of server, whose process is taken
+        to have crashed: nothing is closed or flushed
+    '''
+    for lock in server.locks.values():
+        lock.close()
+    return Server(server.server_dir)
+
+
+@pytest.fixture
+def server(tmp_path):
+    return Server(str(tmp_path))
+
+
+@pytest.fixture
+def run(server):
+    return Runner(server)
+
+
+@pytest.fixture
+def connect(server):
+    '''
+        makes runners of more sessions of the same server
+    '''
+    return lambda: Runner(server)
@@ -0,0 +1,50 @@
+from conftest import create
+
+
+def schema(run):
+    create(run, 'create_table p', 'create_column p id int primary-key-unique',
+           'create_table t', 'create_column t id int primary-key-unique', 'create_column t g int index',
+           'create_column t x int none', 'create_column t pid int foreign-key=p.id',
+           'bulk_insert into p values 1;2;3')
+    run('bulk_insert into t values ' + ';'.join(f'{i}#{i % 4}#{i * 3 % 17}#{i % 3 + 1}' for i in range(200)))
+    return [(i, i % 4, i * 3 % 17, i % 3 + 1) for i in range(200)]
+
+
+def test_counts_read_from_index_entries(run):
+    rows = schema(run)
+
+    assert run('explain select count(*) from t where g=1')[2] == 't: count from index entries'
+    assert run('select count(*) from t where g=1')[1] == [{'count(*)': sum(1 for row in rows if row[1] == 1)}]
+    assert run('select count(*) from t where pid=2')[1] == [{'count(*)': sum(1 for row in rows if row[3] == 2)}]
+    assert run('select count(*) from t where g=7')[1] == [{'count(*)': 0}]
+
+    # the entries follow deletes
+    assert run('delete t where x=0')[0] == 'SUCCESS'
+    rows = [row for row in rows if row[2] != 0]
+    assert run('select count(*) from t where g=1')[1] == [{'count(*)': sum(1 for row in rows if row[1] == 1)}]
+    assert run('select g,count(*) from t group by g')[1] == [
+        {'g': g, 'count(*)': sum(1 for row in rows if row[1] == g)} for g in range(4)]
+
+
+def test_aggregates_folded_as_rows_are_read(run):
+    rows = schema(run)
+
+    assert run('explain select sum(x) from t where x>3')[2].endswith('-> aggregate')
+    selected = [row for row in rows if row[2] > 3]
+    assert run('select count(*),sum(x),min(x),max(x),avg(x) from t where x>3')[1] == [{
+        'count(*)': len(selected), 'sum(x)': sum(row[2] for row in selected), 'min(x)': min(row[2] for row in selected),
+        'max(x)': max(row[2] for row in selected), 'avg(x)': sum(row[2] for row in selected) / len(selected)}]
+
+    grouped = run('select g,sum(x),max(id) from t group by g')[1]
+    assert grouped == [{'g': g, 'sum(x)': sum(row[2] for row in rows if row[1] == g),
+                        'max(id)': max(row[0] for row in rows if row[1] == g)} for g in range(4)]
+
+
+def test_aggregates_match_the_rows_selected(run):
+    schema(run)
+
+    for where in ['', ' where g=2', ' where x>=5 x<9', ' where pid=3 g=0']:
+        selected = run(f'select * from t{where}')[1]
+        xs = [row['x'] for row in selected]
+        assert run(f'select count(*),sum(x),min(x) from t{where}')[1] == [
+            {'count(*)': len(xs), 'sum(x)': sum(xs), 'min(x)': min(xs)}], where
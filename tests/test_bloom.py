@@ -0,0 +1,59 @@
+import os
+
+from conftest import Runner, create, reopen
+
+
+def lookups(server, monkeypatch):
+    '''
+        counts the engine reads of unique values and rows by key
+    '''
+    calls = []
+    engine = server.engines['db']
+    for name in ['index_get', 'multi_get', 'get']:
+        method = getattr(engine, name)
+        monkeypatch.setattr(engine, name, lambda *args, method=method, name=name: calls.append(name) or method(*args))
+    return calls
+
+
+def test_new_values_are_checked_without_lookups(server, run, monkeypatch):
+    create(run, 'create_table t', 'create_column t id int primary-key-unique', 'create_column t u int unique',
+           'insert into t values 1#10')
+    calls = lookups(server, monkeypatch)
+
+    assert run('insert into t values 2#20')[0] == 'SUCCESS'
+    assert calls == []
+    assert run('bulk_insert into t values 3#30;4#40')[0] == 'SUCCESS'
+    assert calls == []
+
+    # values that may be stored are looked up
+    assert run('insert into t values 5#10')[0] == 'DUPLICATE_UNIQUE'
+    assert run('insert into t values 1#50')[0] == 'DUPLICATE_KEY'
+    assert len(calls) != 0
+
+
+def test_deleted_values_can_be_inserted_again(run):
+    create(run, 'create_table t', 'create_column t id int primary-key-unique', 'create_column t u int unique',
+           'insert into t values 1#10', 'delete t where id=1')
+
+    assert run('insert into t values 1#10')[0] == 'SUCCESS'
+    assert run('insert into t values 2#10')[0] == 'DUPLICATE_UNIQUE'
+
+
+def test_filters_saved_and_rebuilt(server, run, tmp_path):
+    create(run, 'create_table t', 'create_column t id int primary-key-unique', 'create_column t u int unique',
+           'bulk_insert into t values 1#10;2#20')
+    run('use_database db')  # not in use, checkpoints save the filters
+
+    restarted = reopen(server)
+    run = Runner(restarted)
+    run('use_database db')
+    assert run('insert into t values 3#20')[0] == 'DUPLICATE_UNIQUE'
+
+    # filters missing from the directory are rebuilt from the stored values
+    for name in os.listdir(os.path.join(tmp_path, 'db')):
+        if name.endswith('.bloom'):
+            os.remove(os.path.join(tmp_path, 'db', name))
+    run = Runner(reopen(restarted))
+    run('use_database db')
+    assert run('insert into t values 2#30')[0] == 'DUPLICATE_KEY'
+    assert run('insert into t values 3#10')[0] == 'DUPLICATE_UNIQUE'
@@ -0,0 +1,42 @@
+from conftest import create
+
+
+def cache_stats(run):
+    return next(row for row in run('stats')[1] if row['name'] == 'cache')
+
+
+def test_reads_after_writes_of_another_session(run, connect):
+    create(run, 'create_table t', 'create_column t id int primary-key-unique', 'create_column t u int unique',
+           'create_column t a int index', 'insert into t values 1#10#5')
+    # enough rows for lookups to go through the indexes
+    run('bulk_insert into t values ' + ';'.join(f'{i}#{i * 10}#{i}' for i in range(10, 100)))
+    other = connect()
+    other('use_database db')
+
+    for _ in range(2):
+        assert run('select id from t where id=1')[1] == [{'id': 1}]
+        assert run('select id from t where u=10')[1] == [{'id': 1}]
+        assert run('select id from t where a=5')[1] == [{'id': 1}]
+    stats = cache_stats(run)
+    assert stats['hits'] >= 3 and stats['entries'] != 0
+
+    # cached rows and index entries are dropped by the writes touching them
+    assert other('insert into t values 2#20#5')[0] == 'SUCCESS'
+    assert run('select id from t where a=5')[1] == [{'id': 1}, {'id': 2}]
+    assert other('delete t where id=1')[0] == 'SUCCESS'
+    assert run('select id from t where id=1')[1] == []
+    assert run('select id from t where u=10')[1] == []
+    assert run('select id from t where a=5')[1] == [{'id': 2}]
+    assert other('insert into t values 1#11#6')[0] == 'SUCCESS'
+    assert run('select * from t where id=1')[1] == [{'_id': 1, 'id': 1, 'u': 11, 'a': 6}]
+
+
+def test_reference_checks_after_parent_changes(run):
+    create(run, 'create_table p', 'create_column p id int primary-key-unique',
+           'create_table c', 'create_column c id int primary-key-unique', 'create_column c pid int foreign-key=p.id',
+           'insert into p values 1', 'insert into c values 1#1', 'delete c')
+
+    assert run('delete p where id=1')[0] == 'SUCCESS'
+    assert run('insert into c values 2#1')[0] == 'INVALID_REFERENCE'
+    assert run('insert into p values 1')[0] == 'SUCCESS'
+    assert run('insert into c values 2#1')[0] == 'SUCCESS'
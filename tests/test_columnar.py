@@ -0,0 +1,40 @@
+import random
+
+import pytest
+
+import columnar
+from conftest import create
+
+pytest.importorskip('numpy')
+
+
+def test_columnar_scans_match_row_scans(run, monkeypatch):
+    create(run, 'create_table t', 'create_column t id int primary-key-unique', 'create_column t f float none',
+           'create_column t s string none', 'create_column t d date none', 'create_column t b bit none')
+    rand = random.Random(7)
+    rows = [f'{i}#{rand.uniform(-5, 5):.3f}#{rand.choice("abc")}{rand.randint(0, 9)}#'
+            f'2024-0{rand.randint(1, 9)}-1{rand.randint(0, 9)}#{rand.randint(0, 1)}' for i in range(3000)]
+    assert run('bulk_insert into t values ' + ';'.join(rows))[0] == 'SUCCESS'
+
+    scans = []
+    scan = columnar.scan
+    monkeypatch.setattr(columnar, 'scan', lambda *args: scans.append(args) or scan(*args))
+
+    conditions = ['f>1.5', 'f<=0 b=1', 's=a3', 's>b5', 'd>=2024-05-01 d<2024-07-15', 'id>2990', 'b=0 s<b f>-1',
+                  'f>100']
+    for where in conditions:
+        run('columnar off')
+        expected = run(f'select * from t where {where}')
+        run('columnar on')
+        assert run(f'select * from t where {where}') == expected, where
+        assert run(f'select count(*),max(f) from t where {where}')[1][0]['count(*)'] == len(expected[1]), where
+    assert len(scans) >= len(conditions)
+
+
+def test_columnar_ints_past_int64(run):
+    create(run, 'create_table t', 'create_column t id int primary-key-unique', 'create_column t a int none',
+           f'bulk_insert into t values 1#{2 ** 70};2#5;3#-{2 ** 64}')
+    run('columnar on')
+
+    assert run('select id from t where a>4')[1] == [{'id': 1}, {'id': 2}]
+    assert run(f'select id from t where a<{-2 ** 63}')[1] == [{'id': 3}]
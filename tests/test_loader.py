@@ -0,0 +1,52 @@
+import io
+import json
+
+import server
+from conftest import create
+
+
+def schema(run):
+    create(run, 'create_table p', 'create_column p id int primary-key-unique', 'bulk_insert into p values 1;2',
+           'create_table t', 'create_column t id int primary-key-unique', 'create_column t name string unique',
+           'create_column t pid int foreign-key=p.id')
+
+
+def test_load_csv_with_header(run, tmp_path):
+    schema(run)
+    path = tmp_path / 'rows.csv'
+    path.write_text('pid,id,name\n1,1,a\n2,2,b\nx,3,c\n1,4,a\n9,5,e\n2,1,f\n1,6,g\n')
+
+    status, _, message = run(f'load t {path}')
+    assert status == 'INVALID_TYPE'
+    assert message.startswith('3 inserted, 4 rejected')
+    assert run('select * from t where name=g')[1] == [{'_id': 6, 'id': 6, 'name': 'g', 'pid': 1}]
+    assert [row['id'] for row in run('select id from t')[1]] == [1, 2, 6]
+    assert run('select count(*) from t where pid=1')[1] == [{'count(*)': 2}]
+
+
+def test_load_jsonl_arrays_and_objects(run, tmp_path):
+    schema(run)
+    path = tmp_path / 'rows.jsonl'
+    lines = [[1, 'a', 1], {'name': 'b', 'id': 2, 'pid': 2}, [3, 'c'], {'id': 4, 'name': 'a', 'pid': 1}]
+    path.write_text(''.join(json.dumps(line) + '\n' for line in lines))
+
+    message = run(f'load t {path} format jsonl')[2]
+    assert message.startswith('2 inserted, 2 rejected'), message
+    assert run('select id,name from t')[1] == [{'id': 1, 'name': 'a'}, {'id': 2, 'name': 'b'}]
+    # loaded values are in the filters and caches of the server
+    assert run('insert into t values 5#b#1')[0] == 'DUPLICATE_UNIQUE'
+    assert run('delete p where id=2')[0] == 'FOREIGN_KEY_CONSTRAINT'
+
+
+def test_load_refuses_a_database_in_use(run, tmp_path, monkeypatch):
+    schema(run)
+    path = tmp_path / 'rows.csv'
+    path.write_text('1,a,1\n')
+    monkeypatch.chdir(tmp_path)
+    err = io.StringIO()
+    monkeypatch.setattr(server, 'stderr', err)
+
+    # as another process would, while the server has the database open
+    assert server.load(['db', 't', str(path)]) == 1
+    assert 'DATABASE_IN_USE' in err.getvalue()
+    assert run('select * from t')[1] == []
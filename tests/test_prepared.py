@@ -0,0 +1,42 @@
+from conftest import create
+
+
+def schema(run):
+    create(run, 'create_table t', 'create_column t id int primary-key-unique', 'create_column t a int index',
+           'create_column t s string none')
+    run('bulk_insert into t values ' + ';'.join(f'{i}#{i % 10}#s{i % 3}' for i in range(100)))
+
+
+def test_execute_binds_new_values(run, connect):
+    schema(run)
+
+    assert run('prepare q select id from t where a=? s=?') == ('SUCCESS', [], '2 parameters')
+    for a, s in [(1, 's0'), (2, 's2'), (1, 's1'), (7, 'x')]:
+        assert run(f'execute q {a} {s}') == run(f'select id from t where a={a} s={s}'), (a, s)
+    assert run('execute q 1')[0] == 'INVALID_NUMBER_OF_FIELDS'
+    assert run('execute q x s0')[0] == 'INVALID_TYPE'
+    assert run('execute r 1 s0')[0] == 'DOES_NOT_EXIST'
+
+    # statements belong to the session that prepared them
+    other = connect()
+    other('use_database db')
+    assert other('execute q 1 s0')[0] == 'DOES_NOT_EXIST'
+
+
+def test_execute_after_the_tables_change(run):
+    schema(run)
+    run('prepare q select * from t where id=?')
+    run('prepare k select id from t where a=?')
+    assert run('execute q 5')[1] == [{'_id': 5, 'id': 5, 'a': 5, 's': 's2'}]
+
+    assert run('create_column t b int none default 0')[0] == 'SUCCESS'
+    assert run('execute q 5')[1] == [{'_id': 5, 'id': 5, 'a': 5, 's': 's2', 'b': 0}]
+
+    # the access path is chosen again for an index that is dropped with its table
+    assert run('drop_table t')[0] == 'SUCCESS'
+    assert run('execute k 5')[0] == 'DOES_NOT_EXIST'
+    assert run('create_table t')[0] == 'SUCCESS'
+    assert run('create_column t id int primary-key-unique')[0] == 'SUCCESS'
+    assert run('create_column t a int none')[0] == 'SUCCESS'
+    assert run('insert into t values 1#5')[0] == 'SUCCESS'
+    assert run('execute k 5')[1] == [{'id': 1}]
@@ -0,0 +1,96 @@
+import socket
+import struct
+import threading
+import time
+
+import pytest
+
+import server as server_module
+from client import Connection
+from protocol import decode_batch, decode_response, encode_batch, encode_request
+
+
+def listen(server, workers=8) -> tuple:
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        address = ('localhost', sock.getsockname()[1])
+    threading.Thread(target=server.listen, args=(address, 64, workers), daemon=True).start()
+    for _ in range(100):
+        try:
+            socket.create_connection(address).close()
+            return address
+        except ConnectionError:
+            time.sleep(0.05)
+    raise TimeoutError(address)
+
+
+@pytest.fixture
+def address(server):
+    return listen(server)
+
+
+def request(conn, command) -> (str, list):
+    rows = []
+    conn.send(command)
+    _, status, _, _ = conn.receive(rows.append)
+    return status, rows
+
+
+def test_batch_round_trip():
+    rows = [[1, 'a', 2.5, None], [2 ** 70, 'b', -1.0, True]]
+    line, _, data = encode_batch(0, rows, 'zlib').partition(b'\n')
+    rid, kind, (encoding, compression, size) = decode_response(line.decode())
+    assert (rid, kind, size) == (0, '*', len(data))
+    assert decode_batch(encoding, compression, data) == rows
+
+
+def test_binary_format_kept_across_use_database(address):
+    conn = Connection(address)
+    try:
+        # negotiated before any database is in use, as client.py does
+        assert request(conn, 'format binary zlib')[0] == 'SUCCESS'
+        for command in ['create_database db local', 'use_database db', 'create_table t',
+                        'create_column t id int primary-key-unique', 'create_column t name string none',
+                        'bulk_insert into t values ' + ';'.join(f'{i}#n{i}' for i in range(3000))]:
+            assert request(conn, command)[0] == 'SUCCESS', command
+
+        conn.send('select * from t')
+        kinds = []
+        while len(line := conn.reader.readline()) > 0:
+            _, kind, payload = decode_response(line.decode())
+            kinds.append(kind)
+            if kind == '*':
+                conn.reader.read(payload[2])
+            elif kind not in ('#', '='):
+                break
+        assert kinds[0] == '#' and '=' not in kinds and kinds.count('*') == 3
+
+        status, rows = request(conn, 'select * from t')
+        assert status == 'SUCCESS'
+        assert rows == [{'_id': i, 'id': i, 'name': f'n{i}'} for i in range(3000)]
+    finally:
+        conn.close()
+
+
+def test_client_lost_mid_select_frees_its_worker(server, monkeypatch):
+    # small chunks and queue, so that the select outlasts the connection
+    monkeypatch.setattr(server_module, 'SEND_CHUNK', 1024)
+    monkeypatch.setattr(server_module, 'SEND_QUEUE', 1)
+    address = listen(server, workers=1)
+
+    conn = Connection(address)
+    conn.sock.settimeout(10)
+    for command in ['create_database db local', 'use_database db', 'create_table t',
+                    'create_column t id int primary-key-unique', 'create_column t name string none',
+                    'bulk_insert into t values ' + ';'.join(f'{i}#{"n" * 100}' for i in range(20000))]:
+        assert request(conn, command)[0] == 'SUCCESS', command
+
+    lost = socket.create_connection(address)
+    lost.sendall((encode_request(0, 'use_database db') + encode_request(1, 'select * from t')).encode())
+    lost.recv(1024)
+    # reset instead of closing cleanly
+    lost.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+    lost.close()
+
+    assert request(conn, 'select * from t where id=1')[1] == [{'_id': 1, 'id': 1, 'name': 'n' * 100}]
+    conn.close()
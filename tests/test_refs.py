@@ -0,0 +1,30 @@
+import storage
+from conftest import create
+
+
+def test_references_past_one_bucket(run, monkeypatch):
+    monkeypatch.setattr(storage, 'BUCKET_KEYS', 4)
+    create(run, 'create_table p', 'create_column p id int primary-key-unique', 'bulk_insert into p values 1;2',
+           'create_table c', 'create_column c id int primary-key-unique', 'create_column c pid int foreign-key=p.id',
+           'create_table d', 'create_column d id int primary-key-unique', 'create_column d pid int foreign-key=p.id')
+    run('bulk_insert into c values ' + ';'.join(f'{i}#1' for i in range(11)))
+    run('insert into c values 11#2')
+    run('insert into d values 1#1')
+
+    assert [row['id'] for row in run('select id from c where pid=1')[1]] == list(range(11))
+    assert run('select count(*) from c where pid=1')[1] == [{'count(*)': 11}]
+
+    # the parent stays referenced until the last key of every bucket and table is gone
+    assert run('delete c where id<10')[0] == 'SUCCESS'
+    assert run('select count(*) from c where pid=1')[1] == [{'count(*)': 1}]
+    assert run('delete p where id=1')[0] == 'FOREIGN_KEY_CONSTRAINT'
+    assert run('delete c where id=10')[0] == 'SUCCESS'
+    assert run('delete p where id=1')[0] == 'FOREIGN_KEY_CONSTRAINT'
+    assert run('delete d')[0] == 'SUCCESS'
+    assert run('delete p where id=1')[0] == 'SUCCESS'
+    assert run('delete p where id=2')[0] == 'FOREIGN_KEY_CONSTRAINT'
+
+    # buckets emptied by deletes are filled again
+    run('insert into p values 1')
+    run('bulk_insert into c values ' + ';'.join(f'{i}#1' for i in range(20, 29)))
+    assert [row['id'] for row in run('select id from c where pid=1')[1]] == list(range(20, 29))
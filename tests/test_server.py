@@ -0,0 +1,152 @@
+import os
+import threading
+import time
+
+from conftest import Runner, create, reopen
+
+
+def test_bulk_insert_reports_rejected_rows(run):
+    create(run, 'create_table t', 'create_column t id int primary-key-unique', 'create_column t u int unique',
+           'insert into t values 1#1')
+
+    status, _, message = run('bulk_insert into t values 2#2;3#x;1#3;4#2;5#5;6#6 batch 2')
+    assert status == 'INVALID_TYPE'
+    assert message == '3 inserted, 3 rejected; row 1: INVALID_TYPE; row 2: DUPLICATE_KEY 1; row 3: DUPLICATE_UNIQUE u'
+    assert [row['id'] for row in run('select id from t')[1]] == [1, 2, 5, 6]
+    assert run('select id from t where u=2')[1] == [{'id': 2}]
+
+
+def test_create_column_refused_on_table_with_rows(run):
+    create(run, 'create_table t', 'create_column t id int primary-key-unique', 'create_column t a int none',
+           'insert into t values 1#10')
+
+    status, _, _ = run('create_column t b int index')
+    assert status == 'INVALID_COMMAND'
+
+    assert run('select * from t') == ('SUCCESS', [{'_id': 1, 'id': 1, 'a': 10}], '')
+    assert run('select * from t where a=10')[1] == [{'_id': 1, 'id': 1, 'a': 10}]
+    assert run('create_index t ia a')[0] == 'SUCCESS'
+
+
+def test_create_column_backfills_rows(run):
+    create(run, 'create_table t', 'create_column t id int primary-key-unique', 'create_column t a int none',
+           'insert into t values 1#10', 'insert into t values 2#20')
+
+    assert run('create_column t b int index default x')[0] == 'INVALID_TYPE'
+    assert run('create_column t k int primary-key-not-unique default 1')[0] == 'INVALID_COMMAND'
+    assert run('create_column t b int index default 5')[0] == 'SUCCESS'
+    assert run('insert into t values 3#30#6')[0] == 'SUCCESS'
+
+    assert [row['id'] for row in run('select id from t where b=5')[1]] == [1, 2]
+    assert run('select * from t where id=2')[1] == [{'_id': 2, 'id': 2, 'a': 20, 'b': 5}]
+    assert run('delete t where b=5')[0] == 'SUCCESS'
+    assert run('select id from t where b=5')[1] == []
+
+
+def test_create_column_backfills_unique_and_foreign_key(run):
+    create(run, 'create_table p', 'create_column p id int primary-key-unique', 'insert into p values 1',
+           'create_table t', 'create_column t id int primary-key-unique', 'insert into t values 1')
+
+    assert run('create_column t pid int foreign-key=p.id default 2')[0] == 'FOREIGN_KEY_CONSTRAINT'
+    assert run('create_column t pid int foreign-key=p.id default 1')[0] == 'SUCCESS'
+    assert run('delete p where id=1')[0] == 'FOREIGN_KEY_CONSTRAINT'
+
+    assert run('create_column t u int unique default 7')[0] == 'SUCCESS'
+    assert run('insert into t values 2#1#7')[0] == 'DUPLICATE_UNIQUE'
+    assert run('insert into t values 2#1#8')[0] == 'SUCCESS'
+    assert run('create_column t v int unique default 7')[0] == 'DUPLICATE_UNIQUE'
+
+
+def test_create_column_on_emptied_table(run):
+    create(run, 'create_table t', 'create_column t id int primary-key-unique', 'insert into t values 1',
+           'delete t', 'create_column t a int index', 'insert into t values 2#20')
+
+    assert run('select * from t where a=20')[1] == [{'_id': 2, 'id': 2, 'a': 20}]
+
+
+def test_insert_waiting_for_a_dropped_table(server, run, connect):
+    create(run, 'create_table t', 'create_column t id int primary-key-unique')
+    other = connect()
+    other('use_database db')
+
+    results = []
+    with server.writers['db']:
+        thread = threading.Thread(target=lambda: results.append(other('insert into t values 1')))
+        thread.start()
+        time.sleep(0.2)  # the insert waits for the write lock
+        assert run('drop_table t')[0] == 'SUCCESS'
+    thread.join()
+
+    assert results[0][0] == 'DOES_NOT_EXIST'
+    assert run('create_table t')[0] == 'SUCCESS'
+
+
+def test_drop_table_refused_while_referenced(run):
+    create(run, 'create_table p', 'create_column p id int primary-key-unique',
+           'create_table c', 'create_column c id int primary-key-unique', 'create_column c pid int foreign-key=p.id',
+           'insert into p values 1', 'insert into c values 1#1')
+
+    assert run('drop_table p')[0] == 'FOREIGN_KEY_CONSTRAINT'
+    assert run('delete c')[0] == 'SUCCESS'
+    assert run('drop_table p')[0] == 'SUCCESS'
+
+
+def test_drop_table_waits_for_a_referencing_insert(server, run, connect):
+    create(run, 'create_table p', 'create_column p id int primary-key-unique',
+           'create_table c', 'create_column c id int primary-key-unique', 'create_column c pid int foreign-key=p.id',
+           'insert into p values 1')
+    other = connect()
+    other('use_database db')
+
+    results = []
+    with server.writers['db']:
+        thread = threading.Thread(target=lambda: results.append(other('drop_table p')))
+        thread.start()
+        time.sleep(0.2)  # the drop waits for the write lock
+        assert run('insert into c values 1#1')[0] == 'SUCCESS'
+    thread.join()
+
+    assert results[0][0] == 'FOREIGN_KEY_CONSTRAINT'
+    assert run('select * from c')[1] == [{'_id': 1, 'id': 1, 'pid': 1}]
+
+
+def test_database_dropped_by_another_session(run, connect):
+    create(run, 'create_table t', 'create_column t id int primary-key-unique', 'insert into t values 1')
+    other = connect()
+    other('use_database db')
+
+    assert run('drop_database db')[0] == 'SUCCESS'
+    assert other('select * from t')[0] == 'NO_DATABASE_IN_USE'
+    assert other('stats')[0] == 'SUCCESS'
+
+    create(run, 'create_table t', 'create_column t id int primary-key-unique')
+    assert other('insert into t values 2')[0] == 'NO_DATABASE_IN_USE'
+    assert other('use_database db')[0] == 'SUCCESS'
+    assert other('insert into t values 2')[0] == 'SUCCESS'
+    assert run('select * from t')[1] == [{'_id': 2, 'id': 2}]
+
+
+def test_legacy_rows_typed_on_open(server, run, tmp_path):
+    create(run, 'create_table p', 'create_column p id int primary-key-unique',
+           'create_table t', 'create_column t id int primary-key-unique', 'create_column t u int unique',
+           'create_column t a int index', 'create_column t pid int foreign-key=p.id',
+           'insert into p values 1')
+    # rows and entries as written before values were typed
+    engine = server.engines['db']
+    engine.put_many('t', [{'_id': '1', 'values': '5#7#1'}, {'_id': '2', 'values': '6#7#1'}])
+    engine.index_insert('t_uq', 'u', {'5': {'key': '1'}, '6': {'key': '2'}})
+    engine.index_push('t_nq', 'keys', {('a', '7'): ['1', '2']})
+    engine.sync()
+    os.remove(os.path.join(tmp_path, 'db', 'typed'))
+
+    run = Runner(reopen(server))
+    assert run('use_database db')[0] == 'SUCCESS'
+    assert run('select * from t')[1] == [{'_id': 1, 'id': 1, 'u': 5, 'a': 7, 'pid': 1},
+                                         {'_id': 2, 'id': 2, 'u': 6, 'a': 7, 'pid': 1}]
+    assert run('select id from t where u=6')[1] == [{'id': 2}]
+    assert len(run('select id from t where a=7')[1]) == 2
+    assert run('insert into t values 1#9#9#1')[0] == 'DUPLICATE_KEY'
+    assert run('insert into t values 3#5#9#1')[0] == 'DUPLICATE_UNIQUE'
+    assert run('delete p where id=1')[0] == 'FOREIGN_KEY_CONSTRAINT'
+    assert run('delete t where id=1')[0] == 'SUCCESS'
+    assert run('insert into t values 3#5#9#1')[0] == 'SUCCESS'
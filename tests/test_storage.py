@@ -0,0 +1,30 @@
+import storage
+from storage import LocalEngine
+
+
+def test_local_scan_reads_keys_as_it_goes(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage, 'SCAN_CHUNK', 10)
+    engine = LocalEngine(str(tmp_path))
+    engine.put_many('t', [{'_id': i, 'v': [i]} for i in range(100)])
+
+    scan = engine.scan('t')
+    assert next(scan)['_id'] == 0
+    # rows deleted before the scan gets to them are skipped, rows added meanwhile are not read
+    engine.delete('t', list(range(50, 100)))
+    engine.put_many('t', [{'_id': i, 'v': [i]} for i in range(100, 150)])
+    assert [doc['_id'] for doc in scan] == list(range(1, 50))
+
+    assert [doc['_id'] for doc in engine.scan('t', 45, 10)] == [45, 46, 47, 48, 49, *range(100, 105)]
+
+
+def test_local_scan_after_reopen_and_reorder(tmp_path):
+    engine = LocalEngine(str(tmp_path))
+    for i in range(3):
+        engine.put_many('t', [{'_id': (i, j), 'v': [j]} for j in range(3000)])
+        engine.delete('t', [(i, j) for j in range(3000) if j % 3 != 0])
+    expected = [(i, j) for i in range(3) for j in range(0, 3000, 3)]
+    assert [doc['_id'] for doc in engine.scan('t')] == expected
+
+    engine.close()
+    reopened = LocalEngine(str(tmp_path))
+    assert [doc['_id'] for doc in reopened.scan('t')] == expected
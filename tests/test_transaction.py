@@ -0,0 +1,78 @@
+from conftest import create
+
+
+def schema(run):
+    create(run, 'create_table p', 'create_column p id int primary-key-unique',
+           'create_table c', 'create_column c id int primary-key-unique', 'create_column c pid int foreign-key=p.id',
+           'insert into p values 1')
+
+
+def test_commit_applies_every_write(run, connect):
+    schema(run)
+    other = connect()
+    other('use_database db')
+
+    assert run('begin')[0] == 'SUCCESS'
+    for command in ['insert into p values 2', 'insert into c values 1#2', 'insert into c values 2#1',
+                    'delete p where id=1']:
+        assert run(command)[0] == 'SUCCESS', command
+    # the session reads its own writes, others do not see them before the commit
+    assert run('select id from c')[1] == [{'id': 1}, {'id': 2}]
+    assert other('select id from c')[1] == []
+    assert run('delete c where id=2')[0] == 'SUCCESS'
+
+    assert run('commit') == ('SUCCESS', [], '2 inserted, 1 deleted')
+    assert other('select id from p')[1] == [{'id': 2}]
+    assert other('select * from c')[1] == [{'_id': 1, 'id': 1, 'pid': 2}]
+
+
+def test_rollback_discards_every_write(run):
+    schema(run)
+
+    run('begin')
+    run('insert into c values 1#1')
+    run('delete p where id=1')
+    assert run('rollback')[0] == 'SUCCESS'
+    assert run('select id from p')[1] == [{'id': 1}]
+    assert run('select id from c')[1] == []
+    assert run('commit')[0] == 'INVALID_COMMAND'
+
+
+def test_conflicting_commit_writes_nothing(run, connect):
+    schema(run)
+    other = connect()
+    other('use_database db')
+
+    run('begin')
+    run('insert into c values 1#1')
+    run('insert into c values 2#1')
+    # committed meanwhile by another session
+    assert other('insert into c values 2#1')[0] == 'SUCCESS'
+
+    assert run('commit')[0] == 'DUPLICATE_KEY'
+    assert run('select id from c')[1] == [{'id': 2}]
+    # the transaction is over
+    assert run('rollback')[0] == 'INVALID_COMMAND'
+
+
+def test_commit_checks_references_deleted_meanwhile(run, connect):
+    schema(run)
+    other = connect()
+    other('use_database db')
+
+    run('begin')
+    run('insert into c values 1#1')
+    assert other('delete p where id=1')[0] == 'SUCCESS'
+
+    assert run('commit')[0] == 'INVALID_REFERENCE'
+    assert run('select id from c')[1] == []
+
+
+def test_use_database_refused_with_an_open_transaction(run):
+    schema(run)
+
+    run('begin')
+    assert run('use_database db')[0] == 'INVALID_COMMAND'
+    assert run('insert into p values 2')[0] == 'SUCCESS'
+    assert run('commit')[0] == 'SUCCESS'
+    assert run('select id from p')[1] == [{'id': 1}, {'id': 2}]
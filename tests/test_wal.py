@@ -0,0 +1,36 @@
+from conftest import Runner, create, reopen
+
+
+def test_crash_replay_finishes_logged_changes(server, run):
+    create(run, 'create_table a', 'create_column a id int primary-key-unique', 'create_column a u int unique',
+           'create_column a n string index', 'insert into a values 1#10#x')
+
+    # a crash cut an insert short after some of its index entries, and a logged delete before any write
+    wal, engine = server.logs['db'], server.engines['db']
+    wal.commit('insert', 'a', [['2', '20', 'y'], ['3', '30', 'y']])
+    engine.index_insert('a_uq', 'u', {20: {'key': 2}})
+    engine.index_push('a_nq', 'keys', {('n', 'y'): [2]})
+    wal.commit('delete', 'a', [1])
+    engine.index_delete('a_uq', 'u', [10])
+    wal.file.flush()
+
+    restarted = reopen(server)
+    run = Runner(restarted)
+    assert run('use_database db')[0] == 'SUCCESS'
+    assert run('select * from a')[1] == [{'_id': 2, 'id': 2, 'u': 20, 'n': 'y'}, {'_id': 3, 'id': 3, 'u': 30, 'n': 'y'}]
+    assert run('select id from a where u=20')[1] == [{'id': 2}]
+    assert run('select id from a where n=y')[1] == [{'id': 2}, {'id': 3}]
+    assert run('select id from a where u=10')[1] == []
+    assert run('insert into a values 4#20#z')[0] == 'DUPLICATE_UNIQUE'
+    assert run('insert into a values 1#10#x')[0] == 'SUCCESS'
+    assert restarted.logs['db'].pending == []
+
+
+def test_committed_changes_survive_a_crash(server, run):
+    create(run, 'create_table a', 'create_column a id int primary-key-unique', 'create_column a n string index',
+           'insert into a values 1#x', 'bulk_insert into a values 2#y;3#y', 'delete a where id=1')
+
+    run = Runner(reopen(server))
+    assert run('use_database db')[0] == 'SUCCESS'
+    assert run('select id from a where n=y')[1] == [{'id': 2}, {'id': 3}]
+    assert run('select id from a where n=x')[1] == []
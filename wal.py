@@ -0,0 +1,154 @@
+'''
+    write-ahead log of the changes made to one database
+
+    Every insert, bulk insert batch, delete and table drop is appended as a
+    record and made durable before the engine sees it, then marked done
+    once applied. Sessions committing at the same time share one fsync: the
+    first one to get there syncs everything appended so far, the others
+    wait for it.
+
+    Records not marked done when the log is opened are left in pending for
+    replay. They may have been applied in part or in full, so replaying
+    them has to be idempotent. The log is emptied once every record is done
+    or failed and the engine has made its own writes durable; records that
+    failed are written to it again, to be replayed when it is next opened.
+'''
+import os
+import pickle
+import struct
+import threading
+
+WAL_FILE = 'wal.log'  # inside the database directory
+CHECKPOINT_BYTES = 2 ** 26  # log size at which it is emptied once nothing is in flight
+
+
+class WriteAheadLog:
+
+    def __init__(self, path, checkpoint):
+        self.path = path
+        self.on_checkpoint = checkpoint  # makes the engine's writes durable
+        self.cond = threading.Condition()
+        self.lsn = 0  # last record appended
+        self.synced = 0  # last record known to be durable
+        self.syncing = False
+        self.active = {}  # lsn -> record appended and not done
+        self.failures = {}  # lsn -> record whose change failed, to replay
+        self.pending = self.__read()  # [(lsn, record)] to replay
+        self.synced = self.lsn
+        self.file = open(path, 'ab')
+        self.size = self.file.tell()
+
+    def __read(self):
+        records = {}
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, 'rb') as f:
+            data = f.read()
+        pos = 0
+        while pos + 4 <= len(data):
+            length, = struct.unpack_from('>I', data, pos)
+            if pos + 4 + length > len(data):
+                break
+            lsn, record = pickle.loads(data[pos + 4:pos + 4 + length])
+            pos += 4 + length
+            if record is None:
+                records.pop(lsn, None)
+            else:
+                records[lsn] = record
+            self.lsn = max(self.lsn, lsn)
+        # drop a record torn by a crash
+        if pos != len(data):
+            with open(self.path, 'r+b') as f:
+                f.truncate(pos)
+        return sorted(records.items())
+
+    def __write(self, lsn, record):
+        data = pickle.dumps((lsn, record), pickle.HIGHEST_PROTOCOL)
+        self.file.write(struct.pack('>I', len(data)) + data)
+        self.size += 4 + len(data)
+
+    def append(self, *record) -> int:
+        with self.cond:
+            self.lsn += 1
+            self.__write(self.lsn, record)
+            self.active[self.lsn] = record
+            return self.lsn
+
+    def sync(self, lsn):
+        '''
+            returns once record lsn is durable
+        '''
+        with self.cond:
+            while self.synced < lsn and self.syncing:
+                self.cond.wait()
+            if self.synced >= lsn:
+                return
+            # lead a group commit of everything appended so far
+            self.syncing = True
+            target = self.lsn
+            self.file.flush()
+
+        synced = False
+        try:
+            os.fsync(self.file.fileno())
+            synced = True
+        finally:
+            with self.cond:
+                self.syncing = False
+                if synced:
+                    self.synced = max(self.synced, target)
+                self.cond.notify_all()
+
+    def commit(self, *record) -> int:
+        '''
+            appends a record and returns its lsn once it is durable
+        '''
+        lsn = self.append(*record)
+        self.sync(lsn)
+        return lsn
+
+    def done(self, lsn):
+        # no fsync, losing the mark only replays the record again
+        with self.cond:
+            self.__write(lsn, None)
+            self.active.pop(lsn, None)
+            self.cond.notify_all()
+            if self.size > CHECKPOINT_BYTES:
+                self.checkpoint()
+
+    def fail(self, lsn):
+        '''
+            marks a record whose change failed part way as no longer in
+            flight; it stays in the log, to be replayed on the next open
+        '''
+        with self.cond:
+            self.failures[lsn] = self.active.pop(lsn)
+            self.cond.notify_all()
+
+    def drain(self, timeout=None) -> bool:
+        '''
+            returns whether every record appended so far is done or
+            failed, waiting for them at most timeout seconds
+        '''
+        with self.cond:
+            last = self.lsn
+            return self.cond.wait_for(lambda: all(lsn > last for lsn in self.active), timeout)
+
+    def checkpoint(self):
+        with self.cond:
+            if len(self.active) != 0 or self.size == 0:
+                return
+            self.file.flush()
+            self.on_checkpoint()
+            self.file.truncate(0)
+            self.size = 0
+            self.pending = []
+            if len(self.failures) != 0:
+                for lsn, record in self.failures.items():
+                    self.__write(lsn, record)
+                self.file.flush()
+                os.fsync(self.file.fileno())
+
+    def close(self):
+        with self.cond:
+            self.file.close()